@@ -0,0 +1,181 @@
+from datetime import datetime, timedelta
+from airflow import DAG
+from airflow.operators.dummy_operator import DummyOperator
+from airflow.utils.trigger_rule import TriggerRule
+from operators import (StageToRedshiftOperator, LoadFactOperator,
+                       LoadDimensionOperator, DataQualityOperator, LoadTimeDimensionOperator,
+                       LoadSongCatalogOperator, ResolveLateSongsOperator, AggregateMaintenanceOperator)
+from helpers import SqlQueries
+
+"""
+This Apache Airflow DAG loads history for range of dates in one pass instead of hourly catchup:
+ - Copy daily log files of all dates in range to staging table with one COPY from manifest:
+    - Stage_events;
+ - Copy new song files to staging table:
+    - Stage_songs.
+ - Load dimension and fact tables once over combined staging data:
+    - Load_time_dim_table;
+    - Load_user_dim_table;
+    - Load_song_catalog;
+    - Load_songplays_fact_table.
+ - Fill song_id and artist_id of earlier songplays whose songs and artists are in new song files
+   and keep unresolved songplays of range for later song files:
+    - Resolve_late_songs.
+ - Fold new and patched songplays of range into rollups:
+    - Maintain_aggregates.
+ - Verify all data of tables:
+    - Run_data_quality_checks.
+* DAG has no schedule, it is triggered with range of dates in configuration:
+    airflow trigger_dag backfill_dag -c '{"start_date": "2018-11-01", "end_date": "2018-11-30"}'
+* Ledger of staging is updated for copied log files, so scheduled runs of 'dag' for these dates
+  skip unchanged files.
+* Load_songplays_fact_table copies inserted rows to songplays_delta as in 'dag', so rollups do not miss
+  songplays of range; Maintain_aggregates runs after Resolve_late_songs to fold its corrections of patched
+  songplays and compares rollups with full recompute on every run (backfill is not hourly).
+"""
+
+default_args = {
+    'owner': 'udacity',
+    'depends_on_past': False,
+    'start_date': datetime(2018, 11, 1),
+    'retries': 3,
+    'retry_delay': timedelta(minutes=5),
+    'catchup_by_default': False,
+    'email_on_retry': False
+}
+
+dag = DAG('backfill_dag',
+          default_args=default_args,
+          description='Load range of dates to Redshift in one pass',
+          schedule_interval=None,
+          max_active_runs=1
+        )
+
+start_operator = DummyOperator(task_id='Begin_execution',  dag=dag)
+
+stage_events_to_redshift =  StageToRedshiftOperator(
+    task_id='Stage_events',
+    dag=dag,
+    redshift_conn_id="redshift",
+    aws_credentials_id="aws_credentials",
+    target_table="public.staging_events",
+    s3_bucket="udacity-dend",
+    s3_key="log_data",
+    json_paths="log_json_path.json",
+    use_partitioned_data="True",
+    manifest_bucket="{{ var.value.manifest_bucket }}",
+    backfill_start_date="{{ dag_run.conf['start_date'] }}",
+    backfill_end_date="{{ dag_run.conf['end_date'] }}",
+    copy_columns=SqlQueries.staging_events_columns,
+    post_copy_sql=[SqlQueries.staging_events_start_time_update]
+)
+
+stage_songs_to_redshift =  StageToRedshiftOperator(
+    task_id='Stage_songs',
+    dag=dag,
+    redshift_conn_id="redshift",
+    aws_credentials_id="aws_credentials",
+    target_table="public.staging_songs",
+    s3_bucket="udacity-dend",
+    s3_key="song_data",
+    json_paths="",
+    use_partitioned_data="False",
+    use_incremental_load="True",
+    manifest_bucket="{{ var.value.manifest_bucket }}"
+)
+
+load_songplays_table = LoadFactOperator(
+    task_id='Load_songplays_fact_table',
+    dag=dag,
+    redshift_conn_id="redshift",
+    target_table_name="songplays",
+    target_table_fields=SqlQueries.songplay_table_fields,
+    target_table_key=SqlQueries.songplay_table_key,
+    sql_query_insert=SqlQueries.songplay_table_insert,
+    insert_mode="window",
+    sql_query_select=SqlQueries.songplay_table_select,
+    window_query=SqlQueries.songplay_table_window,
+    delta_table="songplays_delta",
+    trigger_rule=TriggerRule.NONE_FAILED
+)
+
+load_user_dimension_table = LoadDimensionOperator(
+    task_id='Load_user_dim_table',
+    dag=dag,
+    redshift_conn_id="redshift",
+    target_table_name="users",
+    target_table_fields=SqlQueries.user_table_fields,
+    target_table_key=SqlQueries.user_table_key,
+    sql_query_insert=SqlQueries.user_table_insert,
+    insert_mode = "merge",
+)
+
+load_song_catalog = LoadSongCatalogOperator(
+    task_id='Load_song_catalog',
+    dag=dag,
+    redshift_conn_id="redshift",
+    artist_table_name="artists",
+    song_table_name="songs",
+    stage_task_ids=["Stage_songs"],
+    artist_scope_sql=SqlQueries.artist_table_scope,
+    song_scope_sql=SqlQueries.song_table_scope,
+    insert_mode = "append",
+)
+
+load_time_dimension_table = LoadTimeDimensionOperator(
+    task_id='Load_time_dim_table',
+    dag=dag,
+    redshift_conn_id="redshift",
+    aws_credentials_id="aws_credentials",
+    target_table_name="time",
+    output_bucket="{{ var.value.manifest_bucket }}",
+)
+
+resolve_late_songs = ResolveLateSongsOperator(
+    task_id='Resolve_late_songs',
+    dag=dag,
+    redshift_conn_id="redshift",
+    delta_table="songplays_delta",
+    catalog_task_ids=["Load_song_catalog"],
+    stage_task_ids=["Stage_events"],
+    trigger_rule=TriggerRule.NONE_FAILED
+)
+
+maintain_aggregates = AggregateMaintenanceOperator(
+    task_id='Maintain_aggregates',
+    dag=dag,
+    redshift_conn_id="redshift",
+    fact_table="songplays",
+    delta_table="songplays_delta",
+    rollups=SqlQueries.songplay_rollups,
+    check_hours=tuple(range(24)),
+    on_mismatch="repair",
+    trigger_rule=TriggerRule.NONE_FAILED
+)
+
+run_quality_checks = DataQualityOperator(
+    task_id='Run_data_quality_checks',
+    dag=dag,
+    redshift_conn_id="redshift",
+    table_key_list = SqlQueries.table_key_list,
+    dq_checks = SqlQueries.dq_checks,
+    value_checks = SqlQueries.dq_value_checks,
+    trigger_rule=TriggerRule.NONE_FAILED
+)
+
+end_operator = DummyOperator(task_id='Stop_execution',  dag=dag, trigger_rule=TriggerRule.NONE_FAILED)
+
+start_operator >> stage_songs_to_redshift
+start_operator >> stage_events_to_redshift
+
+stage_songs_to_redshift >> load_song_catalog
+
+stage_events_to_redshift >> load_time_dimension_table
+stage_events_to_redshift >> load_user_dimension_table
+
+load_song_catalog >> load_songplays_table
+load_time_dimension_table >> load_songplays_table
+load_user_dimension_table >> load_songplays_table
+
+load_songplays_table >> resolve_late_songs >> run_quality_checks >> end_operator
+resolve_late_songs >> maintain_aggregates >> end_operator
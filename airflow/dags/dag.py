@@ -1,10 +1,7 @@
 from datetime import datetime, timedelta
 import os
-from airflow import DAG
-from airflow.operators.dummy_operator import DummyOperator
-from operators import (StageToRedshiftOperator, LoadFactOperator,
-                       LoadDimensionOperator, DataQualityOperator)
-from helpers import SqlQueries
+from airflow.utils.trigger_rule import TriggerRule
+from helpers import SqlQueries, build_dags
 
 """ 
 This Apache Airflow DAG provides a pipeline to:
@@ -14,16 +11,43 @@ This Apache Airflow DAG provides a pipeline to:
  - Load data from staging tables to dimensions tables:
     - Load_time_dim_table;
     - Load_user_dim_table;
-    - Load_artist_dim_table;
-    - Load_song_dim_table.
+    - Load_song_catalog (artists and songs from one scan of staging_songs).
  - Load data from staging tables to fact table:
     - Load_songplays_fact_table.
+ - Fill song_id and artist_id of earlier songplays whose songs and artists have arrived in catalog late:
+    - Resolve_late_songs.
+ - Fold new rows of fact table into aggregate tables of song play analysis:
+    - Maintain_aggregates.
  - Verify the data loaded to fact and dimension tables:
     - Run_data_quality_checks.
+ - VACUUM and ANALYZE tables past thresholds of unsorted rows and stale statistics, propose keys of tables:
+    - Run_table_maintenance.
 * As a default:
     * Runs hourly;
     * Starts from 2018-11-01 00:00:00;
     * In case of failure - DAG retries 3 times, after 5 min delay;
+    * Stage_events skips COPY if daily log file has not been changed since last run,
+      then load and data quality tasks are skipped too.
+* Stage_songs copies new song files in checkpointed chunks: retry copies only chunks that failed,
+  rejected lines and malformed files are saved to staging_load_quarantine instead of failing task.
+* Load_songplays_fact_table copies inserted rows to songplays_delta, Maintain_aggregates folds them into
+  daily and hourly rollups; rollups are compared with full recompute once a day (hour 0).
+* Resolve_late_songs keeps keys of songplays without song or artist in songplays_unresolved and patches
+  only those that songs and artists loaded in run resolve (cost follows new songs, not size of songplays);
+  patched songplays are copied to songplays_delta with old keys (sign -1) and new keys (sign 1), so
+  Maintain_aggregates runs after it and moves their plays between groups of rollups.
+* Stage_events computes start_time of events once after COPY, Load_time_dim_table computes attributes
+  of new timestamps in Python (NumPy) and loads them by COPY.
+* With limit of WLM slots in extra 'wlm_slots' of connection 'redshift', sessions of tasks wait for lease
+  of slots (COPY is heavy, loads and maintenance are medium, data quality checks are light), so pipelines
+  of many sources do not overload WLM queues; critical path of songplays (Stage_events,
+  Load_songplays_fact_table) has higher priority_weight and is granted slots first.
+* DAG is built by helpers.dag_factory from declarative config PIPELINE; every entry of PIPELINE_VARIANTS
+  builds one more copy of pipeline (e.g. another source bucket or another schema of tables).
+* With environment variable SPARKIFY_FUSED_LOADS=True all load tasks are replaced by one task
+  Load_tables, which runs their sql in the same order in one transaction (one commit):
+    B --> E --> Load_tables --> C
+    B --> S --> Load_tables
 
 Datapipeline scheme:
 
@@ -31,16 +55,22 @@ B{{Begin_execution}} -->E(Stage_vents)
 B --> S(Stage_songs)
     E --> U(Load_user_dim_table)
     E --> T(Load_time_dim_table)
-	S --> A(Load_artist_dim_table)
-		A --> Sng(Load_song_dim_table)
+	S --> Sng(Load_song_catalog)
 			U --> F(Load_songplays_fact_table)
 			T --> F
 			Sng --> F
-				F --> C(Run_data_quality_checks)
-					C --> End{{End_execution}}
+				F --> R(Resolve_late_songs)
+					R --> C(Run_data_quality_checks)
+					R --> A(Maintain_aggregates)
+					C --> M(Run_table_maintenance)
+					A --> M
+						M --> End{{End_execution}}
 
 """
 
+# Priority of tasks on critical path of songplays, in Airflow queue and in queue of WLM slots
+CRITICAL_PATH_PRIORITY = 10
+
 default_args = {
     'owner': 'udacity',
     'depends_on_past': False,
@@ -51,114 +81,213 @@ default_args = {
     'email_on_retry': False
 }
 
-dag = DAG('dag',
-          default_args=default_args,
-          description='Load and transform data in Redshift with Airflow',
-          schedule_interval='0 * * * *'
-        )
-
-start_operator = DummyOperator(task_id='Begin_execution',  dag=dag)
-
-stage_events_to_redshift =  StageToRedshiftOperator(
-    task_id='Stage_events',
-    dag=dag,
-    redshift_conn_id="redshift",
-    aws_credentials_id="aws_credentials",
-    target_table="public.staging_events",
-    s3_bucket="udacity-dend",
-    s3_key="log_data",
-    json_paths="log_json_path.json",
-    use_partitioned_data="True",
-    execution_date="{{ ds }}"
-)
-
-
-stage_songs_to_redshift =  StageToRedshiftOperator(
-    task_id='Stage_songs',
-    dag=dag,
-    redshift_conn_id="redshift",
-    aws_credentials_id="aws_credentials",
-    target_table="public.staging_songs",
-    s3_bucket="udacity-dend",
-    s3_key="song_data",
-    json_paths="",
-    use_partitioned_data="False",
-    execution_date="{{ ds }}"
-)
-
-load_songplays_table = LoadFactOperator(
-    task_id='Load_songplays_fact_table',
-    dag=dag,
-    redshift_conn_id="redshift",
-    target_table_name="songplays",
-    target_table_fields=SqlQueries.songplay_table_fields,
-    target_table_key=SqlQueries.songplay_table_key,
-    sql_query_insert=SqlQueries.songplay_table_insert
-)
-
-load_user_dimension_table = LoadDimensionOperator(
-    task_id='Load_user_dim_table',
-    dag=dag,
-    redshift_conn_id="redshift",
-    target_table_name="users",
-    target_table_fields=SqlQueries.user_table_fields,
-    target_table_key=SqlQueries.user_table_key,
-    sql_query_insert=SqlQueries.user_table_insert,
-    insert_mode = "append",
-)
-
-load_song_dimension_table = LoadDimensionOperator(
-    task_id='Load_song_dim_table',
-    dag=dag,
-    redshift_conn_id="redshift",
-    target_table_name="songs",
-    target_table_fields=SqlQueries.song_table_fields,
-    target_table_key=SqlQueries.song_table_key,
-    sql_query_insert=SqlQueries.song_table_insert,
-    insert_mode = "append",
-)
-
-load_artist_dimension_table = LoadDimensionOperator(
-    task_id='Load_artist_dim_table',
-    dag=dag,
-    redshift_conn_id="redshift",
-    target_table_name="artists",
-    target_table_fields=SqlQueries.artist_table_fields,
-    target_table_key=SqlQueries.artist_table_key,
-    sql_query_insert=SqlQueries.artist_table_insert,
-    insert_mode = "append",
-)
-
-load_time_dimension_table = LoadDimensionOperator(
-    task_id='Load_time_dim_table',
-    dag=dag,
-    redshift_conn_id="redshift",
-    target_table_name="time",
-    target_table_fields=SqlQueries.time_table_fields,
-    target_table_key=SqlQueries.time_table_key,
-    sql_query_insert=SqlQueries.time_table_insert,
-)
-
-run_quality_checks = DataQualityOperator(
-    task_id='Run_data_quality_checks',
-    dag=dag,
-    redshift_conn_id="redshift",
-    table_key_list = SqlQueries.table_key_list,
-    dq_checks = SqlQueries.dq_checks
-)
-
-end_operator = DummyOperator(task_id='Stop_execution',  dag=dag)
-
-start_operator >> stage_songs_to_redshift
-start_operator >> stage_events_to_redshift
-
-stage_songs_to_redshift >> load_artist_dimension_table >> load_song_dimension_table
-
-stage_events_to_redshift >> load_time_dimension_table
-stage_events_to_redshift >> load_user_dimension_table
+PIPELINE = {
+    "dag_id": "dag",
+    "description": "Load and transform data in Redshift with Airflow",
+    "schedule_interval": "0 * * * *",
+    "default_args": default_args,
+    # Loads of dimension and fact tables run in one task and one transaction
+    "fused_loads": os.environ.get("SPARKIFY_FUSED_LOADS", "False") == "True",
+    "fused_params": {
+        "redshift_conn_id": "redshift",
+        "trigger_rule": TriggerRule.NONE_FAILED,
+        "priority_weight": CRITICAL_PATH_PRIORITY
+    },
+    "tasks": [
+        {
+            "task_id": "Stage_events",
+            "operator": "StageToRedshiftOperator",
+            "params": {
+                "redshift_conn_id": "redshift",
+                "aws_credentials_id": "aws_credentials",
+                "target_table": "public.staging_events",
+                "s3_bucket": "udacity-dend",
+                "s3_key": "log_data",
+                "json_paths": "log_json_path.json",
+                "use_partitioned_data": "True",
+                "execution_date": "{{ ds }}",
+                "skip_unchanged": "True",
+                "copy_columns": SqlQueries.staging_events_columns,
+                "post_copy_sql": [SqlQueries.staging_events_start_time_update],
+                "priority_weight": CRITICAL_PATH_PRIORITY
+            }
+        },
+        {
+            "task_id": "Stage_songs",
+            "operator": "StageToRedshiftOperator",
+            "params": {
+                "redshift_conn_id": "redshift",
+                "aws_credentials_id": "aws_credentials",
+                "target_table": "public.staging_songs",
+                "s3_bucket": "udacity-dend",
+                "s3_key": "song_data",
+                "json_paths": "",
+                "use_partitioned_data": "False",
+                "execution_date": "{{ ds }}",
+                "use_incremental_load": "True",
+                "manifest_bucket": "{{ var.value.manifest_bucket }}",
+                "use_resumable_load": "True",
+                "chunk_max_objects": 2000,
+                "max_errors": 10
+            }
+        },
+        {
+            "task_id": "Load_song_catalog",
+            "operator": "LoadSongCatalogOperator",
+            "upstream": ["Stage_songs"],
+            "load": True,
+            "params": {
+                "redshift_conn_id": "redshift",
+                "artist_table_name": "artists",
+                "song_table_name": "songs",
+                "artist_scope_sql": SqlQueries.artist_table_scope,
+                "song_scope_sql": SqlQueries.song_table_scope,
+                "stage_task_ids": ["Stage_songs"],
+                "insert_mode": "append"
+            }
+        },
+        {
+            "task_id": "Load_user_dim_table",
+            "operator": "LoadDimensionOperator",
+            "upstream": ["Stage_events"],
+            "load": True,
+            "params": {
+                "redshift_conn_id": "redshift",
+                "target_table_name": "users",
+                "target_table_fields": SqlQueries.user_table_fields,
+                "target_table_key": SqlQueries.user_table_key,
+                "sql_query_insert": SqlQueries.user_table_insert,
+                "scope_sql": SqlQueries.user_table_scope,
+                "stage_task_ids": ["Stage_events"],
+                "insert_mode": "merge"
+            }
+        },
+        {
+            "task_id": "Load_time_dim_table",
+            "operator": "LoadTimeDimensionOperator",
+            "upstream": ["Stage_events"],
+            "load": True,
+            "params": {
+                "redshift_conn_id": "redshift",
+                "aws_credentials_id": "aws_credentials",
+                "target_table_name": "time",
+                "output_bucket": "{{ var.value.manifest_bucket }}",
+                "scope_sql": SqlQueries.time_table_scope,
+                "stage_task_ids": ["Stage_events"]
+            },
+            # Fused loads render sql of all loads, so time table is loaded by sql there
+            "fused": {
+                "operator": "LoadDimensionOperator",
+                "params": {
+                    "redshift_conn_id": "redshift",
+                    "target_table_name": "time",
+                    "target_table_fields": SqlQueries.time_table_fields,
+                    "target_table_key": SqlQueries.time_table_key,
+                    "sql_query_insert": SqlQueries.time_table_insert,
+                    "scope_sql": SqlQueries.time_table_scope,
+                    "stage_task_ids": ["Stage_events"]
+                }
+            }
+        },
+        {
+            "task_id": "Load_songplays_fact_table",
+            "operator": "LoadFactOperator",
+            "upstream": ["Load_song_catalog", "Load_user_dim_table", "Load_time_dim_table"],
+            "load": True,
+            "params": {
+                "redshift_conn_id": "redshift",
+                "target_table_name": "songplays",
+                "target_table_fields": SqlQueries.songplay_table_fields,
+                "target_table_key": SqlQueries.songplay_table_key,
+                "sql_query_insert": SqlQueries.songplay_table_insert,
+                "insert_mode": "window",
+                "sql_query_select": SqlQueries.songplay_table_select,
+                "window_query": SqlQueries.songplay_table_window,
+                "scope_sql": SqlQueries.songplay_table_scope,
+                "stage_task_ids": ["Stage_events"],
+                "delta_table": "songplays_delta",
+                "trigger_rule": TriggerRule.NONE_FAILED,
+                "priority_weight": CRITICAL_PATH_PRIORITY
+            }
+        },
+        {
+            "task_id": "Resolve_late_songs",
+            "operator": "ResolveLateSongsOperator",
+            "upstream": ["Load_songplays_fact_table"],
+            "params": {
+                "redshift_conn_id": "redshift",
+                "fact_table": "songplays",
+                "delta_table": "songplays_delta",
+                "pending_table": "songplays_unresolved",
+                "song_table_name": "songs",
+                "artist_table_name": "artists",
+                "catalog_task_ids": ["Load_song_catalog"],
+                "stage_task_ids": ["Stage_events"],
+                "capture_sql": SqlQueries.songplay_unresolved_select,
+                "pending_retention_days": 90,
+                "trigger_rule": TriggerRule.NONE_FAILED
+            },
+            "fused": {
+                "params": {"catalog_task_ids": ["Load_tables"]}
+            }
+        },
+        {
+            "task_id": "Maintain_aggregates",
+            "operator": "AggregateMaintenanceOperator",
+            "upstream": ["Resolve_late_songs"],
+            "params": {
+                "redshift_conn_id": "redshift",
+                "fact_table": "songplays",
+                "delta_table": "songplays_delta",
+                "rollups": SqlQueries.songplay_rollups,
+                "check_hours": (0,),
+                "on_mismatch": "repair",
+                "trigger_rule": TriggerRule.NONE_FAILED
+            }
+        },
+        {
+            "task_id": "Run_data_quality_checks",
+            "operator": "DataQualityOperator",
+            "upstream": ["Resolve_late_songs"],
+            "params": {
+                "redshift_conn_id": "redshift",
+                "table_key_list": SqlQueries.table_key_list,
+                "dq_checks": SqlQueries.dq_checks,
+                "value_checks": SqlQueries.dq_value_checks,
+                "stage_task_ids": ["Stage_events", "Stage_songs"],
+                "scope_mode": "run",
+                "load_task_ids": ["Load_songplays_fact_table", "Load_user_dim_table", "Load_song_catalog",
+                                  "Load_time_dim_table"],
+                "full_check_hours": (0,),
+                "trigger_rule": TriggerRule.NONE_FAILED
+            },
+            "fused": {
+                "params": {"load_task_ids": ["Load_tables"]}
+            }
+        },
+        {
+            "task_id": "Run_table_maintenance",
+            "operator": "TableMaintenanceOperator",
+            "upstream": ["Run_data_quality_checks", "Maintain_aggregates"],
+            "params": {
+                "redshift_conn_id": "redshift",
+                "tables": SqlQueries.table_list + SqlQueries.aggregate_table_list + ["public.songplays_unresolved"],
+                "load_task_ids": ["Load_songplays_fact_table", "Load_user_dim_table", "Load_song_catalog",
+                                  "Load_time_dim_table", "Maintain_aggregates", "Resolve_late_songs"],
+                "run_advisor": "True",
+                "trigger_rule": TriggerRule.NONE_FAILED
+            },
+            "fused": {
+                "params": {"load_task_ids": ["Load_tables", "Maintain_aggregates", "Resolve_late_songs"]}
+            }
+        }
+    ]
+}
 
-load_song_dimension_table >> load_songplays_table
-load_time_dimension_table >> load_songplays_table
-load_user_dimension_table >> load_songplays_table
+# Copies of pipeline: dag_id and overrides of top-level keys and of parameters of tasks, e.g.
+#   {"dag_id": "dag_eu", "params": {"Stage_events": {"s3_bucket": "sparkify-eu"}}}
+PIPELINE_VARIANTS = [
+    {"dag_id": "dag"}
+]
 
-load_songplays_table >> run_quality_checks >> end_operator
\ No newline at end of file
+globals().update(build_dags(PIPELINE, PIPELINE_VARIANTS))
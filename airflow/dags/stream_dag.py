@@ -0,0 +1,112 @@
+from datetime import datetime, timedelta
+import os
+from helpers import SqlQueries, build_dags
+
+"""
+This Apache Airflow DAG ingests event log stream in micro-batches, so new events are in tables
+within minutes instead of after daily log file:
+ - Poll stream prefix for objects after high-water mark, copy ready batch to temp table shadowing
+   own staging table of stream (stream_staging_events) and load users, time and songplays tables
+   from it in one transaction:
+    - Ingest_micro_batches.
+* Runs every POLL_MINUTES minutes, one run at a time.
+* Batch is loaded when it reaches 64 MB or 1000 objects, or when its oldest object has waited
+  max_wait_minutes = STREAM_LATENCY_MINUTES - 2 * POLL_MINUTES (one poll interval to notice batch
+  and one for loading), so latency of event stays within STREAM_LATENCY_MINUTES.
+* Songs and artists are loaded by daily 'dag' (events of songs that are not loaded yet have no song_id
+  and artist_id in songplays, as in daily loads).
+* New songplays are copied to songplays_delta too, Maintain_aggregates of daily 'dag' folds them into rollups.
+  Maintain_aggregates locks songplays_delta while it folds, so batch waits for fold (and fold for batch)
+  instead of failing with serializable isolation violation; rows written after snapshot of fold stay
+  for next fold.
+* Latency is set by environment variable SPARKIFY_STREAM_LATENCY_MINUTES (15 as default, read when DAG is parsed).
+
+Datapipeline scheme:
+
+B{{Begin_execution}} --> I(Ingest_micro_batches) --> End{{Stop_execution}}
+
+"""
+
+POLL_MINUTES = 5
+
+STREAM_LATENCY_MINUTES = int(os.environ.get("SPARKIFY_STREAM_LATENCY_MINUTES", "15"))
+
+default_args = {
+    'owner': 'udacity',
+    'depends_on_past': False,
+    'start_date': datetime(2018, 11, 1),
+    'retries': 3,
+    'retry_delay': timedelta(minutes=1),
+    'email_on_retry': False
+}
+
+PIPELINE = {
+    "dag_id": "stream_dag",
+    "description": "Ingest event log stream to Redshift in micro-batches",
+    "schedule_interval": timedelta(minutes=POLL_MINUTES),
+    "default_args": default_args,
+    "dag_params": {
+        "catchup": False,
+        "max_active_runs": 1
+    },
+    "tasks": [
+        {
+            "task_id": "Ingest_micro_batches",
+            "operator": "MicroBatchIngestOperator",
+            "params": {
+                "redshift_conn_id": "redshift",
+                "aws_credentials_id": "aws_credentials",
+                "staging_table": "public.stream_staging_events",
+                "s3_bucket": "udacity-dend",
+                "s3_key": "log_stream/",
+                "json_paths": "log_json_path.json",
+                "manifest_bucket": "{{ var.value.manifest_bucket }}",
+                "max_batch_mb": 64,
+                "max_batch_objects": 1000,
+                "max_wait_minutes": max(STREAM_LATENCY_MINUTES - 2 * POLL_MINUTES, 0),
+                "copy_columns": SqlQueries.staging_events_columns,
+                "post_copy_sql": [SqlQueries.staging_events_start_time_update],
+                "loads": [
+                    {
+                        "operator": "LoadDimensionOperator",
+                        "params": {
+                            "target_table_name": "users",
+                            "target_table_fields": SqlQueries.user_table_fields,
+                            "target_table_key": SqlQueries.user_table_key,
+                            "sql_query_insert": SqlQueries.user_table_insert,
+                            "insert_mode": "merge"
+                        }
+                    },
+                    {
+                        "operator": "LoadDimensionOperator",
+                        "params": {
+                            "target_table_name": "time",
+                            "target_table_fields": SqlQueries.time_table_fields,
+                            "target_table_key": SqlQueries.time_table_key,
+                            "sql_query_insert": SqlQueries.time_table_insert
+                        }
+                    },
+                    {
+                        "operator": "LoadFactOperator",
+                        "params": {
+                            "target_table_name": "songplays",
+                            "target_table_fields": SqlQueries.songplay_table_fields,
+                            "target_table_key": SqlQueries.songplay_table_key,
+                            "sql_query_insert": SqlQueries.songplay_table_insert,
+                            "insert_mode": "window",
+                            "sql_query_select": SqlQueries.songplay_table_select,
+                            "window_query": SqlQueries.songplay_table_window,
+                            "delta_table": "songplays_delta"
+                        }
+                    }
+                ]
+            }
+        }
+    ]
+}
+
+PIPELINE_VARIANTS = [
+    {"dag_id": "stream_dag"}
+]
+
+globals().update(build_dags(PIPELINE, PIPELINE_VARIANTS))
@@ -2,18 +2,9 @@ from __future__ import division, absolute_import, print_function
 
 from airflow.plugins_manager import AirflowPlugin
 
-import operators
-import helpers
-
 # Defining the plugin class
+# Operators and helpers are not listed here: DAGs import them from `operators` and `helpers` packages,
+# which import module of operator or helper on its first use, so loading of plugin on every parse loop
+# of scheduler imports no operator module (and no psycopg2).
 class UdacityPlugin(AirflowPlugin):
     name = "udacity_plugin"
-    operators = [
-        operators.StageToRedshiftOperator,
-        operators.LoadFactOperator,
-        operators.LoadDimensionOperator,
-        operators.DataQualityOperator
-    ]
-    helpers = [
-        helpers.SqlQueries
-    ]
@@ -1,5 +1,107 @@
-from helpers.sql_queries import SqlQueries
+import importlib
+
+# Helper modules are imported on first use of helper, so e.g. NumPy of time dimension builder
+# and psycopg2 of connection pool are not imported by DAGs which do not use them
+_helper_modules = {
+    'SqlQueries': 'helpers.sql_queries',
+    'list_s3_objects': 'helpers.s3_manifest',
+    'object_fingerprint': 'helpers.s3_manifest',
+    'select_new_objects': 'helpers.s3_manifest',
+    'build_copy_manifest': 'helpers.s3_manifest',
+    'split_objects_by_size': 'helpers.s3_manifest',
+    'split_objects_into_chunks': 'helpers.s3_manifest',
+    'push_staging_changed': 'helpers.change_signal',
+    'is_staging_unchanged': 'helpers.change_signal',
+    'push_load_scope': 'helpers.change_signal',
+    'push_load_scopes': 'helpers.change_signal',
+    'pull_load_scopes': 'helpers.change_signal',
+    'sql_literal': 'helpers.sql_literals',
+    'RedshiftConnectionPool': 'helpers.redshift_pool',
+    'RedshiftSession': 'helpers.redshift_pool',
+    'get_pool': 'helpers.redshift_pool',
+    'redshift_session': 'helpers.redshift_pool',
+    'log_pool_report': 'helpers.redshift_pool',
+    'parse_json_paths': 'helpers.json_records',
+    'iter_json_objects': 'helpers.json_records',
+    'extract_fields': 'helpers.json_records',
+    'write_csv_gzip': 'helpers.json_records',
+    'OperatorTelemetry': 'helpers.telemetry',
+    'pull_table_rows': 'helpers.telemetry',
+    'QueryRegistry': 'helpers.query_registry',
+    'registry': 'helpers.query_registry',
+    'validate_template': 'helpers.query_registry',
+    'run_statements': 'helpers.query_registry',
+    'time_attributes': 'helpers.time_dimension',
+    'time_csv': 'helpers.time_dimension',
+    'get_s3_hook': 'helpers.aws_hooks',
+    'get_aws_credentials': 'helpers.aws_hooks',
+    'apply_variant': 'helpers.dag_factory',
+    'build_dag': 'helpers.dag_factory',
+    'build_dags': 'helpers.dag_factory',
+    'select_micro_batch': 'helpers.micro_batch',
+    'list_folder_objects': 'helpers.micro_batch',
+    'collect_sql_texts': 'helpers.key_advisor',
+    'collect_column_usage': 'helpers.key_advisor',
+    'advise_table_keys': 'helpers.key_advisor',
+    'render_key_ddl': 'helpers.key_advisor',
+    'SlotScheduler': 'helpers.wlm_scheduler',
+    'get_scheduler': 'helpers.wlm_scheduler'
+}
 
 __all__ = [
     'SqlQueries',
-]
\ No newline at end of file
+    'list_s3_objects',
+    'object_fingerprint',
+    'select_new_objects',
+    'build_copy_manifest',
+    'split_objects_by_size',
+    'split_objects_into_chunks',
+    'sql_literal',
+    'RedshiftConnectionPool',
+    'RedshiftSession',
+    'get_pool',
+    'redshift_session',
+    'log_pool_report',
+    'push_staging_changed',
+    'is_staging_unchanged',
+    'push_load_scope',
+    'push_load_scopes',
+    'pull_load_scopes',
+    'parse_json_paths',
+    'iter_json_objects',
+    'extract_fields',
+    'write_csv_gzip',
+    'OperatorTelemetry',
+    'pull_table_rows',
+    'QueryRegistry',
+    'registry',
+    'validate_template',
+    'run_statements',
+    'time_attributes',
+    'time_csv',
+    'get_s3_hook',
+    'get_aws_credentials',
+    'apply_variant',
+    'build_dag',
+    'build_dags',
+    'select_micro_batch',
+    'list_folder_objects',
+    'collect_sql_texts',
+    'collect_column_usage',
+    'advise_table_keys',
+    'render_key_ddl',
+    'SlotScheduler',
+    'get_scheduler',
+]
+
+
+def __getattr__(name):
+    if name not in _helper_modules:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module(_helper_modules[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
\ No newline at end of file
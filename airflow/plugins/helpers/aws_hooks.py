@@ -0,0 +1,15 @@
+def get_s3_hook(aws_credentials_id):
+    """
+    Returns S3 hook of AWS connection in Airflow.
+    Hook (and boto3) is imported at run of task, not at every parsing of DAG by scheduler.
+    """
+    from airflow.hooks.S3_hook import S3Hook
+    return S3Hook(aws_conn_id=aws_credentials_id)
+
+
+def get_aws_credentials(aws_credentials_id):
+    """
+    Returns credentials (access_key, secret_key) of AWS connection in Airflow.
+    """
+    from airflow.contrib.hooks.aws_hook import AwsHook
+    return AwsHook(aws_credentials_id).get_credentials()
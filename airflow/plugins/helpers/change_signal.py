@@ -0,0 +1,71 @@
+STAGING_CHANGED_KEY = "staging_changed"
+
+
+def push_staging_changed(context, changed):
+    """
+    Publishes signal of staging task to XCom whether staging table got new data.
+
+    context - context of task instance
+    changed - True if staging table has been reloaded, False if source data has not been changed
+    """
+    context["ti"].xcom_push(key=STAGING_CHANGED_KEY, value=changed)
+
+
+def is_staging_unchanged(context, stage_task_ids):
+    """
+    Checks signals of staging tasks.
+    Returns True only if all staging tasks reported that source data has not been changed.
+    Tasks without signal are treated as changed.
+
+    context - context of task instance
+    stage_task_ids - list of staging task ids
+    """
+    if not stage_task_ids:
+        return False
+    signals = context["ti"].xcom_pull(task_ids=list(stage_task_ids), key=STAGING_CHANGED_KEY)
+    return all(signal is False for signal in signals)
+
+
+LOAD_SCOPE_KEY = "load_scope"
+
+
+def push_load_scope(context, table_name, scope_sql):
+    """
+    Publishes scope of rows loaded by load task to XCom.
+
+    context - context of task instance
+    table_name - name of loaded table
+    scope_sql - sql query returning keys of rows in loaded batch
+    """
+    context["ti"].xcom_push(key=LOAD_SCOPE_KEY, value={"table_name": table_name, "scope_sql": scope_sql})
+
+
+def push_load_scopes(context, scopes):
+    """
+    Publishes scopes of rows loaded to several tables by one task (fused loads) to XCom.
+
+    context - context of task instance
+    scopes - list of pairs of table name and sql query returning keys of rows in loaded batch
+    """
+    context["ti"].xcom_push(key=LOAD_SCOPE_KEY, value=[{"table_name": table_name, "scope_sql": scope_sql}
+                                                        for table_name, scope_sql in scopes])
+
+
+def pull_load_scopes(context, load_task_ids):
+    """
+    Reads scopes published by load tasks.
+    Returns dictionary with pairs of table name (without schema) and sql query returning keys of loaded rows.
+    Skipped load tasks do not publish scope.
+
+    context - context of task instance
+    load_task_ids - list of load task ids
+    """
+    if not load_task_ids:
+        return {}
+    scopes = []
+    for task_scopes in context["ti"].xcom_pull(task_ids=list(load_task_ids), key=LOAD_SCOPE_KEY):
+        if isinstance(task_scopes, list):
+            scopes.extend(task_scopes)
+        elif task_scopes:
+            scopes.append(task_scopes)
+    return {scope["table_name"].split(".")[-1]: scope["scope_sql"] for scope in scopes}
@@ -0,0 +1,133 @@
+import copy
+
+from airflow import DAG
+from airflow.operators.dummy_operator import DummyOperator
+from airflow.utils.trigger_rule import TriggerRule
+
+BEGIN_TASK_ID = "Begin_execution"
+END_TASK_ID = "Stop_execution"
+FUSED_TASK_ID = "Load_tables"
+
+
+def apply_variant(config, variant):
+    """
+    Returns copy of pipeline config with overrides of variant.
+    Top-level keys of variant (dag_id, schedule_interval, fused_loads, ...) replace keys of config,
+    key 'params' is dictionary {task_id: {parameter: value}} merged into parameters of tasks.
+
+    config - pipeline config (see build_dag)
+    variant - overrides of one copy of pipeline (e.g. another source bucket or another schema of tables)
+    """
+    config = copy.deepcopy(config)
+    variant = dict(variant or {})
+    task_params = variant.pop("params", {})
+    config.update(variant)
+    tasks = {spec["task_id"]: spec for spec in config["tasks"]}
+    for task_id, params in task_params.items():
+        if task_id not in tasks:
+            raise ValueError("Unknown task {} in variant of DAG {}".format(task_id, config["dag_id"]))
+        tasks[task_id].setdefault("params", {}).update(params)
+    return config
+
+
+def build_dag(config, variant=None):
+    """
+    Builds DAG Begin_execution -> tasks -> Stop_execution from declarative config.
+
+    config - dictionary:
+        dag_id, description, schedule_interval, default_args - arguments of DAG
+        dag_params - other arguments of DAG (e.g. max_active_runs)
+        fused_loads - True to replace load tasks by one FusedLoadOperator task Load_tables (one transaction)
+        fused_params - parameters of Load_tables task
+        tasks - list of tasks in order of dependencies, every task is dictionary:
+            task_id - id of task
+            operator - name of operator class in operators package
+            params - parameters of operator
+            upstream - list of ids of upstream tasks (declared before task);
+                       tasks without upstream tasks run after Begin_execution
+            load - True for load tasks which are fused into Load_tables with fused_loads
+            fused - overrides of operator and params used with fused_loads
+        Tasks without downstream tasks run before Stop_execution.
+    variant - overrides of config (see apply_variant)
+    """
+    import operators
+
+    config = apply_variant(config, variant)
+    fused_loads = config.get("fused_loads", False)
+    dag = DAG(config["dag_id"],
+              default_args=config.get("default_args", {}),
+              description=config.get("description", ""),
+              schedule_interval=config.get("schedule_interval"),
+              **config.get("dag_params", {}))
+
+    begin = DummyOperator(task_id=BEGIN_TASK_ID, dag=dag)
+    end = DummyOperator(task_id=END_TASK_ID, dag=dag, trigger_rule=TriggerRule.NONE_FAILED)
+
+    tasks = {}
+    upstream = {}
+    fused_operators = []
+    fused_upstream = []
+    for spec in config["tasks"]:
+        task_id = spec["task_id"]
+        if task_id in tasks or task_id in (BEGIN_TASK_ID, END_TASK_ID, FUSED_TASK_ID):
+            raise ValueError("Duplicate task {} in DAG {}".format(task_id, config["dag_id"]))
+        operator_name = spec["operator"]
+        params = dict(spec.get("params", {}))
+        if fused_loads and "fused" in spec:
+            operator_name = spec["fused"].get("operator", operator_name)
+            params.update(spec["fused"].get("params", {}))
+        fused = fused_loads and spec.get("load", False)
+
+        task_upstream = []
+        for upstream_id in spec.get("upstream", []):
+            if upstream_id not in tasks:
+                raise ValueError("Upstream task {} of {} is not declared before it".format(upstream_id, task_id))
+            # Tasks depending on load tasks depend on Load_tables with fused loads
+            upstream_id = FUSED_TASK_ID if tasks[upstream_id] is None else upstream_id
+            if upstream_id not in task_upstream:
+                task_upstream.append(upstream_id)
+
+        operator_class = getattr(operators, operator_name)
+        task = operator_class(task_id=task_id, dag=None if fused else dag, **params)
+        if fused:
+            # Load task only renders its sql in Load_tables
+            fused_operators.append(task)
+            fused_upstream.extend(upstream_id for upstream_id in task_upstream
+                                  if upstream_id != FUSED_TASK_ID and upstream_id not in fused_upstream)
+            tasks[task_id] = None
+        else:
+            tasks[task_id] = task
+            upstream[task_id] = task_upstream
+
+    if fused_operators:
+        tasks[FUSED_TASK_ID] = operators.FusedLoadOperator(task_id=FUSED_TASK_ID,
+                                                           dag=dag,
+                                                           load_operators=fused_operators,
+                                                           **config.get("fused_params", {}))
+        upstream[FUSED_TASK_ID] = fused_upstream
+
+    has_downstream = set()
+    for task_id, task_upstream in upstream.items():
+        if not task_upstream:
+            begin >> tasks[task_id]
+        for upstream_id in task_upstream:
+            tasks[upstream_id] >> tasks[task_id]
+            has_downstream.add(upstream_id)
+    for task_id in upstream:
+        if task_id not in has_downstream:
+            tasks[task_id] >> end
+    return dag
+
+
+def build_dags(config, variants):
+    """
+    Builds one DAG for every variant of pipeline config.
+    Returns dictionary {dag_id: DAG}; DAG file puts DAGs into its globals, so Airflow finds them.
+    """
+    dags = {}
+    for variant in variants:
+        dag = build_dag(config, variant)
+        if dag.dag_id in dags:
+            raise ValueError("Duplicate DAG {}".format(dag.dag_id))
+        dags[dag.dag_id] = dag
+    return dags
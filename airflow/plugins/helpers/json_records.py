@@ -0,0 +1,90 @@
+import csv
+import gzip
+import io
+import json
+import re
+
+CSV_NULL = "\\N"
+
+json_path_item = re.compile(r"""\[\s*'([^']*)'\s*\]|\[\s*"([^"]*)"\s*\]|\[\s*(\d+)\s*\]|\.([A-Za-z_][A-Za-z0-9_]*)""")
+
+
+def parse_json_paths(json_paths_document):
+    """
+    Parses JSONPaths file of Redshift COPY.
+    Returns list of paths, every path is list of object keys and array indexes.
+
+    json_paths_document - text of JSONPaths file, e.g. {"jsonpaths": ["$['artist']", "$.auth"]}
+    """
+    paths = []
+    for expression in json.loads(json_paths_document)["jsonpaths"]:
+        if not expression.startswith("$"):
+            raise ValueError("Invalid JSONPath expression {}".format(expression))
+        path = []
+        for quoted, double_quoted, index, name in json_path_item.findall(expression[1:]):
+            if index:
+                path.append(int(index))
+            else:
+                path.append(quoted or double_quoted or name)
+        paths.append(path)
+    return paths
+
+
+def iter_json_objects(text):
+    """
+    Iterates over JSON objects in text.
+    Objects may be separated by new lines or follow one another as in Redshift COPY source files.
+    """
+    decoder = json.JSONDecoder()
+    position = 0
+    length = len(text)
+    while True:
+        while position < length and text[position].isspace():
+            position += 1
+        if position >= length:
+            return
+        record, position = decoder.raw_decode(text, position)
+        yield record
+
+
+def extract_fields(record, paths):
+    """
+    Extracts values of fields from JSON object by list of paths.
+    Missing fields are returned as None.
+    """
+    values = []
+    for path in paths:
+        value = record
+        for item in path:
+            try:
+                value = value[item]
+            except (KeyError, IndexError, TypeError):
+                value = None
+                break
+        values.append(value)
+    return values
+
+
+def csv_value(value):
+    """
+    Renders JSON value for CSV file loaded by COPY with NULL AS '\\N'.
+    """
+    if value is None:
+        return CSV_NULL
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+
+def write_csv_gzip(rows):
+    """
+    Writes rows to gzip compressed CSV.
+    Returns compressed bytes.
+    """
+    text = io.StringIO()
+    writer = csv.writer(text, lineterminator="\n")
+    for row in rows:
+        writer.writerow([csv_value(value) for value in row])
+    return gzip.compress(text.getvalue().encode("utf-8"))
@@ -0,0 +1,171 @@
+import re
+from collections import Counter
+
+# Words after FROM/JOIN table which are not aliases of table
+SQL_KEYWORDS = {"on", "where", "join", "left", "right", "inner", "outer", "full", "cross", "group", "order",
+                "having", "limit", "union", "using", "as", "and", "or", "set", "values", "select", "natural"}
+
+TABLE_REFERENCE = re.compile(r'\b(?:FROM|JOIN)\s+([\w."]+)(?:\s+(?:AS\s+)?(\w+))?', re.IGNORECASE)
+
+TABLE_PLACEHOLDER = re.compile(r'\{(\w+?)_table_name\}')
+
+PLACEHOLDER = re.compile(r'\{[^{}]*\}')
+
+# Qualified column compared with qualified column (join) or with value (filter)
+PREDICATE = re.compile(r'\b(\w+)\.("?\w+"?)\s*(<=|>=|<>|!=|=|<|>|\bBETWEEN\b|\bIN\b)\s*([A-Za-z_]\w*\.\w+\b)?',
+                       re.IGNORECASE)
+
+RANGE_OPERATORS = {"<", ">", "<=", ">=", "between"}
+
+
+def short_table_name(table_name):
+    """
+    Returns name of table without schema and quotes in lower case.
+    """
+    return table_name.split(".")[-1].strip('"').lower()
+
+
+def collect_sql_texts(source):
+    """
+    Collects sql texts from attributes of class (e.g. SqlQueries): strings, lists and dictionaries of strings.
+    """
+    texts = []
+    values = [value for name, value in sorted(vars(source).items()) if not name.startswith("_")]
+    while values:
+        value = values.pop(0)
+        if isinstance(value, str):
+            texts.append(value)
+        elif isinstance(value, (list, tuple)):
+            values.extend(value)
+        elif isinstance(value, dict):
+            values.extend(value.values())
+    return texts
+
+
+def collect_column_usage(queries, table_fields):
+    """
+    Counts columns of analysed tables used in joins, equality filters and range filters of sql queries.
+    Returns dictionary {table name: {"join": Counter, "filter": Counter, "range": Counter, "partners": {column: set}}},
+    partners are analysed tables joined on column.
+
+    queries - list of sql queries or templates; placeholders {<name>_table_name} are resolved to analysed table
+              whose name starts with <name> (e.g. {song_table_name} - songs), other placeholders are ignored
+    table_fields - dictionary {table name: list of columns} of analysed tables (e.g. tables of star schema)
+    """
+    tables = {short_table_name(table_name): table_name for table_name in table_fields}
+    columns = {short_table_name(table_name): {column.strip().strip('"').lower() for column in fields}
+               for table_name, fields in table_fields.items()}
+    usage = {table_name: {"join": Counter(), "filter": Counter(), "range": Counter(), "partners": {}}
+             for table_name in table_fields}
+
+    def resolve_placeholder(match):
+        names = [name for name in tables if name.startswith(match.group(1).lower())]
+        return names[0] if len(names) == 1 else match.group(0)
+
+    for query in queries:
+        query = PLACEHOLDER.sub(" ", TABLE_PLACEHOLDER.sub(resolve_placeholder, query))
+        aliases = {name: name for name in tables}
+        for table_name, alias in TABLE_REFERENCE.findall(query):
+            table_name = short_table_name(table_name)
+            if table_name in tables and alias and alias.lower() not in SQL_KEYWORDS:
+                aliases[alias.lower()] = table_name
+
+        def resolve(qualifier, column):
+            table_name = aliases.get(qualifier.lower())
+            column = column.strip('"').lower()
+            if table_name is None or column not in columns[table_name]:
+                return None, column
+            return table_name, column
+
+        for qualifier, column, operator, other in PREDICATE.findall(query):
+            table_name, column = resolve(qualifier, column)
+            if other:
+                # Join: both sides are counted; column of subquery or staging table is join without partner
+                other_table, other_column = resolve(*other.split("."))
+                for side, side_column, partner in ((table_name, column, other_table),
+                                                   (other_table, other_column, table_name)):
+                    if side is None:
+                        continue
+                    usage[tables[side]]["join"][side_column] += 1
+                    if partner is not None and partner != side:
+                        usage[tables[side]]["partners"].setdefault(side_column, set()).add(tables[partner])
+            elif table_name is not None:
+                kind = "range" if operator.lower() in RANGE_OPERATORS else "filter"
+                usage[tables[table_name]][kind][column] += 1
+    return usage
+
+
+def advise_table_keys(usage, table_fields, table_rows, all_rows_threshold=3000000):
+    """
+    Proposes distribution style, distribution key and sort key of every analysed table from usage of its columns:
+    - the biggest table (fact) and tables with at least all_rows_threshold rows are distributed by column
+      joined most often (ties are broken by size of joined tables, so joined big tables are co-located),
+      tables without joins are distributed evenly
+    - smaller tables (dimensions) are copied to all nodes (DISTSTYLE ALL)
+    - sort key is column with the best score of range filters (x2), equality filters and joins
+      (ties are broken by order of columns)
+    Returns list of dictionaries with table, rows, diststyle, distkey, sortkey and reason of proposal.
+
+    usage - result of collect_column_usage
+    table_fields - dictionary {table name: list of columns} of analysed tables
+    table_rows - dictionary {table name: number of rows}
+    all_rows_threshold - number of rows from which table is not copied to all nodes
+    """
+    largest = max(table_fields, key=lambda table_name: table_rows.get(table_name, 0))
+    distributed = {table_name for table_name in table_fields
+                   if table_name == largest or table_rows.get(table_name, 0) >= all_rows_threshold}
+    advice = []
+    for table_name, fields in table_fields.items():
+        table_usage = usage[table_name]
+        order = [column.strip().strip('"').lower() for column in fields]
+        reasons = []
+        if table_name in distributed:
+            joins = table_usage["join"]
+            if joins:
+                distkey = max(joins, key=lambda column: (joins[column],
+                                                         max([table_rows.get(partner, 0)
+                                                              for partner in table_usage["partners"].get(column, ())
+                                                              if partner in distributed] or [0]),
+                                                         -order.index(column)))
+                diststyle = "KEY"
+                reasons.append("joined on {} {} times{}".format(
+                                    distkey, joins[distkey],
+                                    " with " + ", ".join(sorted(table_usage["partners"][distkey]))
+                                    if distkey in table_usage["partners"] else ""))
+            else:
+                distkey, diststyle = None, "EVEN"
+                reasons.append("no joins")
+        else:
+            distkey, diststyle = None, "ALL"
+            reasons.append("{} rows, below {}".format(table_rows.get(table_name, 0), all_rows_threshold))
+
+        scores = Counter()
+        for kind, weight in (("range", 2), ("filter", 1), ("join", 1)):
+            for column, count in table_usage[kind].items():
+                scores[column] += weight * count
+        sortkey = max(scores, key=lambda column: (scores[column], -order.index(column))) if scores else None
+        if sortkey is not None:
+            reasons.append("sort key {}: {} range filters, {} filters, {} joins".format(
+                                sortkey, table_usage["range"][sortkey], table_usage["filter"][sortkey],
+                                table_usage["join"][sortkey]))
+        advice.append({"table": table_name,
+                       "rows": table_rows.get(table_name, 0),
+                       "diststyle": diststyle,
+                       "distkey": distkey,
+                       "sortkey": sortkey,
+                       "reason": "; ".join(reasons)})
+    return advice
+
+
+def render_key_ddl(advice):
+    """
+    Renders ALTER TABLE statements that apply proposal of advise_table_keys to existing table.
+    """
+    statements = []
+    if advice["diststyle"] == "KEY":
+        statements.append("ALTER TABLE {} ALTER DISTKEY {}".format(advice["table"], advice["distkey"]))
+    else:
+        statements.append("ALTER TABLE {} ALTER DISTSTYLE {}".format(advice["table"], advice["diststyle"]))
+    if advice["sortkey"] is not None:
+        statements.append("ALTER TABLE {} ALTER SORTKEY ({})".format(advice["table"], advice["sortkey"]))
+    return statements
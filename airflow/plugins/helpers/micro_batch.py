@@ -0,0 +1,55 @@
+import datetime
+import hashlib
+import os
+
+
+def select_micro_batch(objects, max_batch_bytes, max_batch_objects, max_wait, now):
+    """
+    Selects next micro-batch from objects after high-water mark (objects are taken in order of keys).
+    Returns pair of batch and flag if batch is ready to load: batch is full (max_batch_bytes or
+    max_batch_objects is reached or more objects are waiting) or its oldest object has waited max_wait.
+
+    objects - list of objects from list_s3_objects listed after high-water mark
+    max_batch_bytes - maximum size of batch in bytes (batch has at least one object)
+    max_batch_objects - maximum number of objects in batch
+    max_wait - maximum time (timedelta) for which object waits until batch is full
+    now - current time, timezone aware as last modified time of S3 objects
+    """
+    pending = sorted(objects, key=lambda obj: obj["key"])
+    batch = []
+    batch_bytes = 0
+    for obj in pending:
+        if batch and (batch_bytes + obj["size"] > max_batch_bytes or len(batch) >= max_batch_objects):
+            break
+        batch.append(obj)
+        batch_bytes += obj["size"]
+    if not batch:
+        return batch, False
+    full = len(batch) < len(pending) or batch_bytes >= max_batch_bytes or len(batch) >= max_batch_objects
+    oldest = min(obj["last_modified"] for obj in batch)
+    return batch, full or now - oldest >= max_wait
+
+
+def list_folder_objects(folder, prefix="", start_after=None):
+    """
+    Lists files of local folder as objects of list_s3_objects (stand-in of S3 prefix for tests and benchmark).
+    Key is path relative to folder with '/' separators, last modified time is modification time of file in UTC.
+
+    folder - local folder used as bucket
+    prefix - prefix of keys
+    start_after - key after which objects are listed; None to list all objects
+    """
+    objects = []
+    for directory, _, file_names in os.walk(folder):
+        for file_name in file_names:
+            path = os.path.join(directory, file_name)
+            key = os.path.relpath(path, folder).replace(os.sep, "/")
+            if not key.startswith(prefix) or (start_after and key <= start_after):
+                continue
+            stat = os.stat(path)
+            objects.append({"key": key,
+                            "etag": hashlib.md5("{}:{}:{}".format(key, stat.st_size, stat.st_mtime).encode()).hexdigest(),
+                            "size": stat.st_size,
+                            "last_modified": datetime.datetime.fromtimestamp(int(stat.st_mtime),
+                                                                             datetime.timezone.utc)})
+    return sorted(objects, key=lambda obj: obj["key"])
@@ -0,0 +1,170 @@
+import datetime
+import hashlib
+import re
+import string
+import threading
+import weakref
+
+from helpers.sql_queries import SqlQueries
+from helpers.sql_literals import sql_literal
+
+# Placeholders that operators fill in templates of SqlQueries
+TEMPLATE_FIELDS = {"INSERT_MODE_QUERY", "table_name", "table_key", "scope_filter"}
+
+plan_cost_pattern = re.compile(r"cost=[\d.]+\.\.([\d.]+)")
+
+
+def validate_template(name, template):
+    """
+    Validates sql template: only known placeholders, balanced parentheses and quotes.
+    Raises ValueError with name of template.
+    """
+    try:
+        fields = {field for _, field, _, _ in string.Formatter().parse(template) if field is not None}
+    except ValueError as error:
+        raise ValueError("Invalid sql template {}: {}".format(name, error))
+    unknown = fields - TEMPLATE_FIELDS
+    if unknown:
+        raise ValueError("Invalid sql template {}: unknown placeholders {}".format(name, sorted(unknown)))
+    unquoted = re.sub(r"'[^']*'", "", template)
+    if unquoted.count("'") or unquoted.count("(") != unquoted.count(")"):
+        raise ValueError("Invalid sql template {}: unbalanced quotes or parentheses".format(name))
+    if not template.strip():
+        raise ValueError("Invalid sql template {}: empty template".format(name))
+
+
+class QueryRegistry:
+    """
+    Registry of sql templates of SqlQueries.
+    - Templates are validated once at import of plugin, broken template fails DAG parsing instead of task run
+    - Repeated statements run as prepared statements (PREPARE/EXECUTE), prepared once per pooled connection
+    - EXPLAIN cost of statements is compared with baseline saved in warehouse table:
+      jump of cost over threshold or new nested loop in plan is reported as warning or fails task
+
+    baseline_table - table with baselines of plans
+    """
+
+    baseline_select = ("""
+        SELECT plan_cost, has_nested_loop
+        FROM {baseline_table}
+        WHERE query_name = {query_name}
+    """)
+
+    baseline_delete = ("""
+        DELETE FROM {baseline_table}
+        WHERE query_name = {query_name}
+    """)
+
+    baseline_insert = ("""
+        INSERT INTO {baseline_table} (query_name, plan_cost, has_nested_loop, plan_hash, captured_at)
+        VALUES ({query_name}, {plan_cost}, {has_nested_loop}, {plan_hash}, {captured_at})
+    """)
+
+    def __init__(self, baseline_table="public.query_plan_baseline"):
+        self.baseline_table = baseline_table
+        self.templates = {}
+        self.prepared = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def register(self, name, template):
+        validate_template(name, template)
+        self.templates[name] = template
+
+    def register_queries(self, queries):
+        """
+        Registers insert and scope templates and data quality checks of class with queries.
+        """
+        for name in sorted(vars(queries)):
+            template = getattr(queries, name)
+            if isinstance(template, str) and name.endswith(("_insert", "_scope")):
+                self.register(name, template)
+        for dq_check in getattr(queries, "dq_checks", []):
+            self.register("dq_checks.{}".format(dq_check["type"]), dq_check["check_sql"])
+
+    def execute_prepared(self, redshift, sql):
+        """
+        Executes statement as prepared statement of connection of session.
+        Statement is prepared on first use on connection and executed by name later.
+        Returns list with number of affected rows.
+        """
+        plan_name = "sparkify_{}".format(hashlib.md5(sql.encode("utf-8")).hexdigest()[:16])
+        with self.lock:
+            prepared = self.prepared.setdefault(redshift.connection, set())
+        if plan_name not in prepared:
+            redshift.run("PREPARE {} AS {}".format(plan_name, sql))
+            prepared.add(plan_name)
+        return redshift.run("EXECUTE {}".format(plan_name))
+
+    def check_plan(self, redshift, query_name, sql, threshold=2.0, on_regression="warn", log=None):
+        """
+        Compares EXPLAIN cost of statement with baseline.
+        Baseline is replaced by current plan when there is no regression.
+        Returns dictionary with cost of plan, baseline cost and list of regressions.
+
+        query_name - name of query in baseline table
+        threshold - allowed ratio of current cost to baseline cost
+        on_regression - 'warn' to log warning, 'fail' to raise ValueError
+        """
+        plan = [row[0] for row in redshift.get_records("EXPLAIN " + sql)]
+        costs = [float(match.group(1)) for match in map(plan_cost_pattern.search, plan) if match]
+        plan_cost = costs[0] if costs else 0.0
+        has_nested_loop = any("Nested Loop" in line for line in plan)
+
+        params = dict(baseline_table = self.baseline_table, query_name = sql_literal(query_name))
+        baseline = redshift.get_first(QueryRegistry.baseline_select.format(**params))
+        regressions = []
+        if baseline is not None:
+            baseline_cost, baseline_nested_loop = float(baseline[0] or 0), baseline[1]
+            if baseline_cost > 0 and plan_cost > baseline_cost * threshold:
+                regressions.append("cost {:.2f} is {:.1f}x of baseline {:.2f}".format(
+                                        plan_cost, plan_cost / baseline_cost, baseline_cost))
+            if has_nested_loop and not baseline_nested_loop:
+                regressions.append("plan switched to nested loop")
+
+        if regressions:
+            message = "Plan regression of query {}: {}".format(query_name, "; ".join(regressions))
+            if on_regression == "fail":
+                raise ValueError(message)
+            if log is not None:
+                log.warning(message)
+        else:
+            redshift.run([QueryRegistry.baseline_delete.format(**params),
+                          QueryRegistry.baseline_insert.format(
+                                plan_cost = sql_literal(plan_cost),
+                                has_nested_loop = sql_literal(has_nested_loop),
+                                plan_hash = sql_literal(hashlib.md5("\n".join(plan).encode("utf-8")).hexdigest()),
+                                captured_at = sql_literal(datetime.datetime.utcnow()),
+                                **params)])
+        return {"query_name": query_name,
+                "plan_cost": plan_cost,
+                "has_nested_loop": has_nested_loop,
+                "baseline_cost": baseline[0] if baseline is not None else None,
+                "regressions": regressions}
+
+
+registry = QueryRegistry()
+registry.register_queries(SqlQueries)
+
+
+def run_statements(redshift, telemetry, statements, query_prefix, plan_guard="off", plan_cost_threshold=2.0,
+                   use_prepared=False, log=None):
+    """
+    Runs statements of load operator with optional plan guard and prepared statements.
+
+    redshift - session
+    telemetry - telemetry of operator
+    statements - list of sql statements
+    query_prefix - prefix of query names in baseline table (task id)
+    plan_guard - 'off', 'warn' or 'fail' for INSERT, DELETE and MERGE statements
+    plan_cost_threshold - allowed ratio of cost to baseline cost
+    use_prepared - True to run INSERT statements as prepared statements
+    """
+    for statement_no, statement in enumerate(statements):
+        keyword = statement.split(None, 1)[0].lower() if statement.strip() else ""
+        if plan_guard != "off" and keyword in ("insert", "delete", "merge"):
+            registry.check_plan(redshift, "{}.{}".format(query_prefix, statement_no), statement,
+                                threshold=plan_cost_threshold, on_regression=plan_guard, log=log)
+        if use_prepared and keyword == "insert":
+            telemetry.run(redshift, statement, runner=registry.execute_prepared)
+        else:
+            telemetry.run(redshift, statement)
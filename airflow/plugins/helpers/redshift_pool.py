@@ -0,0 +1,342 @@
+import atexit
+import threading
+import time
+from contextlib import contextmanager
+
+from airflow.hooks.base_hook import BaseHook
+
+
+class RedshiftSession:
+    """
+    Session on one pooled connection.
+    All statements of session run in one transaction which is committed when session is closed
+    (or in autocommit mode, if statement can not run in transaction block, e.g. VACUUM).
+
+    connection - psycopg2 connection
+    checkout_seconds - time spent on taking connection from pool (including opening of new connection)
+    queue_seconds - time spent in queue of slot scheduler before session was opened
+    """
+
+    def __init__(self, connection, checkout_seconds=0.0, queue_seconds=0.0):
+        self.connection = connection
+        self.checkout_seconds = checkout_seconds
+        self.queue_seconds = queue_seconds
+
+    def run(self, sql, parameters=None):
+        """
+        Executes sql statement or list of statements.
+        Returns list of numbers of rows affected by each statement.
+        """
+        if isinstance(sql, str):
+            sql = [sql]
+        rowcounts = []
+        with self.connection.cursor() as cursor:
+            for statement in sql:
+                cursor.execute(statement, parameters)
+                rowcounts.append(cursor.rowcount)
+        return rowcounts
+
+    def get_records(self, sql, parameters=None):
+        """
+        Executes sql query and returns all rows.
+        """
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, parameters)
+            return cursor.fetchall()
+
+    def get_first(self, sql, parameters=None):
+        """
+        Executes sql query and returns first row.
+        """
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, parameters)
+            return cursor.fetchone()
+
+    def rollback(self):
+        """
+        Rolls back transaction of session, so session can run next statements after failed statement
+        (e.g. read errors of failed COPY). Statements run before in session are rolled back too.
+        """
+        self.connection.rollback()
+
+    def fetch_batches(self, sql, batch_size, parameters=None):
+        """
+        Executes sql query with server-side cursor and yields lists of at most batch_size rows,
+        so big results are not held in memory at once. Session must not be in autocommit mode.
+        """
+        with self.connection.cursor(name="sparkify_batches_{}".format(id(self))) as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(sql, parameters)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield rows
+
+
+class RedshiftConnectionPool:
+    """
+    Pool of connections to Redshift for one Airflow connection per worker process.
+    - Connections are opened with TCP keepalive
+    - Idle connections are checked with light query before reuse
+    - Broken connections are dropped and replaced
+    - Time spent on opening connections is measured
+
+    conn_id - name of Redshift connection in Airflow
+    max_size - maximum number of connections opened at the same time
+    health_check_after - seconds of idle time after which connection is checked before reuse
+    keepalives_idle - seconds of idle time before TCP keepalive probes are sent
+    """
+
+    connection_extras = ('sslmode', 'sslcert', 'sslkey', 'sslrootcert', 'sslcrl',
+                         'application_name', 'connect_timeout')
+
+    health_check_query = ("SELECT 1")
+
+    def __init__(self, conn_id, max_size=4, health_check_after=60, keepalives_idle=60):
+        self.conn_id = conn_id
+        self.max_size = max_size
+        self.health_check_after = health_check_after
+        self.keepalives_idle = keepalives_idle
+        self.idle = []
+        self.opened = 0
+        self.condition = threading.Condition()
+        self.connect_args = None
+        self.stats = {"connections_opened": 0,
+                      "connect_seconds": 0.0,
+                      "checkouts": 0,
+                      "reused": 0,
+                      "health_checks": 0,
+                      "dropped": 0}
+
+    def get_connect_args(self):
+        """
+        Reads parameters of connection from Airflow once.
+        """
+        if self.connect_args is None:
+            conn = BaseHook.get_connection(self.conn_id)
+            connect_args = dict(host=conn.host,
+                                user=conn.login,
+                                password=conn.password,
+                                dbname=conn.schema,
+                                port=conn.port,
+                                keepalives=1,
+                                keepalives_idle=self.keepalives_idle,
+                                keepalives_interval=10,
+                                keepalives_count=5)
+            for name, value in conn.extra_dejson.items():
+                if name in RedshiftConnectionPool.connection_extras:
+                    connect_args[name] = value
+            self.connect_args = connect_args
+        return self.connect_args
+
+    def connect(self):
+        """
+        Opens new connection and measures time of connecting.
+        """
+        # psycopg2 is imported at run of task, not at parsing of DAG
+        import psycopg2
+        start = time.monotonic()
+        connection = psycopg2.connect(**self.get_connect_args())
+        with self.condition:
+            self.stats["connections_opened"] += 1
+            self.stats["connect_seconds"] += time.monotonic() - start
+        return connection
+
+    def is_healthy(self, connection, idle_since):
+        """
+        Checks connection that has been idle for long time with light query.
+        """
+        import psycopg2
+        if connection.closed:
+            return False
+        if time.monotonic() - idle_since < self.health_check_after:
+            return True
+        with self.condition:
+            self.stats["health_checks"] += 1
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(RedshiftConnectionPool.health_check_query)
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def checkout(self):
+        """
+        Takes idle connection from pool or opens new one.
+        Waits if max_size connections are already in use.
+        """
+        with self.condition:
+            while not self.idle and self.opened >= self.max_size:
+                self.condition.wait()
+            self.stats["checkouts"] += 1
+            if self.idle:
+                connection, idle_since = self.idle.pop()
+            else:
+                connection, idle_since = None, None
+                self.opened += 1
+
+        if connection is not None:
+            if self.is_healthy(connection, idle_since):
+                with self.condition:
+                    self.stats["reused"] += 1
+                return connection
+            # Broken connection is replaced, its place in pool is kept
+            self.discard(connection)
+        try:
+            return self.connect()
+        except Exception:
+            self.release()
+            raise
+
+    def checkin(self, connection):
+        """
+        Returns connection to pool. Connections in broken state are dropped.
+        """
+        from psycopg2 import extensions
+        if connection.closed or \
+           connection.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            self.discard(connection)
+            self.release()
+            return
+        with self.condition:
+            self.idle.append((connection, time.monotonic()))
+            self.condition.notify()
+
+    def discard(self, connection):
+        """
+        Closes connection without releasing its place in pool.
+        """
+        import psycopg2
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+        with self.condition:
+            self.stats["dropped"] += 1
+
+    def release(self):
+        """
+        Releases place of closed connection in pool.
+        """
+        with self.condition:
+            self.opened -= 1
+            self.condition.notify()
+
+    @contextmanager
+    def session(self, autocommit=False):
+        """
+        Opens session on pooled connection.
+        Transaction is committed on exit and rolled back on error.
+        """
+        import psycopg2
+        start = time.monotonic()
+        connection = self.checkout()
+        checkout_seconds = time.monotonic() - start
+        try:
+            connection.autocommit = autocommit
+            yield RedshiftSession(connection, checkout_seconds)
+            if not autocommit:
+                connection.commit()
+        except Exception:
+            if not connection.closed:
+                try:
+                    connection.rollback()
+                except psycopg2.Error:
+                    pass
+            raise
+        finally:
+            if not connection.closed:
+                connection.autocommit = False
+            self.checkin(connection)
+
+    def report(self):
+        """
+        Returns statistics of pool with estimate of time saved by reusing connections.
+        """
+        with self.condition:
+            stats = dict(self.stats)
+        opened = stats["connections_opened"]
+        stats["avg_connect_seconds"] = stats["connect_seconds"] / opened if opened else 0.0
+        stats["saved_seconds_estimate"] = stats["reused"] * stats["avg_connect_seconds"]
+        return stats
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        with self.condition:
+            idle, self.idle = self.idle, []
+        for connection, _ in idle:
+            self.discard(connection)
+            self.release()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(conn_id, max_size=4):
+    """
+    Returns pool of connections for Airflow connection shared in worker process.
+
+    conn_id - name of Redshift connection in Airflow
+    max_size - maximum number of connections, pool is grown if bigger value is requested
+    """
+    with _pools_lock:
+        pool = _pools.get(conn_id)
+        if pool is None:
+            pool = _pools[conn_id] = RedshiftConnectionPool(conn_id, max_size=max_size)
+        elif pool.max_size < max_size:
+            with pool.condition:
+                pool.max_size = max_size
+                pool.condition.notify_all()
+        return pool
+
+
+def log_pool_report(conn_id, log):
+    """
+    Logs statistics of pool of Airflow connection: opened and reused connections, time spent on connecting
+    and estimate of time saved by reuse.
+
+    conn_id - name of Redshift connection in Airflow
+    log - logger of task
+    """
+    log.info("Redshift connection pool: {}".format(get_pool(conn_id).report()))
+
+
+@contextmanager
+def redshift_session(conn_id, autocommit=False, operation=None, priority=0, owner=""):
+    """
+    Opens session on pooled connection of Airflow connection.
+    All statements of session run in one transaction.
+    If operation is set and connection has limit of WLM slots (extra 'wlm_slots'), session waits
+    for lease of slots of slot scheduler first and holds it until session is closed.
+
+    conn_id - name of Redshift connection in Airflow
+    autocommit - True for statements that can not run in transaction block
+    operation - operation type of session for slot scheduler ('copy', 'load', 'maintenance', 'check');
+                None for sessions that are not scheduled (e.g. sessions inside scheduled session of task)
+    priority - priority of session in queue of slot scheduler (e.g. priority_weight of task)
+    owner - description of session in lease table (e.g. task id)
+    """
+    # Imported here: scheduler module imports pool module
+    from helpers.wlm_scheduler import get_scheduler
+    scheduler = get_scheduler(conn_id) if operation is not None else None
+    if scheduler is None:
+        with get_pool(conn_id).session(autocommit=autocommit) as session:
+            yield session
+        return
+    with scheduler.lease(operation, priority, owner) as lease:
+        with get_pool(conn_id).session(autocommit=autocommit) as session:
+            session.queue_seconds = lease.wait_seconds
+            yield session
+
+
+@atexit.register
+def close_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close()
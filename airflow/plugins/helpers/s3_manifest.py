@@ -0,0 +1,109 @@
+import json
+
+
+def list_s3_objects(s3_client, s3_bucket, s3_prefix, start_after=None):
+    """
+    Lists all objects under a prefix in S3 bucket.
+    Returns list of dictionaries with object key, etag, size and last modified time.
+
+    s3_client - boto3 S3 client (or any client with the same paginator interface)
+    s3_bucket - name of bucket
+    s3_prefix - prefix of objects in bucket
+    start_after - key after which objects are listed (in order of keys); None to list all objects
+    """
+    paginator = s3_client.get_paginator('list_objects_v2')
+    pagination = dict(Bucket=s3_bucket, Prefix=s3_prefix)
+    if start_after:
+        pagination["StartAfter"] = start_after
+    objects = []
+    for page in paginator.paginate(**pagination):
+        for item in page.get('Contents', []):
+            if item['Key'].endswith('/'):
+                continue
+            objects.append({
+                "key": item['Key'],
+                "etag": item.get('ETag', '').strip('"'),
+                "size": item.get('Size', 0),
+                "last_modified": item.get('LastModified')
+            })
+    return objects
+
+
+def object_fingerprint(etag, size, last_modified):
+    """
+    Builds fingerprint of S3 object from its ETag, size and last modified time.
+    Last modified time is compared with precision of seconds as it is stored in ledger.
+
+    etag - ETag of object without quotes
+    size - size of object in bytes
+    last_modified - last modified time of object (datetime or None)
+    """
+    if last_modified is not None:
+        last_modified = last_modified.strftime('%Y-%m-%d %H:%M:%S')
+    return (etag, int(size or 0), last_modified)
+
+
+def select_new_objects(objects, loaded_objects):
+    """
+    Selects objects that are not loaded yet or changed since last load.
+
+    objects - list of objects from list_s3_objects
+    loaded_objects - dictionary with pairs of object key and fingerprint of objects that have been already loaded
+    """
+    return [obj for obj in objects
+            if loaded_objects.get(obj["key"]) != object_fingerprint(obj["etag"], obj["size"], obj["last_modified"])]
+
+
+def build_copy_manifest(s3_bucket, objects):
+    """
+    Builds Redshift COPY manifest (JSON) for list of objects.
+
+    s3_bucket - name of bucket with objects
+    objects - list of objects from list_s3_objects
+    """
+    entries = [{"url": "s3://{}/{}".format(s3_bucket, obj["key"]),
+                "mandatory": True,
+                "meta": {"content_length": obj["size"]}}
+               for obj in objects]
+    return json.dumps({"entries": entries})
+
+
+def split_objects_by_size(objects, parts):
+    """
+    Splits objects into groups with balanced total size (the biggest objects are placed first
+    to the group with the smallest total size). Empty groups are not returned.
+
+    objects - list of objects from list_s3_objects
+    parts - number of groups
+    """
+    groups = [[] for _ in range(max(parts, 1))]
+    sizes = [0] * len(groups)
+    for obj in sorted(objects, key=lambda obj: obj["size"], reverse=True):
+        smallest = sizes.index(min(sizes))
+        groups[smallest].append(obj)
+        sizes[smallest] += obj["size"]
+    return [sorted(group, key=lambda obj: obj["key"]) for group in groups if group]
+
+
+def split_objects_into_chunks(objects, max_chunk_bytes, max_chunk_objects):
+    """
+    Splits objects in order of keys into consecutive chunks of limited size and number of objects
+    (chunk has at least one object, so object bigger than max_chunk_bytes is chunk of its own).
+
+    objects - list of objects from list_s3_objects
+    max_chunk_bytes - maximum total size of chunk in bytes
+    max_chunk_objects - maximum number of objects in chunk
+    """
+    chunks = []
+    chunk = []
+    chunk_bytes = 0
+    for obj in sorted(objects, key=lambda obj: obj["key"]):
+        if chunk and (chunk_bytes + obj["size"] > max_chunk_bytes or len(chunk) >= max_chunk_objects):
+            chunks.append(chunk)
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(obj)
+        chunk_bytes += obj["size"]
+    if chunk:
+        chunks.append(chunk)
+    return chunks
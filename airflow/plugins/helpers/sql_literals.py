@@ -0,0 +1,20 @@
+import datetime
+
+
+def sql_literal(value):
+    """
+    Renders python value as sql literal for generated scripts.
+
+    value - None, number, string, date or datetime
+    """
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, datetime.datetime):
+        value = value.strftime('%Y-%m-%d %H:%M:%S')
+    elif isinstance(value, datetime.date):
+        value = value.strftime('%Y-%m-%d')
+    return "'{}'".format(str(value).replace("'", "''"))
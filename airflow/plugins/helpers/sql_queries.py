@@ -2,7 +2,7 @@ class SqlQueries:
     """
     contains SQL Queries for insert operations in datapipeline
     """
-    songplay_table_insert = ("""
+    songplay_table_select = ("""
         SELECT
             md5(events.sessionid || events.start_time) songplay_id,
             events.start_time, 
@@ -13,19 +13,38 @@ class SqlQueries:
             events.sessionid, 
             events.location, 
             events.useragent
-        FROM (SELECT TIMESTAMP 'epoch' + ts/1000 * interval '1 second' AS start_time, staging_events.*
+        FROM (SELECT upper(BTRIM(song)) AS song_key,
+                     trunc(length) AS length_key,
+                     upper(BTRIM(artist)) AS artist_key,
+                     staging_events.*
               FROM staging_events
               WHERE page='NextSong') events
-        LEFT JOIN songs ON upper(BTRIM(songs.title)) = upper(BTRIM(events.song))
-                       AND trunc(songs.duration) = trunc(events.length)
-        LEFT JOIN artists ON upper(BTRIM(artists.name)) = upper(BTRIM(events.artist))
+        LEFT JOIN songs ON songs.title_key = events.song_key
+                       AND songs.duration_key = events.length_key
+        LEFT JOIN artists ON artists.name_key = events.artist_key
+    """)
+
+    songplay_table_insert = songplay_table_select + ("""
         WHERE NOT EXISTS (SELECT songplay_id FROM songplays WHERE songplays.songplay_id =  md5(events.sessionid || events.start_time))
     """)
 
+    # range of start_time of staging batch, it limits dedupe of 'window' mode of fact load to slice of songplays
+    songplay_table_window = ("""
+        SELECT min(start_time), max(start_time)
+        FROM staging_events
+        WHERE page='NextSong'
+    """)
+
     songplay_table_key = ("songplay_id")
 
     songplay_table_fields = ("songplay_id, start_time, user_id, level, song_id, artist_id, session_id, location, user_agent")
 
+    songplay_table_scope = ("""
+        SELECT md5(sessionid || start_time)
+        FROM staging_events
+        WHERE page='NextSong'
+    """)
+
 
     user_table_insert = ("""
         SELECT 
@@ -52,13 +71,21 @@ class SqlQueries:
 
     user_table_fields = ("user_id, first_name, last_name, gender, level")
 
+    user_table_scope = ("""
+        SELECT userid
+        FROM staging_events
+        WHERE page='NextSong' AND userid is not null
+    """)
+
     song_table_insert = ("""
             SELECT
                 dedubl.song_id,
                 dedubl.title,
                 dedubl.artist_id,
                 dedubl.year,
-                dedubl.duration
+                dedubl.duration,
+                upper(BTRIM(dedubl.title)) AS title_key,
+                trunc(dedubl.duration) AS duration_key
             FROM (
                 SELECT 
                     stage.song_id,
@@ -75,7 +102,12 @@ class SqlQueries:
 
     song_table_key = ("song_id")
 
-    song_table_fields = ("song_id, title, artist_id, year, duration")
+    song_table_fields = ("song_id, title, artist_id, year, duration, title_key, duration_key")
+
+    song_table_scope = ("""
+        SELECT song_id
+        FROM staging_songs
+    """)
 
     artist_table_insert = ("""
         SELECT 
@@ -83,7 +115,8 @@ class SqlQueries:
         dedubl.artist_name,
         dedubl.artist_location,
         dedubl.artist_latitude,
-        dedubl.artist_longitude
+        dedubl.artist_longitude,
+        upper(BTRIM(dedubl.artist_name)) AS name_key
         FROM (
             SELECT 
                 stage.artist_id,
@@ -100,7 +133,68 @@ class SqlQueries:
 
     artist_table_key = ("artist_id")
 
-    artist_table_fields = ("artist_id, name, location, latitude, longitude")
+    artist_table_fields = ("artist_id, name, location, latitude, longitude, name_key")
+
+    artist_table_scope = ("""
+        SELECT artist_id
+        FROM staging_songs
+    """)
+
+    # songs and artists are derived from one scan of staging_songs saved to temp table song_catalog_stage
+    song_catalog_stage_create = ("""
+        CREATE TEMP TABLE song_catalog_stage AS
+        SELECT *
+        FROM (
+            SELECT
+                stage.song_id,
+                stage.title,
+                stage.artist_id,
+                stage.year,
+                stage.duration,
+                stage.artist_name,
+                stage.artist_location,
+                stage.artist_latitude,
+                stage.artist_longitude,
+                row_number() over (partition by stage.song_id order by LEN(stage.title) asc, stage.title asc) as song_rn,
+                row_number() over (partition by stage.artist_id order by LEN(stage.artist_name) asc, stage.artist_name asc) as artist_rn
+            FROM staging_songs stage
+            WHERE {INSERT_MODE_QUERY}
+            ) catalog
+        WHERE song_rn = 1 OR artist_rn = 1
+    """)
+
+    # in append mode only rows of new songs or new artists are saved; filter keeps whole partitions of both windows
+    song_catalog_append_filter = ("""
+        (NOT EXISTS (SELECT song_id FROM {song_table_name} WHERE {song_table_name}.song_id = stage.song_id)
+         OR NOT EXISTS (SELECT artist_id FROM {artist_table_name} WHERE {artist_table_name}.artist_id = stage.artist_id))
+    """)
+
+    song_catalog_stage_drop = ("DROP TABLE song_catalog_stage;")
+
+    song_catalog_song_insert = ("""
+        SELECT
+            stage.song_id,
+            stage.title,
+            stage.artist_id,
+            stage.year,
+            stage.duration,
+            upper(BTRIM(stage.title)) AS title_key,
+            trunc(stage.duration) AS duration_key
+        FROM song_catalog_stage stage
+        WHERE stage.song_rn = 1 AND {INSERT_MODE_QUERY}
+    """)
+
+    song_catalog_artist_insert = ("""
+        SELECT
+            stage.artist_id,
+            stage.artist_name,
+            stage.artist_location,
+            stage.artist_latitude,
+            stage.artist_longitude,
+            upper(BTRIM(stage.artist_name)) AS name_key
+        FROM song_catalog_stage stage
+        WHERE stage.artist_rn = 1 AND {INSERT_MODE_QUERY}
+    """)
 
     time_table_insert = ("""
         SELECT 
@@ -113,7 +207,7 @@ class SqlQueries:
             cast(to_char(stage.start_time, 'D') AS int4)
         FROM (
             SELECT
-                distinct TIMESTAMP 'epoch' + staging_events.ts/1000 *INTERVAL '1 second' as start_time 
+                distinct staging_events.start_time
             FROM staging_events
             WHERE page='NextSong') stage
         WHERE {INSERT_MODE_QUERY}
@@ -123,8 +217,136 @@ class SqlQueries:
 
     time_table_fields = ("start_time, hour, day, week, month, year, weekday")
 
+    time_table_scope = ("""
+        SELECT start_time
+        FROM staging_events
+        WHERE page='NextSong'
+    """)
+
+    time_table_new_seconds = ("""
+        SELECT DISTINCT stage.ts / 1000
+        FROM {staging_table} stage
+        WHERE stage.page='NextSong' AND stage.start_time IS NOT NULL
+          AND NOT EXISTS (SELECT start_time
+                          FROM {target_table_name}
+                          WHERE {target_table_name}.start_time = stage.start_time)
+    """)
+
+    # start_time of event is computed once after COPY to staging table, loads of fact and time tables read it
+    staging_events_start_time_update = ("""
+        UPDATE staging_events
+        SET start_time = TIMESTAMP 'epoch' + ts/1000 * interval '1 second'
+        WHERE start_time IS NULL AND ts IS NOT NULL
+    """)
+
+    staging_events_columns = ["artist", "auth", "firstname", "gender", "iteminsession", "lastname", "length", "level",
+                              "location", "method", "page", "registration", "sessionid", "song", "status", "ts",
+                              "useragent", "userid"]
+
+    staging_songs_columns = ["num_songs", "artist_id", "artist_name", "artist_latitude", "artist_longitude",
+                             "artist_location", "song_id", "title", "duration", "year"]
+
+    # aggregate tables of song play analysis maintained from new rows of songplays (songplays_delta);
+    # {source_table} is temp table with new rows or songplays for full recompute, measure column is plays;
+    # keys are not null (missing level or artist is 'unknown'), so folds join rollups on plain equality
+    songplay_rollups = [
+        {"table_name": "songplays_daily_user",
+         "key_fields": ["play_date", "user_id", "level"],
+         "select": """
+            SELECT cast(start_time AS date) AS play_date, user_id, coalesce(level, 'unknown') AS level,
+                   count(1) AS plays
+            FROM {source_table}
+            GROUP BY cast(start_time AS date), user_id, coalesce(level, 'unknown')
+         """},
+        {"table_name": "songplays_daily_song",
+         "key_fields": ["play_date", "song_id", "artist_id"],
+         "select": """
+            SELECT cast(start_time AS date) AS play_date, song_id, coalesce(artist_id, 'unknown') AS artist_id,
+                   count(1) AS plays
+            FROM {source_table}
+            WHERE song_id IS NOT NULL
+            GROUP BY cast(start_time AS date), song_id, coalesce(artist_id, 'unknown')
+         """},
+        {"table_name": "songplays_hourly",
+         "key_fields": ["play_hour", "level"],
+         "select": """
+            SELECT date_trunc('hour', start_time) AS play_hour, coalesce(level, 'unknown') AS level,
+                   count(1) AS plays
+            FROM {source_table}
+            GROUP BY date_trunc('hour', start_time), coalesce(level, 'unknown')
+         """}
+    ]
+
+    aggregate_table_list = ["public.songplays_delta", "public.songplays_daily_user", "public.songplays_daily_song",
+                            "public.songplays_hourly"]
+
+    # events of staging batch without song or artist in catalog, fact load of the same run inserted them with NULL
+    # song_id or artist_id; keys are join keys of songplay_table_select, so late songs and artists are matched
+    # the same way (catalog is probed before songplay_id is hashed, so only unresolved events are hashed)
+    songplay_unresolved_select = ("""
+        SELECT events.songplay_id, events.start_time, events.song_key, events.length_key, events.artist_key
+        FROM (SELECT md5(sessionid || start_time) AS songplay_id,
+                     start_time,
+                     upper(BTRIM(song)) AS song_key,
+                     trunc(length) AS length_key,
+                     upper(BTRIM(artist)) AS artist_key
+              FROM staging_events
+              WHERE page='NextSong') events
+        WHERE NOT EXISTS (SELECT 1
+                          FROM {song_table_name}
+                          WHERE {song_table_name}.title_key = events.song_key
+                            AND {song_table_name}.duration_key = events.length_key)
+           OR NOT EXISTS (SELECT 1
+                          FROM {artist_table_name}
+                          WHERE {artist_table_name}.name_key = events.artist_key)
+    """)
+
     table_list =  ["public.songplays","public.users","public.songs","public.artists","public.time"]
 
+    # columns of tables of star schema, they are analysed by advisor of distribution and sort keys
+    table_fields = {
+        "public.songplays": songplay_table_fields.split(", "),
+        "public.users":     user_table_fields.split(", "),
+        "public.songs":     song_table_fields.split(", "),
+        "public.artists":   artist_table_fields.split(", "),
+        "public.time":      time_table_fields.split(", ")
+    }
+
+    # queries of song play analysis (see README), advisor of keys counts their joins and filters with load queries
+    analysis_queries = [
+        """
+        SELECT users.first_name, users.last_name
+        FROM songplays
+        JOIN users ON users.user_id = songplays.user_id
+        WHERE songplays.level = 'paid'
+        GROUP BY users.first_name, users.last_name
+        HAVING count(1)>10
+        ORDER BY count(1) desc
+        """,
+        """
+        SELECT artists.name as artist_name
+        FROM songplays
+        JOIN artists ON artists.artist_id = songplays.artist_id
+        WHERE songplays.level = 'paid'
+        GROUP BY artists.name
+        ORDER BY count(1) desc
+        LIMIT 1
+        """,
+        """
+        SELECT songplays.user_id, count(1) as count_listening
+        FROM songplays
+        WHERE songplays.user_id = 2
+        GROUP BY songplays.user_id
+        """,
+        """
+        SELECT time.weekday, time.hour, count(1) as count_listening
+        FROM songplays
+        JOIN time ON time.start_time = songplays.start_time
+        WHERE songplays.start_time BETWEEN '2018-11-01' AND '2018-11-30'
+        GROUP BY time.weekday, time.hour
+        """
+    ]
+
     table_key_list = [
         {"table_name": "public.songplays", "table_key": "songplay_id"},
         {"table_name": "public.users",     "table_key": "user_id"},
@@ -133,16 +355,37 @@ class SqlQueries:
         {"table_name": "public.time",      "table_key": "start_time"}
     ]
 
+    # value checks of data quality: values without row in reference table and share of nulls in columns
+    dq_value_checks = [
+        {"type": "orphan", "table_name": "public.songplays", "column": "user_id",
+         "ref_table": "public.users", "ref_column": "user_id"},
+        {"type": "orphan", "table_name": "public.songplays", "column": "song_id",
+         "ref_table": "public.songs", "ref_column": "song_id"},
+        {"type": "orphan", "table_name": "public.songplays", "column": "artist_id",
+         "ref_table": "public.artists", "ref_column": "artist_id"},
+        {"type": "orphan", "table_name": "public.songplays", "column": "start_time",
+         "ref_table": "public.time", "ref_column": "start_time"},
+        {"type": "orphan", "table_name": "public.songs", "column": "artist_id",
+         "ref_table": "public.artists", "ref_column": "artist_id"},
+        {"type": "null_rate", "table_name": "public.songplays", "column": "level", "max_rate": 0.0},
+        {"type": "null_rate", "table_name": "public.songplays", "column": "session_id", "max_rate": 0.0},
+        {"type": "null_rate", "table_name": "public.users", "column": "level", "max_rate": 0.0},
+        {"type": "null_rate", "table_name": "public.songs", "column": "title", "max_rate": 0.0},
+        {"type": "null_rate", "table_name": "public.artists", "column": "name", "max_rate": 0.0}
+    ]
+
     dq_checks=[
         {'check_sql': """
                         SELECT count(1) as count_f
                         FROM {table_name}
+                        WHERE {scope_filter}
                       """, 
          'type':      "fill"},
         {'check_sql': """
                         SELECT count(1) FROM (
                         SELECT {table_key}
                         FROM {table_name}
+                        WHERE {scope_filter}
                         GROUP BY {table_key}
                         HAVING count(1)>1) a
                       """, 
@@ -0,0 +1,200 @@
+import datetime
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from airflow.stats import Stats
+
+TELEMETRY_KEY = "telemetry"
+
+# Target table of statement recorded in telemetry: rows of INSERT, MERGE and COPY are written, rows of DELETE are deleted,
+# rows of UPDATE are both (Redshift writes new versions of updated rows and marks old ones deleted)
+STATEMENT_TABLE = re.compile(r'^\s*(INSERT\s+INTO|MERGE\s+INTO|COPY|DELETE\s+FROM|UPDATE)\s+([\w."]+)', re.IGNORECASE)
+
+STATS_PREFIX = "sparkify"
+
+
+class OperatorTelemetry:
+    """
+    Structured telemetry of one run of operator.
+    - Timings of phases (render, connect, delete, copy, insert, checks, ...)
+    - Timing and number of affected rows of every statement
+    - Number of rows and bytes loaded by COPY (Redshift pg_last_copy_count() and stl_s3client)
+    - Optional EXPLAIN plans of INSERT statements
+    Report is pushed to XCom (key 'telemetry'), sent to StatsD by Airflow Stats
+    and appended as one JSON line to file, if path of file is set; statistics of pool of Redshift connection
+    (RedshiftConnectionPool.report) are logged with report.
+
+    Operators of plugin take parameter telemetry_path - path of JSON-lines file for telemetry of task;
+    "" to publish telemetry only to XCom and Stats. It is passed as sink_path, redshift_conn_id of operator as conn_id.
+
+    task_id - id of task
+    table - target table of operator
+    sink_path - path of JSON-lines file; "" to skip file sink
+    explain - True to capture EXPLAIN plans of INSERT statements
+    conn_id - name of Redshift connection whose pool statistics are logged; "" to skip them
+    """
+
+    copy_count_query = ("SELECT pg_last_copy_count()")
+
+    copy_bytes_query = ("""
+        SELECT COALESCE(SUM(transfer_size), 0)
+        FROM stl_s3client
+        WHERE query = pg_last_copy_id()
+    """)
+
+    statement_text_length = 200
+
+    def __init__(self, task_id, table="", sink_path="", explain=False, conn_id=""):
+        self.task_id = task_id
+        self.table = table
+        self.sink_path = sink_path
+        self.explain = explain
+        self.conn_id = conn_id
+        self.started_at = datetime.datetime.utcnow()
+        self.start = time.monotonic()
+        self.phases = {}
+        self.statements = []
+        self.lock = threading.Lock()
+
+    def add_phase(self, name, seconds):
+        """
+        Adds time to phase, phases with the same name are summed.
+        """
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Measures time of block as phase.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.monotonic() - start)
+
+    def run(self, redshift, sql, phase=None, runner=None):
+        """
+        Executes sql statement or list of statements in session one by one and records each of them.
+        Phase of statement is its first keyword (delete, copy, insert, ...) if phase is not set.
+        Returns list of numbers of rows affected by each statement.
+
+        runner - function executing statement in session (e.g. as prepared statement); session.run if not set
+        """
+        if isinstance(sql, str):
+            sql = [sql]
+        rowcounts = []
+        for statement in sql:
+            keyword = statement.split(None, 1)[0].lower() if statement.strip() else ""
+            record = {"phase": phase or keyword,
+                      "statement": " ".join(statement.split())[:OperatorTelemetry.statement_text_length]}
+            if self.explain and keyword == "insert":
+                record["plan"] = [row[0] for row in redshift.get_records("EXPLAIN " + statement)]
+            start = time.monotonic()
+            if runner is None:
+                rowcount = redshift.run(statement)[0]
+            else:
+                rowcount = runner(redshift, statement)[0]
+            record["seconds"] = time.monotonic() - start
+            record["rows"] = rowcount
+            if keyword == "copy":
+                # COPY does not report rows by cursor, they are read from system functions of session
+                record["rows"] = redshift.get_first(OperatorTelemetry.copy_count_query)[0]
+                record["bytes"] = int(redshift.get_first(OperatorTelemetry.copy_bytes_query)[0])
+            with self.lock:
+                self.statements.append(record)
+            self.add_phase(record["phase"], record["seconds"])
+            rowcounts.append(record["rows"])
+        return rowcounts
+
+    def record_statement(self, phase, statement, seconds, rows=None):
+        """
+        Records statement executed outside of run (e.g. query of data quality check);
+        seconds and rows are None if they are not known for statement (e.g. statement of script run at once).
+        """
+        with self.lock:
+            self.statements.append({"phase": phase,
+                                    "statement": " ".join(statement.split())[:OperatorTelemetry.statement_text_length],
+                                    "seconds": seconds,
+                                    "rows": rows})
+
+    def report(self):
+        """
+        Returns report of telemetry as dictionary.
+        """
+        with self.lock:
+            statements = [dict(record) for record in self.statements]
+            phases = dict(self.phases)
+        return {"task_id": self.task_id,
+                "table": self.table,
+                "started_at": self.started_at.isoformat(),
+                "total_seconds": time.monotonic() - self.start,
+                "phases": phases,
+                "rows": sum(record["rows"] for record in statements
+                            if record["rows"] is not None and record["rows"] > 0 and record["phase"] != "copy"),
+                "copy_rows": sum(record["rows"] or 0 for record in statements if record["phase"] == "copy"),
+                "copy_bytes": sum(record.get("bytes", 0) for record in statements),
+                "statements": statements}
+
+    def publish(self, context, log=None):
+        """
+        Pushes report to XCom, sends timings and counters to Stats and appends report to JSON-lines file.
+        Statistics of pool of connection are logged, if conn_id is set.
+        """
+        report = self.report()
+        context["ti"].xcom_push(key=TELEMETRY_KEY, value=report)
+
+        stat_name = "{}.{}".format(STATS_PREFIX, self.task_id)
+        Stats.timing("{}.total".format(stat_name), report["total_seconds"] * 1000)
+        for phase, seconds in report["phases"].items():
+            Stats.timing("{}.{}".format(stat_name, phase), seconds * 1000)
+        Stats.gauge("{}.rows".format(stat_name), report["rows"])
+        Stats.gauge("{}.copy_rows".format(stat_name), report["copy_rows"])
+        Stats.gauge("{}.copy_bytes".format(stat_name), report["copy_bytes"])
+
+        if self.sink_path:
+            report_line = dict(report, dag_id=context["dag"].dag_id if context.get("dag") else None,
+                               execution_date=str(context.get("execution_date")))
+            with open(self.sink_path, "a") as sink:
+                sink.write(json.dumps(report_line, default=str) + "\n")
+
+        if log is not None:
+            if self.conn_id:
+                # Imported here: telemetry is also used without pool (e.g. by benchmark on its own connection)
+                from helpers.redshift_pool import log_pool_report
+                log_pool_report(self.conn_id, log)
+            log.info("Telemetry: total {:.3f} s, phases {}, rows {}, copy rows {}, copy bytes {}".format(
+                        report["total_seconds"],
+                        ", ".join("{} {:.3f} s".format(phase, seconds) for phase, seconds in report["phases"].items()),
+                        report["rows"], report["copy_rows"], report["copy_bytes"]))
+        return report
+
+
+def pull_table_rows(context, task_ids):
+    """
+    Reads telemetry of tasks from XCom and sums rows written and deleted in every table by their statements.
+    Returns dictionary {table name without schema: {"written": rows, "deleted": rows}}.
+    Skipped tasks do not publish telemetry, their tables are not in result.
+
+    context - context of task instance
+    task_ids - list of task ids (e.g. load tasks of DAG)
+    """
+    table_rows = {}
+    if not task_ids:
+        return table_rows
+    for report in context["ti"].xcom_pull(task_ids=list(task_ids), key=TELEMETRY_KEY):
+        for record in (report or {}).get("statements", []):
+            match = STATEMENT_TABLE.match(record["statement"])
+            if match is None:
+                continue
+            table_name = match.group(2).split(".")[-1].strip('"').lower()
+            counts = table_rows.setdefault(table_name, {"written": 0, "deleted": 0})
+            keyword = match.group(1).upper()
+            for key in ("written", "deleted"):
+                if keyword == "UPDATE" or keyword.startswith("DELETE") == (key == "deleted"):
+                    counts[key] += max(record["rows"] or 0, 0)
+    return table_rows
@@ -0,0 +1,301 @@
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from airflow.hooks.base_hook import BaseHook
+
+from helpers.redshift_pool import get_pool
+from helpers.sql_literals import sql_literal
+
+# Slots of WLM queue taken by one statement of operation type: COPY is heavy (spills and fills memory of slices),
+# loads and table maintenance scan and write big tables, data quality checks are short aggregate queries
+OPERATION_WEIGHTS = {"copy": 4,
+                     "load": 2,
+                     "maintenance": 2,
+                     "check": 1}
+
+
+class SlotLease:
+    """
+    Lease of slots of WLM queue held by one session.
+
+    lease_id - id of row of lease table
+    operation - operation type of session
+    weight - number of slots taken by lease
+    priority - priority of lease, higher priority is granted first
+    wait_seconds - time spent in queue before lease was granted
+    """
+
+    def __init__(self, lease_id, operation, weight, priority, wait_seconds=0.0):
+        self.lease_id = lease_id
+        self.operation = operation
+        self.weight = weight
+        self.priority = priority
+        self.wait_seconds = wait_seconds
+
+
+class SlotScheduler:
+    """
+    Limits weight of statements running on one Redshift connection at the same time, so concurrent DAG runs
+    and pipelines of many sources do not queue in WLM or spill to disk.
+    - Leases are rows of lease table in Redshift, so the limit holds for all workers and DAG runs
+    - Session asks for lease with weight of its operation type (OPERATION_WEIGHTS) and priority;
+      lease waits in queue until running leases leave room for its weight
+    - Queue is ordered by priority (higher first) and time of request; waiting lease is granted only
+      if all leases before it are granted, so light leases do not starve heavy ones
+    - Queue is dispatched in short transactions holding exclusive lock of lease table: by new lease,
+      by finished sessions, which delete their leases and grant waiting ones, and by waiting session
+      only if it finds expired leases
+    - Waiting session polls state of its lease with one SELECT in autocommit mode (no lock, no commit),
+      first after min_poll_seconds, then with doubled interval up to poll_seconds; expiry of waiting lease
+      is extended only when a third of it has passed
+    - Leases of crashed workers expire: granted leases after lease_seconds, waiting leases when
+      their session stops polling
+    - Time spent in queue is measured
+
+    pool - pool of connections of Redshift connection (RedshiftConnectionPool)
+    slots - maximum total weight of granted leases
+    lease_table - table of leases (see create_tables.sql)
+    lease_seconds - seconds after which granted lease expires
+    poll_seconds - maximum seconds between polls of waiting lease
+    min_poll_seconds - seconds before first poll of waiting lease
+    """
+
+    lease_insert = ("""
+        INSERT INTO {lease_table} (conn_id, lease_id, "owner", operation, weight, priority, state,
+                                   requested_at, expires_at)
+        VALUES ({conn_id}, {lease_id}, {owner}, {operation}, {weight}, {priority}, 'waiting',
+                GETDATE(), GETDATE() + INTERVAL '{wait_expiry_seconds} seconds')
+    """)
+
+    lease_lock = ("LOCK {lease_table}")
+
+    lease_expire = ("""
+        DELETE FROM {lease_table}
+        WHERE conn_id = {conn_id}
+          AND expires_at < GETDATE()
+    """)
+
+    lease_queue_select = ("""
+        SELECT lease_id, weight, state
+        FROM {lease_table}
+        WHERE conn_id = {conn_id}
+        ORDER BY state, priority DESC, requested_at, lease_id
+    """)
+
+    lease_grant = ("""
+        UPDATE {lease_table}
+        SET state = 'running',
+            granted_at = GETDATE(),
+            expires_at = GETDATE() + INTERVAL '{lease_seconds} seconds'
+        WHERE conn_id = {conn_id}
+          AND lease_id IN ({lease_ids})
+    """)
+
+    lease_state_select = ("""
+        SELECT MAX(CASE WHEN lease_id = {lease_id} THEN state END),
+               SUM(CASE WHEN expires_at < GETDATE() THEN 1 ELSE 0 END)
+        FROM {lease_table}
+        WHERE conn_id = {conn_id}
+    """)
+
+    lease_refresh = ("""
+        UPDATE {lease_table}
+        SET expires_at = GETDATE() + INTERVAL '{wait_expiry_seconds} seconds'
+        WHERE conn_id = {conn_id}
+          AND lease_id = {lease_id}
+          AND state = 'waiting'
+    """)
+
+    lease_delete = ("""
+        DELETE FROM {lease_table}
+        WHERE conn_id = {conn_id}
+          AND lease_id = {lease_id}
+    """)
+
+    def __init__(self, pool, slots, lease_table="public.wlm_slot_lease", lease_seconds=10800, poll_seconds=2.0,
+                 min_poll_seconds=0.25):
+        self.pool = pool
+        self.slots = slots
+        self.lease_table = lease_table
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.min_poll_seconds = min(min_poll_seconds, poll_seconds)
+        self.lock = threading.Lock()
+        self.stats = {"leases": 0,
+                      "queued": 0,
+                      "polls": 0,
+                      "dispatches": 0,
+                      "wait_seconds": 0.0,
+                      "max_wait_seconds": 0.0,
+                      "expired": 0}
+
+    def weight(self, operation):
+        """
+        Returns weight of operation type, capped by slots (heavy operation runs alone instead of waiting forever).
+        """
+        if operation not in OPERATION_WEIGHTS:
+            raise ValueError("Invalid value in operation = {}".format(operation))
+        return min(OPERATION_WEIGHTS[operation], self.slots)
+
+    def params(self, **params):
+        """
+        Returns parameters of sql templates of lease table.
+        """
+        return dict(lease_table = self.lease_table,
+                    conn_id = sql_literal(self.pool.conn_id),
+                    lease_seconds = int(self.lease_seconds),
+                    wait_expiry_seconds = int(max(self.poll_seconds * 10, 60)),
+                    **params)
+
+    def dispatch(self, session, released=None, requested=None):
+        """
+        Grants waiting leases that fit into free slots, in order of queue; released lease and expired leases
+        are deleted and requested lease is inserted first. Runs in transaction of session holding exclusive lock
+        of lease table (lock is taken before any change of table, so concurrent dispatches do not deadlock).
+        Returns set of ids of granted leases.
+
+        released - SlotLease to delete
+        requested - INSERT statement of new lease (lease_insert)
+        """
+        with self.lock:
+            self.stats["dispatches"] += 1
+        session.run(SlotScheduler.lease_lock.format(**self.params()))
+        if released is not None:
+            session.run(SlotScheduler.lease_delete.format(**self.params(lease_id = sql_literal(released.lease_id))))
+        if requested is not None:
+            session.run(requested)
+        expired = session.run(SlotScheduler.lease_expire.format(**self.params()))[0]
+        if expired > 0:
+            with self.lock:
+                self.stats["expired"] += expired
+        queue = session.get_records(SlotScheduler.lease_queue_select.format(**self.params()))
+        free = self.slots - sum(weight for _, weight, state in queue if state == "running")
+        running = {lease_id for lease_id, _, state in queue if state == "running"}
+        granted = []
+        for lease_id, weight, state in queue:
+            if state == "running":
+                continue
+            if weight > free:
+                break
+            free -= weight
+            granted.append(lease_id)
+        if granted:
+            session.run(SlotScheduler.lease_grant.format(**self.params(
+                            lease_ids = ", ".join(sql_literal(lease_id) for lease_id in granted))))
+        return running | set(granted)
+
+    def acquire(self, operation, priority=0, owner=""):
+        """
+        Puts lease into queue and waits until it is granted.
+        Returns SlotLease with time spent in queue.
+
+        operation - operation type of session (key of OPERATION_WEIGHTS)
+        priority - priority of lease (e.g. priority_weight of task), higher priority is granted first
+        owner - description of session in lease table (e.g. task id)
+        """
+        lease = SlotLease(uuid.uuid4().hex, operation, self.weight(operation), priority)
+        params = self.params(lease_id = sql_literal(lease.lease_id))
+        insert = SlotScheduler.lease_insert.format(owner = sql_literal(owner[:256]),
+                                                   operation = sql_literal(operation),
+                                                   weight = lease.weight,
+                                                   priority = int(priority),
+                                                   **params)
+        start = time.monotonic()
+        with self.pool.session() as session:
+            granted = lease.lease_id in self.dispatch(session, requested=insert)
+        refreshed = time.monotonic()
+        polls = 0
+        try:
+            while not granted:
+                time.sleep(min(self.min_poll_seconds * 2 ** polls, self.poll_seconds))
+                polls += 1
+                with self.pool.session(autocommit=True) as session:
+                    state, expired = session.get_first(SlotScheduler.lease_state_select.format(**params))
+                    refresh_due = time.monotonic() - refreshed > params["wait_expiry_seconds"] / 3
+                    if state == "waiting" and not expired and refresh_due:
+                        session.run(SlotScheduler.lease_refresh.format(**params))
+                        refreshed = time.monotonic()
+                granted = state == "running"
+                if state is None or (state == "waiting" and expired):
+                    # Expired leases hold queue until they are deleted; own lease expired while session
+                    # was not polling (e.g. worker was suspended) is requested again
+                    with self.pool.session() as session:
+                        granted = lease.lease_id in self.dispatch(session, requested=None if state else insert)
+                        if not granted:
+                            session.run(SlotScheduler.lease_refresh.format(**params))
+                    refreshed = time.monotonic()
+        except BaseException:
+            self.delete(lease)
+            raise
+        lease.wait_seconds = time.monotonic() - start
+        with self.lock:
+            self.stats["leases"] += 1
+            self.stats["wait_seconds"] += lease.wait_seconds
+            self.stats["polls"] += polls
+            if polls:
+                self.stats["queued"] += 1
+            self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], lease.wait_seconds)
+        return lease
+
+    def delete(self, lease):
+        """
+        Deletes lease from lease table.
+        """
+        with self.pool.session() as session:
+            session.run(SlotScheduler.lease_delete.format(**self.params(lease_id = sql_literal(lease.lease_id))))
+
+    def release(self, lease):
+        """
+        Releases slots of lease and grants waiting leases that fit into them.
+        """
+        with self.pool.session() as session:
+            self.dispatch(session, released=lease)
+
+    @contextmanager
+    def lease(self, operation, priority=0, owner=""):
+        """
+        Holds lease of slots for block of statements.
+        """
+        lease = self.acquire(operation, priority, owner)
+        try:
+            yield lease
+        finally:
+            self.release(lease)
+
+    def report(self):
+        """
+        Returns statistics of leases with average time spent in queue.
+        """
+        with self.lock:
+            stats = dict(self.stats)
+        stats["slots"] = self.slots
+        stats["avg_wait_seconds"] = stats["wait_seconds"] / stats["leases"] if stats["leases"] else 0.0
+        return stats
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(conn_id):
+    """
+    Returns scheduler of slots of Airflow connection shared in worker process,
+    None if the connection has no limit of slots.
+    Limit is read once from extra 'wlm_slots' of connection (e.g. {"wlm_slots": 8}); 0 or no extra - no limit.
+    Optional extras 'wlm_lease_table' and 'wlm_poll_seconds' override defaults of SlotScheduler.
+
+    conn_id - name of Redshift connection in Airflow
+    """
+    with _schedulers_lock:
+        if conn_id not in _schedulers:
+            extra = BaseHook.get_connection(conn_id).extra_dejson
+            slots = int(extra.get("wlm_slots", 0) or 0)
+            scheduler = None
+            if slots > 0:
+                scheduler = SlotScheduler(get_pool(conn_id), slots,
+                                          lease_table=extra.get("wlm_lease_table", "public.wlm_slot_lease"),
+                                          poll_seconds=float(extra.get("wlm_poll_seconds", 2.0)))
+            _schedulers[conn_id] = scheduler
+        return _schedulers[conn_id]
@@ -1,11 +1,45 @@
-from operators.stage_redshift import StageToRedshiftOperator
-from operators.load_fact import LoadFactOperator
-from operators.load_dimension import LoadDimensionOperator
-from operators.data_quality import DataQualityOperator
+import importlib
+
+# Operator modules are imported on first use of operator, so parsing of DAG imports only operators of DAG
+# (and their dependencies, e.g. boto3 and NumPy are imported at run of task only)
+_operator_modules = {
+    'StageToRedshiftOperator': 'operators.stage_redshift',
+    'LoadFactOperator': 'operators.load_fact',
+    'LoadDimensionOperator': 'operators.load_dimension',
+    'DataQualityOperator': 'operators.data_quality',
+    'PreprocessJsonOperator': 'operators.preprocess_json',
+    'FusedLoadOperator': 'operators.fused_load',
+    'LoadTimeDimensionOperator': 'operators.load_time_dimension',
+    'LoadSongCatalogOperator': 'operators.load_song_catalog',
+    'MicroBatchIngestOperator': 'operators.micro_batch_ingest',
+    'TableMaintenanceOperator': 'operators.table_maintenance',
+    'AggregateMaintenanceOperator': 'operators.aggregate_maintenance',
+    'ResolveLateSongsOperator': 'operators.resolve_late_songs'
+}
 
 __all__ = [
     'StageToRedshiftOperator',
     'LoadFactOperator',
     'LoadDimensionOperator',
-    'DataQualityOperator'
+    'DataQualityOperator',
+    'PreprocessJsonOperator',
+    'FusedLoadOperator',
+    'LoadTimeDimensionOperator',
+    'LoadSongCatalogOperator',
+    'MicroBatchIngestOperator',
+    'TableMaintenanceOperator',
+    'AggregateMaintenanceOperator',
+    'ResolveLateSongsOperator'
 ]
+
+
+def __getattr__(name):
+    if name not in _operator_modules:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module(_operator_modules[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
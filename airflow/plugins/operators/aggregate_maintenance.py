@@ -0,0 +1,254 @@
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
+from airflow.exceptions import AirflowSkipException
+from helpers.redshift_pool import redshift_session
+from helpers.telemetry import OperatorTelemetry
+
+class AggregateMaintenanceOperator(BaseOperator):
+    """
+    Keeps aggregate tables (rollups) of fact table up to date by folding in only new rows of fact table.
+    Fact load copies rows inserted into fact table to delta table in the same transaction (delta_table of
+    LoadFactOperator), so rows of failed or skipped runs stay in delta table until they are folded.
+    Rows of delta table have sign: 1 adds row to rollups, -1 removes it (ResolveLateSongsOperator writes patched
+    songplays with old keys and sign -1 and with new keys and sign 1).
+    In one transaction:
+    - Lock delta table, so writers of other DAGs (micro-batches of stream_dag) wait until fold is committed
+      instead of failing with serializable isolation violation, and fold waits for batch in progress
+    - Refresh statistics of delta table (it is emptied by every fold, so automatic statistics lag behind
+      and planner may join it as table of one row)
+    - Snapshot rows of delta table into temp table
+    - For every rollup: aggregate added and removed rows of snapshot by keys of rollup, add net counts
+      to existing groups (UPDATE), delete groups left without plays and insert new groups (INSERT)
+    - Delete folded rows from delta table by delta_key, so rows written after snapshot (e.g. later -1/+1 pairs
+      of the same songplay) stay for next fold
+    - For DAG runs with execution hour in check_hours: compare every rollup with full recompute
+      from fact table (EXCEPT in both directions); mismatched rollup is rebuilt (on_mismatch='repair')
+      or task fails after commit of fold (on_mismatch='fail'). First check also builds rollups
+      of history loaded before delta table existed.
+
+    redshift_conn_id - name of Rendsift connection in Airflow
+    fact_table - fact table, source of full recompute
+    delta_table - table with new rows of fact table and column sign, written by fact load and late binding
+    delta_key - IDENTITY column of delta table, folded rows are deleted from delta table by it
+    rollups - list of rollups: table_name, key_fields and select (sql query aggregating {source_table}
+              by key fields into column plays); key fields are not null, groups are matched by equality
+    check_hours - hours of execution date when rollups are compared with full recompute
+    on_mismatch - action on mismatch of rollup and full recompute - 'repair' or 'fail'
+    """
+
+    ui_color = '#F4C430'
+
+    delta_lock_query = ("LOCK {delta_table}")
+
+    delta_analyze_query = ("ANALYZE {delta_table}")
+
+    fold_create_query = ("CREATE TEMP TABLE {fold_table_name} AS SELECT * FROM {delta_table}")
+
+    fold_count_query = ("SELECT count(1) FROM {fold_table_name}")
+
+    fold_delete_query = ("""
+        DELETE FROM {delta_table}
+        WHERE {delta_key} IN (SELECT {delta_key} FROM {fold_table_name})
+    """)
+
+    drop_query = ("DROP TABLE {table_name}")
+
+    rollup_delta_create_query = ("""
+        CREATE TEMP TABLE {rollup_delta_name} AS
+        SELECT {key_fields}, sum(plays) AS plays
+        FROM (SELECT {rollup_fields} FROM ({added_select}) added
+              UNION ALL
+              SELECT {key_fields}, -plays FROM ({removed_select}) removed) signed
+        GROUP BY {key_fields}
+        HAVING sum(plays) <> 0
+    """)
+
+    # rows of snapshot of delta table with sign, rollup selects count rows of {source_table}
+    fold_source = ("(SELECT * FROM {fold_table_name} WHERE sign {sign_condition}) {fold_table_name}")
+
+    rollup_update_query = ("""
+        UPDATE {table_name}
+        SET plays = {table_name}.plays + delta.plays
+        FROM {rollup_delta_name} delta
+        WHERE {key_match}
+    """)
+
+    rollup_empty_delete_query = ("""
+        DELETE FROM {table_name}
+        USING {rollup_delta_name} delta
+        WHERE {key_match}
+          AND {table_name}.plays = 0
+    """)
+
+    rollup_insert_query = ("""
+        INSERT INTO {table_name} ({rollup_fields})
+        SELECT {rollup_fields}
+        FROM {rollup_delta_name} delta
+        WHERE NOT EXISTS (SELECT 1
+                          FROM {table_name}
+                          WHERE {key_match})
+    """)
+
+    key_match_condition = ("{table_name}.{key_field} = delta.{key_field}")
+
+    check_query = ("""
+        SELECT count(1)
+        FROM ((SELECT {rollup_fields} FROM {table_name}
+               EXCEPT
+               SELECT {rollup_fields} FROM ({rollup_select}) full_rollup)
+              UNION ALL
+              (SELECT {rollup_fields} FROM ({rollup_select}) full_rollup
+               EXCEPT
+               SELECT {rollup_fields} FROM {table_name})) mismatches
+    """)
+
+    rebuild_delete_query = ("DELETE FROM {table_name}")
+
+    rebuild_insert_query = ("""
+        INSERT INTO {table_name} ({rollup_fields})
+        SELECT {rollup_fields}
+        FROM ({rollup_select}) full_rollup
+    """)
+
+    @apply_defaults
+    def __init__(self,
+                 redshift_conn_id="",
+                 fact_table="songplays",
+                 delta_table="songplays_delta",
+                 delta_key="delta_id",
+                 rollups=None,
+                 check_hours=(0,),
+                 on_mismatch="repair",
+                 telemetry_path="",
+                 *args, **kwargs):
+
+        super(AggregateMaintenanceOperator, self).__init__(*args, **kwargs)
+        self.redshift_conn_id = redshift_conn_id
+        self.fact_table = fact_table
+        self.delta_table = delta_table
+        self.delta_key = delta_key
+        self.rollups = rollups or []
+        self.check_hours = check_hours
+        self.on_mismatch = on_mismatch
+        self.telemetry_path = telemetry_path
+
+    def execute(self, context):
+        if self.on_mismatch not in ("repair", "fail"):
+            raise ValueError("Invalid value in on_mismatch = {}".format(self.on_mismatch))
+        check = context["execution_date"].hour in self.check_hours
+        telemetry = OperatorTelemetry(self.task_id, self.delta_table, self.telemetry_path,
+                                      conn_id=self.redshift_conn_id)
+
+        self.log.info("Setting up Redshift connection")
+        mismatches = {}
+        with redshift_session(self.redshift_conn_id, operation="load",
+                              priority=self.priority_weight, owner=self.task_id) as redshift:
+            telemetry.add_phase("connect", redshift.checkout_seconds)
+            telemetry.add_phase("queue", redshift.queue_seconds)
+            telemetry.run(redshift, [AggregateMaintenanceOperator.delta_lock_query.format(
+                                         delta_table = self.delta_table),
+                                     AggregateMaintenanceOperator.delta_analyze_query.format(
+                                         delta_table = self.delta_table),
+                                     AggregateMaintenanceOperator.fold_create_query.format(
+                                         fold_table_name = self.fold_table_name(),
+                                         delta_table = self.delta_table)], phase="snapshot")
+            folded_rows = redshift.get_first(AggregateMaintenanceOperator.fold_count_query.format(
+                                                 fold_table_name = self.fold_table_name()))[0]
+            if folded_rows == 0 and not check:
+                raise AirflowSkipException("Delta table {} is empty. Aggregates SKIPPED.".format(self.delta_table))
+
+            self.log.info("Folding {} new rows of {} into {} rollups".format(folded_rows, self.fact_table,
+                                                                            len(self.rollups)))
+            if folded_rows:
+                telemetry.run(redshift, self.render_fold_sql(), phase="fold")
+            telemetry.run(redshift, AggregateMaintenanceOperator.drop_query.format(
+                                        table_name = self.fold_table_name()), phase="fold")
+
+            if check:
+                self.log.info("Consistency check of rollups is scheduled for hour {}".format(
+                                  context["execution_date"].hour))
+                for rollup in self.rollups:
+                    with telemetry.phase("check"):
+                        mismatches[rollup["table_name"]] = redshift.get_first(self.render_check_sql(rollup))[0]
+                    self.log.info("Rollup {}: {} mismatched groups".format(rollup["table_name"],
+                                                                           mismatches[rollup["table_name"]]))
+                    if mismatches[rollup["table_name"]] and self.on_mismatch == "repair":
+                        self.log.warning("Rollup {} differs from full recompute. Rebuilding.".format(
+                                             rollup["table_name"]))
+                        telemetry.run(redshift, self.render_rebuild_sql(rollup), phase="rebuild")
+        context["ti"].xcom_push(key="aggregates", value={"folded_rows": folded_rows,
+                                                         "checked": check,
+                                                         "mismatches": mismatches})
+        telemetry.publish(context, self.log)
+
+        failures = ["{} ({} groups)".format(table_name, count) for table_name, count in mismatches.items() if count]
+        if failures and self.on_mismatch == "fail":
+            raise ValueError("Rollups differ from full recompute of {}: {}".format(self.fact_table,
+                                                                                   ", ".join(failures)))
+
+    def fold_table_name(self):
+        """
+        Returns name of temp table with snapshot of delta table.
+        """
+        return "{}_fold".format(self.delta_table.split(".")[-1].strip('"'))
+
+    @staticmethod
+    def rollup_fields(rollup):
+        """
+        Returns list of columns of rollup: key fields and plays.
+        """
+        return ", ".join(rollup["key_fields"] + ["plays"])
+
+    def render_fold_sql(self):
+        """
+        Renders list of sql statements folding snapshot of delta table into every rollup and deleting folded rows.
+        """
+        statements = []
+        for rollup in self.rollups:
+            table_name = rollup["table_name"]
+            rollup_delta_name = "{}_delta".format(table_name.split(".")[-1].strip('"'))
+            key_match = " AND ".join(AggregateMaintenanceOperator.key_match_condition.format(
+                                         table_name = table_name,
+                                         key_field = key_field) for key_field in rollup["key_fields"])
+            params = dict(table_name = table_name,
+                          rollup_delta_name = rollup_delta_name,
+                          rollup_fields = self.rollup_fields(rollup),
+                          key_match = key_match)
+            added_source, removed_source = (AggregateMaintenanceOperator.fold_source.format(
+                                                fold_table_name = self.fold_table_name(),
+                                                sign_condition = sign_condition)
+                                            for sign_condition in ("> 0", "< 0"))
+            statements += [AggregateMaintenanceOperator.rollup_delta_create_query.format(
+                               rollup_delta_name = rollup_delta_name,
+                               key_fields = ", ".join(rollup["key_fields"]),
+                               rollup_fields = self.rollup_fields(rollup),
+                               added_select = rollup["select"].format(source_table = added_source),
+                               removed_select = rollup["select"].format(source_table = removed_source)),
+                           AggregateMaintenanceOperator.rollup_update_query.format(**params),
+                           AggregateMaintenanceOperator.rollup_empty_delete_query.format(**params),
+                           AggregateMaintenanceOperator.rollup_insert_query.format(**params),
+                           AggregateMaintenanceOperator.drop_query.format(table_name = rollup_delta_name)]
+        statements.append(AggregateMaintenanceOperator.fold_delete_query.format(
+                              delta_table = self.delta_table,
+                              delta_key = self.delta_key,
+                              fold_table_name = self.fold_table_name()))
+        return statements
+
+    def render_check_sql(self, rollup):
+        """
+        Renders sql query counting groups of rollup that differ from full recompute from fact table.
+        """
+        return AggregateMaintenanceOperator.check_query.format(
+                   table_name = rollup["table_name"],
+                   rollup_fields = self.rollup_fields(rollup),
+                   rollup_select = rollup["select"].format(source_table = self.fact_table))
+
+    def render_rebuild_sql(self, rollup):
+        """
+        Renders list of sql statements rebuilding rollup from full recompute from fact table.
+        """
+        return [AggregateMaintenanceOperator.rebuild_delete_query.format(table_name = rollup["table_name"]),
+                AggregateMaintenanceOperator.rebuild_insert_query.format(
+                    table_name = rollup["table_name"],
+                    rollup_fields = self.rollup_fields(rollup),
+                    rollup_select = rollup["select"].format(source_table = self.fact_table))]
@@ -1,14 +1,51 @@
-from airflow.hooks.postgres_hook import PostgresHook
+import time
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
+from airflow.exceptions import AirflowSkipException
+from helpers.change_signal import is_staging_unchanged, pull_load_scopes
+from helpers.redshift_pool import get_pool, redshift_session
+from helpers.telemetry import OperatorTelemetry
 
 class DataQualityOperator(BaseOperator):
     """
     Runs scripts to check table for number of rows
 
+    All checks for all tables are compiled first and then executed together:
+    - 'threads' mode (as default) - checks run in bounded pool of threads, each check on its own connection,
+      timing of every check is reported; connections are taken from shared pool of worker
+    - 'union' mode - checks are combined into one UNION ALL statement and run in one round trip,
+      only total timing is reported
+    Results are evaluated in Python and all failed checks are reported together.
+
+    Value checks (value_checks) aggregate in warehouse and return one number, like checks of dq_checks:
+    - 'orphan' - number of rows whose column is not null and has no matching row in reference table
+      (e.g. songplays.song_id not in songs); fails if it is over max_rows (0 as default)
+    - 'null_rate' - share of rows with null in column; fails if it is over max_rate (0.0 as default)
+    For failed value checks sample of offending rows (key and value) is read through named server-side cursor
+    in batches, up to sample_rows rows and sample_max_bytes bytes of values, so offending rows never fill
+    memory of worker. Samples are logged and pushed to XCom (key 'check_samples').
+
+    Scope of checks:
+    - 'full' scope mode (as default) - checks scan whole tables ({scope_filter} is changed on 1=1)
+    - 'run' scope mode - checks look only at rows with keys of batch loaded in current run
+      (new rows and rows that collide with them); load tasks publish sql query with keys of loaded batch to XCom,
+      tables without published scope (load skipped) are not checked. Fill checks pass when scope
+      of table has no rows (e.g. no new events in run). Full checks still run
+      for DAG runs with execution hour in full_check_hours.
+
     redshift_conn_id - name of Rendsift connection in Airflow
     table_key_list - dictionary with pairs of table and key
     dq_checks - list of checks
+    value_checks - list of value checks: type ('orphan' or 'null_rate'), table_name, column;
+                   ref_table and ref_column for 'orphan'; optional max_rows / max_rate
+    stage_task_ids - list of staging task ids; checks are skipped if all of them report that staging data has not been changed
+    execution_mode - mode for running checks - 'threads' or 'union'
+    max_workers - maximum number of checks running at the same time in 'threads' mode
+    scope_mode - scope of checks - 'full' or 'run'
+    load_task_ids - list of load task ids publishing scopes of loaded rows ('run' scope mode)
+    full_check_hours - hours of execution date when full checks run in 'run' scope mode
+    sample_rows - maximum number of sample rows of failed value check
+    sample_max_bytes - maximum size of values of sample rows of failed value check
     """
     
     ui_color = '#89DA59'
@@ -18,60 +55,362 @@ class DataQualityOperator(BaseOperator):
         FROM {}
     """
 
+    sql_template_union_item = """
+        SELECT {check_no} AS check_no, ({check_sql}) AS result
+    """
+
+    orphan_check_sql = ("""
+        SELECT count(1)
+        FROM {table_name} checked
+        WHERE checked.{column} IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM {ref_table} WHERE {ref_table}.{ref_column} = checked.{column})
+          AND {scope_filter}
+    """)
+
+    orphan_sample_sql = ("""
+        SELECT checked.{table_key}, checked.{column}
+        FROM {table_name} checked
+        WHERE checked.{column} IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM {ref_table} WHERE {ref_table}.{ref_column} = checked.{column})
+          AND {scope_filter}
+        LIMIT {sample_rows}
+    """)
+
+    null_rate_check_sql = ("""
+        SELECT coalesce(avg(CASE WHEN {column} IS NULL THEN 1.0 ELSE 0.0 END), 0.0)
+        FROM {table_name}
+        WHERE {scope_filter}
+    """)
+
+    null_rate_sample_sql = ("""
+        SELECT {table_key}, {column}
+        FROM {table_name}
+        WHERE {column} IS NULL
+          AND {scope_filter}
+        LIMIT {sample_rows}
+    """)
+
+    # Rows of sample are fetched from server-side cursor in batches of this size
+    sample_batch_size = 50
+
+    # Values of sample rows are cut to this number of characters
+    sample_value_length = 256
+
+    full_scope_filter = ("1=1")
+
+    run_scope_filter = ("{table_key} IN ({scope_sql})")
+
+    # Fill check of run scope returns empty_scope_result instead of count of rows when scope has no rows
+    run_scope_fill_sql = ("""
+        SELECT CASE WHEN EXISTS ({scope_sql}) THEN ({check_sql}) ELSE {empty_scope_result} END
+    """)
+
+    empty_scope_result = -1
+
     @apply_defaults
     def __init__(self,
                  redshift_conn_id="",
                  table_key_list="",
                  dq_checks="",
+                 stage_task_ids=None,
+                 execution_mode="threads",
+                 max_workers=4,
+                 scope_mode="full",
+                 load_task_ids=None,
+                 full_check_hours=(0,),
+                 value_checks=None,
+                 sample_rows=20,
+                 sample_max_bytes=65536,
+                 telemetry_path="",
                  *args, **kwargs):
 
         super(DataQualityOperator, self).__init__(*args, **kwargs)
         self.redshift_conn_id = redshift_conn_id
         self.table_key_list = table_key_list
         self.dq_checks = dq_checks
+        self.stage_task_ids = stage_task_ids
+        self.execution_mode = execution_mode
+        self.max_workers = max_workers
+        self.scope_mode = scope_mode
+        self.load_task_ids = load_task_ids
+        self.full_check_hours = full_check_hours
+        self.value_checks = value_checks or []
+        self.sample_rows = sample_rows
+        self.sample_max_bytes = sample_max_bytes
+        self.telemetry_path = telemetry_path
 
     def execute(self, context):
+        if is_staging_unchanged(context, self.stage_task_ids):
+            raise AirflowSkipException("Staging data has not been changed. Data quality checks SKIPPED.")
+
         self.log.info('DataQuality BEGIN')
-        self.log.info("Setting up Redshift connection")
-        redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
-        self.log.info("Redshift connection created.")
+        self.log.info("Setting up Redshift connection pool")
+        get_pool(self.redshift_conn_id, max_size=self.max_workers)
 
-        for dq_check in self.dq_checks:
-            if dq_check["type"] == "fill":
-                self.log.info('Check filling in tables')
-                for table_key in self.table_key_list:
-                    table = table_key["table_name"]
-                    self.log.info('Checking filling in {} BEGIN'.format(table))
-                    formatted_sql = dq_check["check_sql"].format(table_name = table)
-
-                    records = redshift.get_records(formatted_sql)
-
-                    if len(records) < 1 or len(records[0]) < 1:
-                        raise ValueError(f"Data quality check failed. {table} returned no results")
-                    num_records = records[0][0]
-                    if num_records < 1:
-                        raise ValueError(f"Data quality check failed. {table} contained 0 rows")
-                    self.log.info(f"Data quality on table {table} check passed with {records[0][0]} records")
-                    
-            elif dq_check["type"] == "double":
-                self.log.info('Check double in keys in tables')
-                for table_key in self.table_key_list:
-                    table = table_key["table_name"]
-                    key = table_key["table_key"]
-                    self.log.info('Checking double in {} in table {} BEGIN'.format(key, table))
-                    formatted_sql = dq_check["check_sql"].format(table_key = key, table_name = table)
-
-                    records = redshift.get_records(formatted_sql)
-
-                    if len(records) < 1 or len(records[0]) < 1:
-                        raise ValueError(f"Data quality check failed. {table} returned no results")
-                    num_records = records[0][0]
-                    if num_records == dq_check["exp_res"]:
-                        self.log.info('No double in table {}'.format(table))
-                    else:
-                        self.log.info('Double in table {}'.format(table))
+        telemetry = OperatorTelemetry(self.task_id, sink_path=self.telemetry_path, conn_id=self.redshift_conn_id)
+        queue_waits = []
+        with telemetry.phase("render"):
+            checks = self.compile_checks(self.get_scopes(context))
+        self.log.info("Running {} checks. Execution mode = {}".format(len(checks), self.execution_mode))
+        with telemetry.phase("checks"):
+            if self.execution_mode == "threads":
+                results = self.run_threads(checks, queue_waits)
+            elif self.execution_mode == "union":
+                results = self.run_union(checks, queue_waits)
+            else:
+                raise ValueError("Invalid value in execution_mode = {}".format(self.execution_mode))
+        telemetry.add_phase("queue", sum(queue_waits))
+        for check in checks:
+            if check["seconds"] is not None:
+                telemetry.record_statement("check", check["sql"], check["seconds"])
 
+        # Evaluate results
+        failures = []
+        failed_checks = []
+        for check, result in zip(checks, results):
+            error = self.evaluate_check(check, result)
+            if error:
+                failures.append(error)
+                failed_checks.append(check)
             else:
+                self.log.info("Data quality check {} on table {} passed with result {}".format(
+                                    check["type"], check["table"], result))
+
+        samples = []
+        sampled_checks = [check for check in failed_checks if check.get("sample_sql")]
+        if sampled_checks:
+            with telemetry.phase("samples"):
+                with redshift_session(self.redshift_conn_id, operation="check",
+                                      priority=self.priority_weight, owner=self.task_id) as redshift:
+                    telemetry.add_phase("queue", redshift.queue_seconds)
+                    for check in sampled_checks:
+                        sample = self.fetch_sample(redshift, check)
+                        self.log.info("Sample of check {} on {}.{}: {}".format(
+                                            check["type"], check["table"], check["column"], sample["rows"]))
+                        samples.append(sample)
+        context["ti"].xcom_push(key="check_samples", value=samples)
+
+        self.report_timings(context, checks)
+        telemetry.publish(context, self.log)
+        if failures:
+            raise ValueError("Data quality check failed. {}".format(" ".join(failures)))
+
+        self.log.info('DataQuality DONE')
+
+    def get_scopes(self, context):
+        """
+        Returns dictionary with pairs of table name (without schema) and filter of checked rows.
+        """
+        if self.scope_mode == "full":
+            return None
+        if self.scope_mode != "run":
+            raise ValueError("Invalid value in scope_mode = {}".format(self.scope_mode))
+        if context["execution_date"].hour in self.full_check_hours:
+            self.log.info("Full checks are scheduled for hour {}".format(context["execution_date"].hour))
+            return None
+        return pull_load_scopes(context, self.load_task_ids)
+
+    def compile_checks(self, scopes=None):
+        """
+        Renders sql scripts for all checks and all tables.
+        Returns list of checks with type, table, sql script and expected result.
+
+        scopes - dictionary with pairs of table name (without schema) and sql query with keys of loaded rows;
+                 None for full checks
+        """
+        checks = []
+        for dq_check in self.dq_checks:
+            if dq_check["type"] not in ("fill", "double"):
                 self.log.info('Unexpected TYPE of data quality checks')
+                continue
+            for table_key in self.table_key_list:
+                table = table_key["table_name"]
+                scope_filter = self.get_scope_filter(table, table_key["table_key"], scopes, dq_check["type"])
+                if scope_filter is None:
+                    continue
+                check_sql = dq_check["check_sql"].format(table_key = table_key["table_key"],
+                                                         table_name = table,
+                                                         scope_filter = scope_filter)
+                if dq_check["type"] == "fill" and scopes is not None:
+                    check_sql = DataQualityOperator.run_scope_fill_sql.format(
+                                    scope_sql = scopes[table.split(".")[-1]],
+                                    check_sql = check_sql,
+                                    empty_scope_result = DataQualityOperator.empty_scope_result)
+                checks.append({
+                    "type": dq_check["type"],
+                    "table": table,
+                    "sql": check_sql,
+                    "exp_res": dq_check.get("exp_res"),
+                    "seconds": None
+                })
+        for value_check in self.value_checks:
+            check = self.compile_value_check(value_check, scopes)
+            if check is not None:
+                checks.append(check)
+        return checks
+
+    def get_scope_filter(self, table, table_key, scopes, check_type):
+        """
+        Returns filter of rows checked in table, or None if check of table is skipped (no rows loaded in run).
+        """
+        if scopes is None:
+            return DataQualityOperator.full_scope_filter
+        if table.split(".")[-1] in scopes:
+            return DataQualityOperator.run_scope_filter.format(table_key = table_key,
+                                                               scope_sql = scopes[table.split(".")[-1]])
+        self.log.info("No rows loaded in current run to table {}. Check {} SKIPPED.".format(table, check_type))
+        return None
+
+    def compile_value_check(self, value_check, scopes=None):
+        """
+        Renders sql scripts of value check: query returning one number and query of sample of offending rows.
+        Key of checked table is read from table_key_list (or from table_key of value check).
+        Returns check, or None if check is skipped.
+        """
+        table = value_check["table_name"]
+        table_key = value_check.get("table_key") or next(
+                        (item["table_key"] for item in self.table_key_list if item["table_name"] == table), None)
+        if value_check["type"] not in ("orphan", "null_rate") or table_key is None:
+            self.log.info("Unexpected value check {} on table {}".format(value_check["type"], table))
+            return None
+        # Orphan check joins reference table, so key of checked table in scope filter is qualified by alias
+        key_reference = "checked." + table_key if value_check["type"] == "orphan" else table_key
+        scope_filter = self.get_scope_filter(table, key_reference, scopes, value_check["type"])
+        if scope_filter is None:
+            return None
+        if value_check["type"] == "orphan":
+            params = dict(table_name = table,
+                          column = value_check["column"],
+                          ref_table = value_check["ref_table"],
+                          ref_column = value_check["ref_column"],
+                          scope_filter = scope_filter)
+            check_sql = DataQualityOperator.orphan_check_sql.format(**params)
+            sample_sql = DataQualityOperator.orphan_sample_sql.format(table_key = table_key,
+                                                                      sample_rows = self.sample_rows,
+                                                                      **params)
+            exp_res = value_check.get("max_rows", 0)
+        else:
+            params = dict(table_name = table,
+                          column = value_check["column"],
+                          scope_filter = scope_filter)
+            check_sql = DataQualityOperator.null_rate_check_sql.format(**params)
+            sample_sql = DataQualityOperator.null_rate_sample_sql.format(table_key = table_key,
+                                                                         sample_rows = self.sample_rows,
+                                                                         **params)
+            exp_res = value_check.get("max_rate", 0.0)
+        return {"type": value_check["type"],
+                "table": table,
+                "column": value_check["column"],
+                "ref_table": value_check.get("ref_table"),
+                "sql": check_sql,
+                "sample_sql": sample_sql,
+                "exp_res": exp_res,
+                "seconds": None}
+
+    def fetch_sample(self, redshift, check):
+        """
+        Reads sample of offending rows of failed value check through server-side cursor in batches.
+        Reading stops at sample_rows rows or when values of read rows reach sample_max_bytes.
+        Returns dictionary with type, table, column, rows (values as text) and flag if sample was cut by limits.
+        """
+        rows = []
+        size = 0
+        truncated = False
+        batches = redshift.fetch_batches(check["sample_sql"], min(self.sample_rows,
+                                                                  DataQualityOperator.sample_batch_size))
+        try:
+            for batch in batches:
+                for row in batch:
+                    values = [None if value is None else str(value)[:DataQualityOperator.sample_value_length]
+                              for value in row]
+                    row_size = sum(len(value) for value in values if value is not None)
+                    if len(rows) >= self.sample_rows or size + row_size > self.sample_max_bytes:
+                        truncated = True
+                        break
+                    rows.append(values)
+                    size += row_size
+                if truncated:
+                    break
+        finally:
+            # Closing of generator closes server-side cursor, remaining rows are not fetched
+            batches.close()
+        return {"type": check["type"],
+                "table": check["table"],
+                "column": check["column"],
+                "rows": rows,
+                "truncated": truncated}
+
+    def run_threads(self, checks, queue_waits):
+        """
+        Runs each check as separate query in pool of threads.
+        Returns list of results in order of checks.
+
+        queue_waits - list which gets seconds of waiting of every session for slots of slot scheduler
+        """
+        def run_check(check):
+            start = time.monotonic()
+            with redshift_session(self.redshift_conn_id, operation="check",
+                                  priority=self.priority_weight, owner=self.task_id) as redshift:
+                queue_waits.append(redshift.queue_seconds)
+                record = redshift.get_first(check["sql"])
+            check["seconds"] = time.monotonic() - start
+            if not record:
+                return None
+            return record[0]
+
+        # concurrent.futures is imported at run of task, not at parsing of DAG
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(run_check, checks))
+
+    def run_union(self, checks, queue_waits):
+        """
+        Runs all checks as one UNION ALL statement.
+        Returns list of results in order of checks.
+
+        queue_waits - list which gets seconds of waiting of session for slots of slot scheduler
+        """
+        sqlquery = "\n        UNION ALL".join(
+            DataQualityOperator.sql_template_union_item.format(check_no = check_no, check_sql = check["sql"])
+            for check_no, check in enumerate(checks))
+        start = time.monotonic()
+        with redshift_session(self.redshift_conn_id, operation="check",
+                              priority=self.priority_weight, owner=self.task_id) as redshift:
+            queue_waits.append(redshift.queue_seconds)
+            records = redshift.get_records(sqlquery)
+        self.log.info("Checks batch DONE in {:.3f} s".format(time.monotonic() - start))
+        results = dict(records)
+        return [results.get(check_no) for check_no in range(len(checks))]
+
+    def evaluate_check(self, check, result):
+        """
+        Evaluates result of check.
+        Returns text of error or None if check is passed.
+        """
+        table = check["table"]
+        if result is None:
+            return "{} returned no results.".format(table)
+        if check["type"] == "fill" and result == DataQualityOperator.empty_scope_result:
+            self.log.info("No rows in scope of current run in table {}. Check fill PASSED.".format(table))
+            return None
+        if check["type"] == "fill" and result < 1:
+            return "{} contained 0 rows.".format(table)
+        if check["type"] == "double" and result != check["exp_res"]:
+            return "{} contained {} doubled keys.".format(table, result)
+        if check["type"] == "orphan" and result > check["exp_res"]:
+            return "{}.{} contained {} values not in {}.".format(table, check["column"], result, check["ref_table"])
+        if check["type"] == "null_rate" and float(result) > check["exp_res"]:
+            return "{}.{} contained {:.2%} nulls (allowed {:.2%}).".format(table, check["column"], float(result),
+                                                                          check["exp_res"])
+        return None
 
-        self.log.info('DataQuality DONE')
\ No newline at end of file
+    def report_timings(self, context, checks):
+        """
+        Logs timings of checks from the slowest one and pushes them to XCom.
+        """
+        timings = [{"type": check["type"], "table": check["table"], "seconds": check["seconds"]}
+                   for check in checks if check["seconds"] is not None]
+        for timing in sorted(timings, key=lambda timing: timing["seconds"], reverse=True):
+            self.log.info("Timing of check {} on table {}: {:.3f} s".format(
+                                timing["type"], timing["table"], timing["seconds"]))
+        context["ti"].xcom_push(key="check_timings", value=timings)
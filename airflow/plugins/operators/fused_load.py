@@ -0,0 +1,154 @@
+import uuid
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
+from airflow.exceptions import AirflowSkipException
+from helpers.change_signal import is_staging_unchanged, push_load_scopes
+from helpers.redshift_pool import redshift_session
+from helpers.telemetry import OperatorTelemetry
+
+class FusedLoadOperator(BaseOperator):
+    """
+    Runs rendered sql scripts of several load operators in one session and one transaction (one commit),
+    so loads of dimension and fact tables do not wait in commit queue of cluster one after another.
+    - Render sql scripts of load operators in given order (order of dependencies, e.g. artists before songs,
+      all dimensions before fact table); loads whose staging data has not been changed are left out
+    - Connect to Redshift
+    - Run all statements in one transaction with timing and rows of every statement
+      (or as one script in one round trip with single_script = "True")
+    - Publish scopes of loaded rows of all tables to XCom for run-scoped data quality checks
+    Load operators are created without DAG and only render sql here.
+    Insert mode 'delete-load' is rejected, as TRUNCATE commits transaction in Redshift and loads would not be atomic.
+
+    In single script mode statements run in stored procedure created for run (user needs CREATE privilege
+    on schema), which records rows of every statement by GET DIAGNOSTICS to temp table read at end of script;
+    cursor reports rows of last statement of script only.
+
+    redshift_conn_id - name of Rendsift connection in Airflow
+    load_operators - list of LoadDimensionOperator, LoadSongCatalogOperator and LoadFactOperator in order of dependencies
+    single_script - variable for definitions if all statements are sent as one script ("True"/"False");
+                    timing is reported for whole script only, rows are reported for every statement
+    """
+
+    ui_color = '#F9C784'
+
+    script_rowcount_table = "fused_load_rowcounts"
+
+    script_prepare_query = ("""
+        DROP TABLE IF EXISTS {rowcount_table};
+        CREATE TEMP TABLE {rowcount_table} (statement_no int4, row_count int8)
+    """)
+
+    script_procedure_query = ("""
+        CREATE PROCEDURE {procedure_name}() AS $$
+        DECLARE
+            fused_row_count int8;
+        BEGIN
+        {procedure_body}
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+
+    script_statement_query = ("""
+            {statement};
+            GET DIAGNOSTICS fused_row_count := ROW_COUNT;
+            INSERT INTO {rowcount_table} VALUES ({statement_no}, fused_row_count);
+    """)
+
+    script_call_query = ("""
+        CALL {procedure_name}();
+        DROP PROCEDURE {procedure_name}();
+        SELECT statement_no, row_count FROM {rowcount_table} ORDER BY statement_no
+    """)
+
+    @apply_defaults
+    def __init__(self,
+                 redshift_conn_id="",
+                 load_operators=None,
+                 single_script="False",
+                 telemetry_path="",
+                 *args, **kwargs):
+
+        super(FusedLoadOperator, self).__init__(*args, **kwargs)
+        self.redshift_conn_id = redshift_conn_id
+        self.load_operators = load_operators or []
+        self.single_script = single_script
+        self.telemetry_path = telemetry_path
+        for operator in self.load_operators:
+            if getattr(operator, "insert_mode", None) == "delete-load":
+                raise ValueError("Insert mode 'delete-load' of {} is not supported in fused loads, "
+                                 "as TRUNCATE commits transaction".format(operator.task_id))
+
+    def execute(self, context):
+        telemetry = OperatorTelemetry(self.task_id, sink_path=self.telemetry_path, conn_id=self.redshift_conn_id)
+
+        # Render sql scripts of loads in order of dependencies
+        loads = []
+        with telemetry.phase("render"):
+            for operator in self.load_operators:
+                if is_staging_unchanged(context, operator.stage_task_ids):
+                    self.log.info("Staging data has not been changed. Load {} SKIPPED.".format(operator.task_id))
+                    continue
+                loads.append((operator, operator.render_sql()))
+        if not loads:
+            raise AirflowSkipException("Staging data has not been changed. Loads SKIPPED.")
+
+        # Run all statements in one transaction, commit is timed with session
+        self.log.info("Setting up Redshift connection")
+        with telemetry.phase("session"):
+            with redshift_session(self.redshift_conn_id, operation="load",
+                                  priority=self.priority_weight, owner=self.task_id) as redshift:
+                telemetry.add_phase("connect", redshift.checkout_seconds)
+                telemetry.add_phase("queue", redshift.queue_seconds)
+                self.log.info("Redshift connection created.")
+                if self.single_script == "True":
+                    statements = [(operator, statement) for operator, statements in loads for statement in statements]
+                    self.log.info("Executing {} loads as one script".format(len(loads)))
+                    with telemetry.phase("script"):
+                        rowcounts = dict(redshift.get_records(
+                                            self.render_script([statement for _, statement in statements])))
+                    for statement_no, (operator, statement) in enumerate(statements):
+                        telemetry.record_statement(operator.task_id, statement, None, rowcounts.get(statement_no))
+                else:
+                    for operator, statements in loads:
+                        self.log.info("Executing Redshift SQL operation in table {} ({} statements)".format(
+                                            operator.target_table_name, len(statements)))
+                        telemetry.run(redshift, statements, phase=operator.task_id)
+        self.log.info("Redshift SQL operations DONE in tables {}.".format(
+                            ", ".join(operator.target_table_name for operator, _ in loads)))
+
+        report = telemetry.publish(context, self.log)
+        for statement in report["statements"]:
+            if statement["seconds"] is not None:
+                self.log.info("{:.3f} s {} rows: {}".format(statement["seconds"], statement["rows"],
+                                                            statement["statement"]))
+            else:
+                self.log.info("{} rows: {}".format(statement["rows"], statement["statement"]))
+        push_load_scopes(context, [scope for operator, _ in loads for scope in self.get_load_scopes(operator)])
+
+    def render_script(self, statements):
+        """
+        Renders single script running statements in stored procedure of run.
+        Last query of script returns pairs of number of statement and its rows.
+        """
+        params = dict(rowcount_table = FusedLoadOperator.script_rowcount_table,
+                      procedure_name = "fused_load_{}".format(uuid.uuid4().hex))
+        procedure_body = "".join(FusedLoadOperator.script_statement_query.format(
+                                    statement = statement.strip().rstrip(";"),
+                                    statement_no = statement_no,
+                                    **params)
+                                 for statement_no, statement in enumerate(statements))
+        return ";\n".join(query.strip() for query in [
+                    FusedLoadOperator.script_prepare_query.format(**params),
+                    FusedLoadOperator.script_procedure_query.format(procedure_body = procedure_body, **params),
+                    FusedLoadOperator.script_call_query.format(**params)])
+
+    def get_load_scopes(self, operator):
+        """
+        Returns list of pairs of table name and scope sql of load operator
+        (LoadSongCatalogOperator loads two tables).
+        """
+        if hasattr(operator, "load_scopes"):
+            return operator.load_scopes
+        if operator.scope_sql:
+            return [(operator.target_table_name, operator.scope_sql)]
+        return []
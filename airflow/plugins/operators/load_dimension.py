@@ -1,6 +1,10 @@
-from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
+from airflow.exceptions import AirflowSkipException
+from helpers.change_signal import is_staging_unchanged, push_load_scope
+from helpers.redshift_pool import redshift_session
+from helpers.telemetry import OperatorTelemetry
+from helpers.query_registry import run_statements
 
 class LoadDimensionOperator(BaseOperator):
     """
@@ -18,6 +22,26 @@ class LoadDimensionOperator(BaseOperator):
     insert_mode - mode for insert query 
                 'append' (as default) - load data with new primary key from staging area
                 'delete-load' - truncate target table and load data from staging area
+                'merge' - upsert data from staging area in one transaction:
+                          deduplicated rows are saved to temp table once, rows equal to target rows are removed from it,
+                          then rows with the same primary key are updated in target table by join
+                          and rows with new primary key are inserted from temp table
+                Choose 'append' when rows never change after first load (songs, artists),
+                'merge' when attributes of rows change (level of users) or staging area holds only part of dimension:
+                rows of target table are updated in place, so rows referenced by songplays are never removed
+                and rerun with unchanged staging data writes nothing;
+                'delete-load' only when staging area holds whole dimension and rows of most keys change in every run,
+                as rows missing in staging area are removed and all rows are rewritten
+    use_merge_command - variable for definitions if MERGE command is used in 'merge' mode instead of UPDATE and INSERT
+                        ("True"/"False")
+    stage_task_ids - list of staging task ids; load is skipped if all of them report that staging data has not been changed
+    scope_sql - sql query returning keys of rows in loaded batch; it is published to XCom for run-scoped data quality checks
+    explain_plans - variable for definitions if EXPLAIN plans of INSERT statements are captured to telemetry ("True"/"False")
+    plan_guard - check of EXPLAIN cost against baseline in table query_plan_baseline:
+                'off' (as default), 'warn' - log regression, 'fail' - fail task on regression
+    plan_cost_threshold - allowed ratio of EXPLAIN cost to baseline cost
+    use_prepared_statements - variable for definitions if INSERT statements run as prepared statements,
+                prepared once per pooled connection ("True"/"False") - not used in 'merge' mode
     """
     
     ui_color = '#80BD9E'
@@ -36,6 +60,45 @@ class LoadDimensionOperator(BaseOperator):
 
     delete_load_mode_query_where = ("1=1")
 
+    merge_stage_create_query = ("CREATE TEMP TABLE {stage_table_name} (LIKE {target_table_name});")
+
+    merge_stage_insert_query = ("""
+        INSERT INTO {stage_table_name} ({target_table_fields})
+    """)
+
+    merge_stage_unchanged_delete_query = ("""
+        DELETE FROM {stage_table_name}
+        USING {target_table_name}
+        WHERE {target_table_name}.{target_table_key} = {stage_table_name}.{target_table_key}
+          AND {unchanged_fields};
+    """)
+
+    merge_update_query = ("""
+        UPDATE {target_table_name}
+        SET {update_fields}
+        FROM {stage_table_name}
+        WHERE {target_table_name}.{target_table_key} = {stage_table_name}.{target_table_key};
+    """)
+
+    merge_insert_query = ("""
+        INSERT INTO {target_table_name} ({target_table_fields})
+        SELECT {target_table_fields}
+        FROM {stage_table_name}
+        WHERE NOT EXISTS (SELECT {target_table_key}
+                          FROM {target_table_name}
+                          WHERE {target_table_name}.{target_table_key} = {stage_table_name}.{target_table_key});
+    """)
+
+    merge_command_query = ("""
+        MERGE INTO {target_table_name}
+        USING {stage_table_name}
+        ON {target_table_name}.{target_table_key} = {stage_table_name}.{target_table_key}
+        WHEN MATCHED THEN UPDATE SET {update_fields}
+        WHEN NOT MATCHED THEN INSERT ({target_table_fields}) VALUES ({stage_table_fields});
+    """)
+
+    merge_stage_drop_query = ("DROP TABLE {stage_table_name};")
+
     @apply_defaults
     def __init__(self,
                  redshift_conn_id="",
@@ -44,6 +107,14 @@ class LoadDimensionOperator(BaseOperator):
                  target_table_key="",
                  sql_query_insert="",
                  insert_mode = "append",
+                 stage_task_ids=None,
+                 scope_sql="",
+                 telemetry_path="",
+                 explain_plans="False",
+                 plan_guard="off",
+                 plan_cost_threshold=2.0,
+                 use_prepared_statements="False",
+                 use_merge_command="False",
                  *args, **kwargs):
 
         super(LoadDimensionOperator, self).__init__(*args, **kwargs)
@@ -53,35 +124,97 @@ class LoadDimensionOperator(BaseOperator):
         self.target_table_key = target_table_key
         self.sql_query_insert = sql_query_insert
         self.insert_mode = insert_mode
+        self.stage_task_ids = stage_task_ids
+        self.scope_sql = scope_sql
+        self.telemetry_path = telemetry_path
+        self.explain_plans = explain_plans
+        self.plan_guard = plan_guard
+        self.plan_cost_threshold = plan_cost_threshold
+        self.use_prepared_statements = use_prepared_statements
+        self.use_merge_command = use_merge_command
 
     def execute(self, context):
-        # Set AWS S3 and Redshift connections
-        self.log.info("Setting up Redshift connection")
-        redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
-        self.log.info("Redshift connection created.")
+        if is_staging_unchanged(context, self.stage_task_ids):
+            raise AirflowSkipException("Staging data has not been changed. Load SKIPPED.")
+
+        telemetry = OperatorTelemetry(self.task_id, self.target_table_name, self.telemetry_path,
+                                      conn_id=self.redshift_conn_id, explain=self.explain_plans == "True")
+
+        # Render sql script
+        self.log.info("Rendering sql script for {}. Insert mode = {}".format(self.target_table_name, self.insert_mode))
+        with telemetry.phase("render"):
+            sqlquery = self.render_sql()
 
+        # Set Redshift connection and execute SQL operation in one transaction
+        self.log.info("Setting up Redshift connection")
+        with redshift_session(self.redshift_conn_id, operation="load",
+                              priority=self.priority_weight, owner=self.task_id) as redshift:
+            telemetry.add_phase("connect", redshift.checkout_seconds)
+            telemetry.add_phase("queue", redshift.queue_seconds)
+            self.log.info("Redshift connection created.")
+            self.log.info("Executing Redshift SQL operation in dimension table {}".format(self.target_table_name))
+            run_statements(redshift, telemetry, sqlquery, self.task_id,
+                           plan_guard=self.plan_guard,
+                           plan_cost_threshold=self.plan_cost_threshold,
+                           use_prepared=self.use_prepared_statements == "True" and self.insert_mode != "merge",
+                           log=self.log)
+        self.log.info("Redshift SQL operation DONE in dimension table {}.".format(self.target_table_name))
+        telemetry.publish(context, self.log)
+        if self.scope_sql:
+            push_load_scope(context, self.target_table_name, self.scope_sql)
 
+    def render_sql(self):
+        """
+        Renders list of sql statements for insert mode.
+        Statements are executed in one transaction.
+        """
         insert_query = LoadDimensionOperator.insert_query.format(
                                                 target_table_name = self.target_table_name,
                                                 target_table_fields = self.target_table_fields)
-        # Render sql script
-        self.log.info("Rendering sql script for {}. Insert mode = {}".format(self.target_table_name, self.insert_mode))
         if self.insert_mode == "append":
-            sqlquery = insert_query + \
-                       self.sql_query_insert.format(INSERT_MODE_QUERY = LoadDimensionOperator.append_mode_query_where.format(
+            return [insert_query + \
+                    self.sql_query_insert.format(INSERT_MODE_QUERY = LoadDimensionOperator.append_mode_query_where.format(
                                                         target_table_key = self.target_table_key,
                                                         target_table_name = self.target_table_name
-                       ))
+                    ))]
         elif self.insert_mode == "delete-load":
-            sqlquery = LoadDimensionOperator.delete_query.format(target_table_name = self.target_table_name) + \
-                       insert_query + \
-                       self.sql_query_insert.format(INSERT_MODE_QUERY = LoadDimensionOperator.delete_load_mode_query_where)
+            return [LoadDimensionOperator.delete_query.format(target_table_name = self.target_table_name),
+                    insert_query + \
+                    self.sql_query_insert.format(INSERT_MODE_QUERY = LoadDimensionOperator.delete_load_mode_query_where)]
+        elif self.insert_mode == "merge":
+            return self.render_merge_sql()
         else:
-            self.log.info("Invalid value in insert_mode = {}".format(self.insert_mode))
-            sqlquery = ""
+            raise ValueError("Invalid value in insert_mode = {}".format(self.insert_mode))
 
+    def render_merge_sql(self):
+        """
+        Renders list of sql statements for 'merge' mode.
+        """
+        stage_table_name = "{}_merge_stage".format(self.target_table_name.replace(".", "_"))
+        fields = [field.strip() for field in self.target_table_fields.split(",")]
+        params = dict(target_table_name = self.target_table_name,
+                      target_table_fields = self.target_table_fields,
+                      target_table_key = self.target_table_key,
+                      stage_table_name = stage_table_name)
 
-        # Execute SQL operation
-        self.log.info("Executing Redshift SQL operation in dimension table {}".format(self.target_table_name))
-        redshift.run(sqlquery)
-        self.log.info("Redshift SQL operation DONE in dimension table {}.".format(self.target_table_name))
+        statements = [LoadDimensionOperator.merge_stage_create_query.format(**params),
+                      LoadDimensionOperator.merge_stage_insert_query.format(**params) + \
+                      self.sql_query_insert.format(INSERT_MODE_QUERY = LoadDimensionOperator.delete_load_mode_query_where),
+                      LoadDimensionOperator.merge_stage_unchanged_delete_query.format(
+                          unchanged_fields = "\n          AND ".join(
+                              "({0}.{2} = {1}.{2} OR ({0}.{2} IS NULL AND {1}.{2} IS NULL))".format(
+                                  self.target_table_name, stage_table_name, field)
+                              for field in fields if field != self.target_table_key),
+                          **params)]
+        update_fields = ", ".join("{0} = {1}.{0}".format(field, stage_table_name)
+                                  for field in fields if field != self.target_table_key)
+        if self.use_merge_command == "True":
+            statements.append(LoadDimensionOperator.merge_command_query.format(
+                update_fields = update_fields,
+                stage_table_fields = ", ".join("{}.{}".format(stage_table_name, field) for field in fields),
+                **params))
+        else:
+            statements.append(LoadDimensionOperator.merge_update_query.format(update_fields = update_fields, **params))
+            statements.append(LoadDimensionOperator.merge_insert_query.format(**params))
+        statements.append(LoadDimensionOperator.merge_stage_drop_query.format(**params))
+        return statements
@@ -1,6 +1,11 @@
-from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
+from airflow.exceptions import AirflowSkipException
+from helpers.change_signal import is_staging_unchanged, push_load_scope
+from helpers.redshift_pool import redshift_session
+from helpers.telemetry import OperatorTelemetry
+from helpers.query_registry import run_statements
+from helpers.sql_literals import sql_literal
 
 class LoadFactOperator(BaseOperator):
     """
@@ -14,6 +19,28 @@ class LoadFactOperator(BaseOperator):
     target_table_fields - fields in target table
     target_table_key - primary key in target table
     sql_query_insert - sql query for insert to target table
+    insert_mode - mode for insert query
+                'append' (as default) - sql_query_insert with its own dedupe against target table
+                'window' - rows of sql_query_select (surrogate key is computed once there) are inserted
+                           if they are not in target table; dedupe reads only slice of target table in range
+                           of window_column of staging batch (read by window_query and rendered as literals,
+                           so sort key of target table prunes blocks); if target table has no rows in range,
+                           rows are inserted without dedupe
+    sql_query_select - sql query selecting rows of staging batch without dedupe ('window' mode)
+    window_query - sql query returning minimum and maximum of window_column in staging batch ('window' mode)
+    window_column - column of target table that is sort key and equal for rows with the same key ('window' mode)
+    stage_task_ids - list of staging task ids; load is skipped if all of them report that staging data has not been changed
+    scope_sql - sql query returning keys of rows in loaded batch; it is published to XCom for run-scoped data quality checks
+    explain_plans - variable for definitions if EXPLAIN plans of INSERT statements are captured to telemetry ("True"/"False")
+    plan_guard - check of EXPLAIN cost against baseline in table query_plan_baseline:
+                'off' (as default), 'warn' - log regression, 'fail' - fail task on regression
+    plan_cost_threshold - allowed ratio of EXPLAIN cost to baseline cost
+    use_prepared_statements - variable for definitions if INSERT statements run as prepared statements,
+                prepared once per pooled connection ("True"/"False") - not used in 'window' mode,
+                as literals of window change every run
+    delta_table - table that gets copy of rows inserted into target table in the same transaction
+                (e.g. songplays_delta folded into aggregate tables); "" to not capture inserted rows.
+                Inserted rows are selected once into temp table {target table}_batch and copied from it
     """
     
     ui_color = '#F98866'
@@ -22,6 +49,35 @@ class LoadFactOperator(BaseOperator):
         INSERT INTO {target_table_name} ({target_table_fields})
     """)
 
+    window_select_query = ("""
+        SELECT batch.*
+        FROM ({sql_query_select}) batch
+        WHERE NOT EXISTS (SELECT {target_table_key}
+                          FROM {target_table_name}
+                          WHERE {target_table_name}.{target_table_key} = batch.{target_table_key}
+                            AND {target_table_name}.{window_column} = batch.{window_column}{window_filter})
+    """)
+
+    window_range_filter = ("""
+                            AND {target_table_name}.{window_column} BETWEEN {window_start} AND {window_end}""")
+
+    window_loaded_query = ("""
+        SELECT 1
+        FROM {target_table_name}
+        WHERE {window_column} BETWEEN {window_start} AND {window_end}
+        LIMIT 1
+    """)
+
+    batch_create_query = ("CREATE TEMP TABLE {batch_table_name} (LIKE {target_table_name})")
+
+    batch_copy_query = ("""
+        INSERT INTO {table_name} ({target_table_fields})
+        SELECT {target_table_fields}
+        FROM {batch_table_name}
+    """)
+
+    batch_drop_query = ("DROP TABLE {batch_table_name}")
+
     @apply_defaults
     def __init__(self,
                  redshift_conn_id="",
@@ -29,6 +85,18 @@ class LoadFactOperator(BaseOperator):
                  target_table_fields="",
                  target_table_key="",
                  sql_query_insert="",
+                 insert_mode="append",
+                 sql_query_select="",
+                 window_query="",
+                 window_column="start_time",
+                 stage_task_ids=None,
+                 scope_sql="",
+                 telemetry_path="",
+                 explain_plans="False",
+                 plan_guard="off",
+                 plan_cost_threshold=2.0,
+                 use_prepared_statements="False",
+                 delta_table="",
                  *args, **kwargs):
 
         super(LoadFactOperator, self).__init__(*args, **kwargs)
@@ -37,20 +105,130 @@ class LoadFactOperator(BaseOperator):
         self.target_table_fields = target_table_fields
         self.target_table_key = target_table_key
         self.sql_query_insert = sql_query_insert
+        self.insert_mode = insert_mode
+        self.sql_query_select = sql_query_select
+        self.window_query = window_query
+        self.window_column = window_column
+        self.stage_task_ids = stage_task_ids
+        self.scope_sql = scope_sql
+        self.telemetry_path = telemetry_path
+        self.explain_plans = explain_plans
+        self.plan_guard = plan_guard
+        self.plan_cost_threshold = plan_cost_threshold
+        self.use_prepared_statements = use_prepared_statements
+        self.delta_table = delta_table
 
     def execute(self, context):
-         # Set AWS S3 and Redshift connections
+        if is_staging_unchanged(context, self.stage_task_ids):
+            raise AirflowSkipException("Staging data has not been changed. Load SKIPPED.")
+
+        telemetry = OperatorTelemetry(self.task_id, self.target_table_name, self.telemetry_path,
+                                      conn_id=self.redshift_conn_id, explain=self.explain_plans == "True")
+
+        # Set Redshift connection, render sql script and execute SQL operation
         self.log.info("Setting up Redshift connection")
-        redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
-        self.log.info("Redshift connection created.")
-
-        # Render sql script
-        insert_query_rendered = LoadFactOperator.insert_query.format(
-                                    target_table_name = self.target_table_name,
-                                    target_table_fields = self.target_table_fields)
-        sqlquery = insert_query_rendered + self.sql_query_insert
-
-        # Execute SQL operation
-        self.log.info("Executing Redshift SQL operation in fact table {}".format(self.target_table_name))
-        redshift.run(sqlquery)
+        with redshift_session(self.redshift_conn_id, operation="load",
+                              priority=self.priority_weight, owner=self.task_id) as redshift:
+            telemetry.add_phase("connect", redshift.checkout_seconds)
+            telemetry.add_phase("queue", redshift.queue_seconds)
+            self.log.info("Redshift connection created.")
+            window = None
+            window_loaded = True
+            if self.insert_mode == "window":
+                with telemetry.phase("window"):
+                    window = self.read_window(redshift)
+                    window_loaded = window is not None and self.is_window_loaded(redshift, window)
+                self.log.info("Window of staging batch: {}, rows of window in {}: {}".format(
+                                  window, self.target_table_name, window_loaded))
+            with telemetry.phase("render"):
+                sqlquery = self.render_sql(window, window_loaded)
+            self.log.info("Executing Redshift SQL operation in fact table {}".format(self.target_table_name))
+            run_statements(redshift, telemetry, sqlquery, self.task_id,
+                           plan_guard=self.plan_guard,
+                           plan_cost_threshold=self.plan_cost_threshold,
+                           use_prepared=self.use_prepared_statements == "True" and self.insert_mode != "window",
+                           log=self.log)
         self.log.info("Redshift SQL operation DONE in fact table {}.".format(self.target_table_name))
+        telemetry.publish(context, self.log)
+        if self.scope_sql:
+            push_load_scope(context, self.target_table_name, self.scope_sql)
+
+    def read_window(self, redshift):
+        """
+        Reads minimum and maximum of window column in staging batch.
+        Returns pair of values, or None if staging batch is empty.
+        """
+        window_start, window_end = redshift.get_first(self.window_query)
+        if window_start is None:
+            return None
+        return window_start, window_end
+
+    def is_window_loaded(self, redshift, window):
+        """
+        Checks if target table has some rows in window of staging batch (reads only blocks of range of sort key).
+        """
+        window_start, window_end = (sql_literal(value) for value in window)
+        return redshift.get_first(LoadFactOperator.window_loaded_query.format(
+                                      target_table_name = self.target_table_name,
+                                      window_column = self.window_column,
+                                      window_start = window_start,
+                                      window_end = window_end)) is not None
+
+    def render_sql(self, window=None, window_loaded=True):
+        """
+        Renders list of sql statements for loading fact table.
+
+        window - pair of minimum and maximum of window column in staging batch ('window' mode);
+                 if it is not set (e.g. in fused loads), dedupe is limited by equal window column only
+        window_loaded - False if target table has no rows in window, then rows are inserted without dedupe
+        """
+        if self.insert_mode == "append":
+            return self.render_insert(self.sql_query_insert)
+        elif self.insert_mode == "window":
+            return self.render_window_sql(window, window_loaded)
+        else:
+            raise ValueError("Invalid value in insert_mode = {}".format(self.insert_mode))
+
+    def render_window_sql(self, window, window_loaded=True):
+        """
+        Renders list of sql statements for 'window' mode.
+        """
+        if window is not None and not window_loaded:
+            return self.render_insert(self.sql_query_select)
+        params = dict(target_table_name = self.target_table_name,
+                      target_table_fields = self.target_table_fields,
+                      target_table_key = self.target_table_key,
+                      window_column = self.window_column)
+        window_filter = ""
+        if window is not None:
+            window_start, window_end = (sql_literal(value) for value in window)
+            window_filter = LoadFactOperator.window_range_filter.format(window_start = window_start,
+                                                                        window_end = window_end,
+                                                                        **params)
+        window_select = LoadFactOperator.window_select_query.format(sql_query_select = self.sql_query_select,
+                                                                    window_filter = window_filter,
+                                                                    **params)
+        return self.render_insert(window_select)
+
+    def render_insert(self, sql_query_select):
+        """
+        Renders insert of rows of sql query into target table.
+        With delta_table rows are inserted into temp table once and copied from it to target table and delta table.
+        """
+        if not self.delta_table:
+            return [LoadFactOperator.insert_query.format(target_table_name = self.target_table_name,
+                                                         target_table_fields = self.target_table_fields)
+                    + sql_query_select]
+        batch_table_name = "{}_batch".format(self.target_table_name.split(".")[-1].strip('"'))
+        return [LoadFactOperator.batch_create_query.format(batch_table_name = batch_table_name,
+                                                           target_table_name = self.target_table_name),
+                LoadFactOperator.insert_query.format(target_table_name = batch_table_name,
+                                                     target_table_fields = self.target_table_fields)
+                + sql_query_select,
+                LoadFactOperator.batch_copy_query.format(table_name = self.target_table_name,
+                                                         target_table_fields = self.target_table_fields,
+                                                         batch_table_name = batch_table_name),
+                LoadFactOperator.batch_copy_query.format(table_name = self.delta_table,
+                                                         target_table_fields = self.target_table_fields,
+                                                         batch_table_name = batch_table_name),
+                LoadFactOperator.batch_drop_query.format(batch_table_name = batch_table_name)]
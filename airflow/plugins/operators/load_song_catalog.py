@@ -0,0 +1,140 @@
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
+from airflow.exceptions import AirflowSkipException
+from helpers.sql_queries import SqlQueries
+from helpers.change_signal import is_staging_unchanged, push_load_scopes
+from helpers.redshift_pool import redshift_session
+from helpers.telemetry import OperatorTelemetry
+from helpers.query_registry import run_statements
+from operators.load_dimension import LoadDimensionOperator
+
+class LoadSongCatalogOperator(BaseOperator):
+    """
+    Load artists and songs dimension tables from one scan of staging_songs.
+    - Connect to Redshift
+    - Rendering sql script:
+        - Save staging rows that are first for their song_id or artist_id to temp table
+          (both row_number() windows are computed in the same scan; in 'append' mode only rows
+          of new songs or new artists are saved)
+        - Load artists table from temp table, then songs table, with insert mode of LoadDimensionOperator
+        - Drop temp table
+    - Run all statements in one transaction
+    Staging table is scanned once instead of once per table, and loads of artists and songs
+    are one task instead of two serial tasks.
+
+    redshift_conn_id - name of Rendsift connection in Airflow
+    artist_table_name - name of artists table
+    song_table_name - name of songs table
+    insert_mode - mode for insert queries of both tables: 'append' (as default), 'delete-load' or 'merge'
+                  (see LoadDimensionOperator)
+    use_merge_command - variable for definitions if MERGE command is used in 'merge' mode ("True"/"False")
+    stage_task_ids - list of staging task ids; load is skipped if all of them report that staging data has not been changed
+    artist_scope_sql - sql query returning keys of loaded artists; it is published to XCom for run-scoped data quality checks
+    song_scope_sql - sql query returning keys of loaded songs
+    explain_plans - variable for definitions if EXPLAIN plans of INSERT statements are captured to telemetry ("True"/"False")
+    plan_guard - check of EXPLAIN cost against baseline: 'off' (as default), 'warn' or 'fail'
+    plan_cost_threshold - allowed ratio of EXPLAIN cost to baseline cost
+    """
+
+    ui_color = '#80BD9E'
+
+    @apply_defaults
+    def __init__(self,
+                 redshift_conn_id="",
+                 artist_table_name="artists",
+                 song_table_name="songs",
+                 insert_mode="append",
+                 use_merge_command="False",
+                 stage_task_ids=None,
+                 artist_scope_sql="",
+                 song_scope_sql="",
+                 telemetry_path="",
+                 explain_plans="False",
+                 plan_guard="off",
+                 plan_cost_threshold=2.0,
+                 *args, **kwargs):
+
+        super(LoadSongCatalogOperator, self).__init__(*args, **kwargs)
+        self.redshift_conn_id = redshift_conn_id
+        self.artist_table_name = artist_table_name
+        self.song_table_name = song_table_name
+        self.insert_mode = insert_mode
+        self.use_merge_command = use_merge_command
+        self.stage_task_ids = stage_task_ids
+        self.artist_scope_sql = artist_scope_sql
+        self.song_scope_sql = song_scope_sql
+        self.telemetry_path = telemetry_path
+        self.explain_plans = explain_plans
+        self.plan_guard = plan_guard
+        self.plan_cost_threshold = plan_cost_threshold
+
+    @property
+    def target_table_name(self):
+        return "{}, {}".format(self.artist_table_name, self.song_table_name)
+
+    @property
+    def load_scopes(self):
+        """
+        List of pairs of table name and scope sql of loaded tables.
+        """
+        return [(table_name, scope_sql)
+                for table_name, scope_sql in ((self.artist_table_name, self.artist_scope_sql),
+                                              (self.song_table_name, self.song_scope_sql))
+                if scope_sql]
+
+    def execute(self, context):
+        if is_staging_unchanged(context, self.stage_task_ids):
+            raise AirflowSkipException("Staging data has not been changed. Load SKIPPED.")
+
+        telemetry = OperatorTelemetry(self.task_id, self.target_table_name, self.telemetry_path,
+                                      conn_id=self.redshift_conn_id, explain=self.explain_plans == "True")
+
+        # Render sql script
+        self.log.info("Rendering sql script for {}. Insert mode = {}".format(self.target_table_name, self.insert_mode))
+        with telemetry.phase("render"):
+            sqlquery = self.render_sql()
+
+        # Set Redshift connection and execute SQL operation in one transaction
+        self.log.info("Setting up Redshift connection")
+        with redshift_session(self.redshift_conn_id, operation="load",
+                              priority=self.priority_weight, owner=self.task_id) as redshift:
+            telemetry.add_phase("connect", redshift.checkout_seconds)
+            telemetry.add_phase("queue", redshift.queue_seconds)
+            self.log.info("Redshift connection created.")
+            self.log.info("Executing Redshift SQL operation in dimension tables {}".format(self.target_table_name))
+            run_statements(redshift, telemetry, sqlquery, self.task_id,
+                           plan_guard=self.plan_guard,
+                           plan_cost_threshold=self.plan_cost_threshold,
+                           log=self.log)
+        self.log.info("Redshift SQL operation DONE in dimension tables {}.".format(self.target_table_name))
+        telemetry.publish(context, self.log)
+        if self.load_scopes:
+            push_load_scopes(context, self.load_scopes)
+
+    def render_sql(self):
+        """
+        Renders list of sql statements: temp table of catalog, loads of artists and songs, drop of temp table.
+        Artists are loaded before songs, as songs reference artists.
+        """
+        loads = [LoadDimensionOperator(task_id="{}_{}".format(self.task_id, target_table_name.replace(".", "_")),
+                                       target_table_name=target_table_name,
+                                       target_table_fields=target_table_fields,
+                                       target_table_key=target_table_key,
+                                       sql_query_insert=sql_query_insert,
+                                       insert_mode=self.insert_mode,
+                                       use_merge_command=self.use_merge_command)
+                 for target_table_name, target_table_fields, target_table_key, sql_query_insert in (
+                     (self.artist_table_name, SqlQueries.artist_table_fields, SqlQueries.artist_table_key,
+                      SqlQueries.song_catalog_artist_insert),
+                     (self.song_table_name, SqlQueries.song_table_fields, SqlQueries.song_table_key,
+                      SqlQueries.song_catalog_song_insert))]
+        if self.insert_mode == "append":
+            stage_filter = SqlQueries.song_catalog_append_filter.format(artist_table_name = self.artist_table_name,
+                                                                        song_table_name = self.song_table_name)
+        else:
+            stage_filter = LoadDimensionOperator.delete_load_mode_query_where
+        statements = [SqlQueries.song_catalog_stage_create.format(INSERT_MODE_QUERY = stage_filter)]
+        for load in loads:
+            statements.extend(load.render_sql())
+        statements.append(SqlQueries.song_catalog_stage_drop)
+        return statements
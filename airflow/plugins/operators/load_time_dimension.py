@@ -0,0 +1,140 @@
+import gzip
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
+from airflow.exceptions import AirflowSkipException
+from helpers.sql_queries import SqlQueries
+from helpers.s3_manifest import build_copy_manifest
+from helpers.change_signal import is_staging_unchanged, push_load_scope
+from helpers.redshift_pool import redshift_session
+from helpers.telemetry import OperatorTelemetry
+from helpers.aws_hooks import get_s3_hook, get_aws_credentials
+
+class LoadTimeDimensionOperator(BaseOperator):
+    """
+    Load time dimension table with attributes computed in Python instead of SQL.
+    - Connect to Redshift
+    - Read distinct timestamps of staging events (start_time column) that are not in time table yet,
+      in batches by server-side cursor
+    - Compute hour, day, week, month, year and weekday of every batch in one vectorized pass (NumPy)
+    - Write every batch as gzip compressed CSV from memory buffer to S3
+    - Copy all batches with one COPY from manifest
+    Only new keys are loaded, so COPY does not need DELETE or NOT EXISTS on time table.
+
+    redshift_conn_id - name of Rendsift connection in Airflow
+    aws_credentials_id - name of AWS connection in Airflow
+    target_table_name - time dimension table
+    staging_table - staging table with events and start_time column
+    output_bucket - name of bucket with write access for CSV files and COPY manifest
+    output_prefix - name of folder in output bucket
+    batch_size - number of timestamps computed and written as one file
+    stage_task_ids - list of staging task ids; load is skipped if all of them report that staging data has not been changed
+    scope_sql - sql query returning keys of rows in loaded batch; it is published to XCom for run-scoped data quality checks
+    """
+
+    ui_color = '#80BD9E'
+    template_fields = ("output_bucket",)
+
+    copy_query = ("""
+        COPY {target_table_name} ({target_table_fields})
+        FROM '{manifest_path}'
+        ACCESS_KEY_ID '{access_key}'
+        SECRET_ACCESS_KEY '{secret_key}'
+        format as csv gzip
+        TIMEFORMAT 'YYYY-MM-DD HH:MI:SS'
+        manifest
+    """)
+
+    # Level of gzip compression of CSV files
+    compress_level = 6
+
+    @apply_defaults
+    def __init__(self,
+                 redshift_conn_id="",
+                 aws_credentials_id="",
+                 target_table_name="time",
+                 staging_table="staging_events",
+                 output_bucket="",
+                 output_prefix="time_dimension",
+                 batch_size=500000,
+                 stage_task_ids=None,
+                 scope_sql="",
+                 telemetry_path="",
+                 *args, **kwargs):
+
+        super(LoadTimeDimensionOperator, self).__init__(*args, **kwargs)
+        self.redshift_conn_id = redshift_conn_id
+        self.aws_credentials_id = aws_credentials_id
+        self.target_table_name = target_table_name
+        self.staging_table = staging_table
+        self.output_bucket = output_bucket
+        self.output_prefix = output_prefix
+        self.batch_size = batch_size
+        self.stage_task_ids = stage_task_ids
+        self.scope_sql = scope_sql
+        self.telemetry_path = telemetry_path
+
+    def execute(self, context):
+        if is_staging_unchanged(context, self.stage_task_ids):
+            raise AirflowSkipException("Staging data has not been changed. Load SKIPPED.")
+
+        telemetry = OperatorTelemetry(self.task_id, self.target_table_name, self.telemetry_path,
+                                      conn_id=self.redshift_conn_id)
+        with telemetry.phase("credentials"):
+            credentials = get_aws_credentials(self.aws_credentials_id)
+        s3_hook = get_s3_hook(self.aws_credentials_id)
+        output_folder = "{}/{}/{}".format(self.output_prefix, self.target_table_name, context["ts_nodash"])
+
+        self.log.info("Setting up Redshift connection")
+        with redshift_session(self.redshift_conn_id, operation="load",
+                              priority=self.priority_weight, owner=self.task_id) as redshift:
+            telemetry.add_phase("connect", redshift.checkout_seconds)
+            telemetry.add_phase("queue", redshift.queue_seconds)
+            self.log.info("Redshift connection created.")
+
+            # Compute batches of new keys and write them to S3
+            objects = []
+            for buffer in self.build_batches(redshift, telemetry):
+                object_key = "{}/part-{:05d}.csv.gz".format(output_folder, len(objects))
+                with telemetry.phase("upload"):
+                    s3_hook.load_bytes(buffer, key=object_key, bucket_name=self.output_bucket, replace=True)
+                objects.append({"key": object_key, "size": len(buffer)})
+            if not objects:
+                self.log.info("No new timestamps in {}. Redshift COPY operation SKIPPED.".format(self.staging_table))
+            else:
+                manifest_key = "{}/time.manifest".format(output_folder)
+                s3_hook.load_string(build_copy_manifest(self.output_bucket, objects),
+                                    key=manifest_key,
+                                    bucket_name=self.output_bucket,
+                                    replace=True)
+                self.log.info("Executing Redshift COPY operation for {} files".format(len(objects)))
+                telemetry.run(redshift, LoadTimeDimensionOperator.copy_query.format(
+                                            target_table_name = self.target_table_name,
+                                            target_table_fields = SqlQueries.time_table_fields,
+                                            manifest_path = "s3://{}/{}".format(self.output_bucket, manifest_key),
+                                            access_key = credentials.access_key,
+                                            secret_key = credentials.secret_key))
+        self.log.info("Redshift SQL operation DONE in dimension table {}.".format(self.target_table_name))
+        telemetry.publish(context, self.log)
+        if self.scope_sql:
+            push_load_scope(context, self.target_table_name, self.scope_sql)
+
+    def build_batches(self, redshift, telemetry):
+        """
+        Reads new timestamps of staging table in batches and yields gzip compressed CSV rows of time table.
+        """
+        # NumPy is imported at run of task, not at parsing of DAG
+        from helpers.time_dimension import time_csv
+
+        query = SqlQueries.time_table_new_seconds.format(staging_table = self.staging_table,
+                                                         target_table_name = self.target_table_name)
+        batches = redshift.fetch_batches(query, self.batch_size)
+        while True:
+            with telemetry.phase("query"):
+                records = next(batches, None)
+            if records is None:
+                return
+            with telemetry.phase("compute"):
+                buffer = gzip.compress(time_csv([seconds for (seconds,) in records]),
+                                       compresslevel=LoadTimeDimensionOperator.compress_level)
+            self.log.info("Computed {} rows of time table".format(len(records)))
+            yield buffer
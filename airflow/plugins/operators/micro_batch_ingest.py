@@ -0,0 +1,282 @@
+import datetime
+import re
+from airflow.utils.decorators import apply_defaults
+from airflow.exceptions import AirflowSkipException
+from helpers.s3_manifest import list_s3_objects, build_copy_manifest
+from helpers.micro_batch import select_micro_batch
+from helpers.aws_hooks import get_s3_hook, get_aws_credentials
+from helpers.sql_literals import sql_literal
+from helpers.redshift_pool import redshift_session
+from helpers.telemetry import OperatorTelemetry
+from operators.stage_redshift import StageToRedshiftOperator
+
+class MicroBatchIngestOperator(StageToRedshiftOperator):
+    """
+    Ingest new objects of event log stream (e.g. Kinesis Firehose prefix) in micro-batches with bounded latency.
+    Every micro-batch runs in one session and one transaction:
+    - Lock table of high-water marks and read key of last loaded object of stream
+    - List objects of stream prefix after high-water mark (S3 lists keys in order, so only new keys are listed)
+    - Take objects in order of keys until batch size or number of objects is reached; batch waits for more
+      objects until its oldest object has waited max_wait_minutes
+    - Write COPY manifest of batch and copy it into temp table shadowing own staging table of stream
+      (staging_table) in session, so concurrent batches and daily staging do not share rows
+    - Run statements after COPY (e.g. start_time) and sql scripts of load operators (users, time, songplays);
+      their sql reads load_source_table (staging_events of daily loads), which is replaced by staging table of stream
+    - Move high-water mark to last key of batch, drop temp staging table and commit
+    COPY, loads and high-water mark are committed together, so every object is loaded exactly once:
+    failed batch is rolled back whole and loaded again by next run. Ready batches are loaded one after another,
+    at most max_batches_per_run in one run of task.
+    Keys of stream objects must grow with time of arrival (as Firehose names objects by time), object with key
+    before high-water mark is not listed.
+    Latency of event is at most max_wait_minutes + schedule interval of DAG + time of loading of batch.
+
+    redshift_conn_id - name of Rendsift connection in Airflow
+    aws_credentials_id - name of AWS connection in Airflow
+    staging_table - own staging table of stream, template of temp staging table of batch
+    load_source_table - name of staging table in sql of loads and in post_copy_sql, replaced by name
+                        of staging_table (without schema)
+    s3_bucket - name of bucket of stream
+    s3_key - prefix of stream objects in bucket
+    json_paths - name of json paths in bucket
+    stream_name - name of stream in table of high-water marks; "" for bucket and prefix of stream
+    manifest_bucket - name of bucket with write access for COPY manifests
+    manifest_prefix - name of folder in manifest bucket
+    high_water_mark_table - table with key of last loaded object of every stream
+    max_batch_mb - maximum size of batch in MB
+    max_batch_objects - maximum number of objects in batch
+    max_wait_minutes - maximum time for which object waits until batch is full
+    max_batches_per_run - maximum number of batches loaded by one run of task (catching up after delay)
+    loads - list of loads applied to every batch in order of dependencies, every load is dictionary
+            with name of 'operator' (LoadDimensionOperator, LoadFactOperator) and its 'params'
+    copy_columns - list of columns of staging table loaded by COPY; None to load all columns
+    post_copy_sql - list of sql statements run after COPY in the same transaction (e.g. computed columns)
+    """
+
+    ui_color = '#4A9A6E'
+    template_fields = ("manifest_bucket",)
+
+    high_water_mark_lock = ("LOCK {high_water_mark_table}")
+
+    high_water_mark_select = ("""
+        SELECT object_key, batch_count, object_count
+        FROM {high_water_mark_table}
+        WHERE stream_name = {stream_name}
+    """)
+
+    high_water_mark_delete = ("""
+        DELETE FROM {high_water_mark_table}
+        WHERE stream_name = {stream_name}
+    """)
+
+    high_water_mark_insert = ("""
+        INSERT INTO {high_water_mark_table} (stream_name, object_key, last_modified, batch_count, object_count, loaded_at)
+        VALUES ({stream_name}, {object_key}, {last_modified}, {batch_count}, {object_count}, GETDATE())
+    """)
+
+    stage_table_create = ("CREATE TEMP TABLE {stage_table_name} (LIKE {staging_table})")
+
+    stage_table_drop = ("DROP TABLE {stage_table_name}")
+
+    @apply_defaults
+    def __init__(self,
+                 redshift_conn_id="",
+                 aws_credentials_id="",
+                 staging_table="public.staging_events",
+                 load_source_table="staging_events",
+                 s3_bucket="",
+                 s3_key="",
+                 json_paths="\'auto\'",
+                 stream_name="",
+                 manifest_bucket="",
+                 manifest_prefix="manifests",
+                 high_water_mark_table="public.stream_high_water_mark",
+                 max_batch_mb=64,
+                 max_batch_objects=1000,
+                 max_wait_minutes=5,
+                 max_batches_per_run=12,
+                 loads=None,
+                 copy_columns=None,
+                 post_copy_sql=None,
+                 telemetry_path="",
+                 *args, **kwargs):
+
+        super(MicroBatchIngestOperator, self).__init__(redshift_conn_id=redshift_conn_id,
+                                                       aws_credentials_id=aws_credentials_id,
+                                                       target_table=staging_table,
+                                                       s3_bucket=s3_bucket,
+                                                       s3_key=s3_key,
+                                                       json_paths=json_paths,
+                                                       manifest_bucket=manifest_bucket,
+                                                       manifest_prefix=manifest_prefix,
+                                                       copy_columns=copy_columns,
+                                                       post_copy_sql=post_copy_sql,
+                                                       telemetry_path=telemetry_path,
+                                                       *args, **kwargs)
+        self.load_source_table = load_source_table
+        self.post_copy_sql = [self.render_stream_sql(sql) for sql in self.post_copy_sql]
+        self.stream_name = stream_name or "{}/{}".format(s3_bucket, s3_key)
+        self.high_water_mark_table = high_water_mark_table
+        self.max_batch_mb = max_batch_mb
+        self.max_batch_objects = max_batch_objects
+        self.max_wait_minutes = max_wait_minutes
+        self.max_batches_per_run = max_batches_per_run
+        self.loads = loads or []
+
+    @property
+    def stage_table_name(self):
+        """
+        Name of temp staging table of batch: name of staging table without schema, so it shadows staging table.
+        """
+        return self.target_table.split(".")[-1]
+
+    def render_stream_sql(self, sql):
+        """
+        Replaces load_source_table (not qualified by schema) in sql by temp staging table of batch.
+        """
+        return re.sub(r"(?<![\w.]){}\b".format(re.escape(self.load_source_table)), self.stage_table_name, sql)
+
+    def execute(self, context):
+        self.telemetry = OperatorTelemetry(self.task_id, self.target_table, self.telemetry_path,
+                                           conn_id=self.redshift_conn_id)
+        with self.telemetry.phase("credentials"):
+            credentials = get_aws_credentials(self.aws_credentials_id)
+        s3_hook = get_s3_hook(self.aws_credentials_id)
+        load_operators = self.get_load_operators()
+
+        batches = []
+        while len(batches) < self.max_batches_per_run:
+            self.log.info("Setting up Redshift connection")
+            with redshift_session(self.redshift_conn_id, operation="copy",
+                                  priority=self.priority_weight, owner=self.task_id) as redshift:
+                self.telemetry.add_phase("connect", redshift.checkout_seconds)
+                self.telemetry.add_phase("queue", redshift.queue_seconds)
+                batch = self.ingest_batch(redshift, s3_hook, credentials, load_operators)
+            if batch is None:
+                break
+            # Latency is measured after commit: from arrival of oldest object of batch to its visibility in tables
+            batch["latency_seconds"] = (datetime.datetime.now(datetime.timezone.utc) -
+                                        batch.pop("oldest_last_modified")).total_seconds()
+            self.log.info("Batch {batch_no} committed: {objects} objects, {bytes} bytes, keys {first_key} - {last_key}, "
+                          "latency {latency_seconds:.0f} s".format(**batch))
+            batches.append(batch)
+        self.telemetry.publish(context, self.log)
+        context["ti"].xcom_push(key="micro_batches", value=batches)
+        if not batches:
+            raise AirflowSkipException("No micro-batch is ready. Ingestion SKIPPED.")
+
+    def get_load_operators(self):
+        """
+        Creates load operators of batch without DAG, they only render sql scripts here.
+        Sql parameters of loads read staging table of stream instead of load_source_table.
+        """
+        import operators
+
+        return [getattr(operators, load["operator"])(
+                    task_id="{}_{}".format(self.task_id, load["params"]["target_table_name"].replace(".", "_")),
+                    **{name: self.render_stream_sql(value) if isinstance(value, str) else value
+                       for name, value in load["params"].items()})
+                for load in self.loads]
+
+    def ingest_batch(self, redshift, s3_hook, credentials, load_operators):
+        """
+        Copies next ready micro-batch and applies loads to it in session.
+        Returns summary of batch, or None if no batch is ready.
+        """
+        high_water_mark = self.read_high_water_mark(redshift)
+        self.log.info("High-water mark of stream {}: {}".format(self.stream_name, high_water_mark["object_key"]))
+        with self.telemetry.phase("list"):
+            objects = list_s3_objects(s3_hook.get_conn(), self.s3_bucket, self.s3_key,
+                                      start_after=high_water_mark["object_key"])
+        batch, ready = self.select_batch(objects, datetime.datetime.now(datetime.timezone.utc))
+        if not ready:
+            self.log.info("Objects after high-water mark: {}. Batch is not ready, waiting for next run.".format(
+                                len(objects)))
+            return None
+
+        # Manifest name depends on number of batch, so retry of failed batch overwrites it
+        batch_no = high_water_mark["batch_count"] + 1
+        manifest_key = "{}/{}/batch-{:08d}.manifest".format(self.manifest_prefix, self.stream_name, batch_no)
+        s3_hook.load_string(build_copy_manifest(self.s3_bucket, batch),
+                            key=manifest_key,
+                            bucket_name=self.manifest_bucket,
+                            replace=True)
+        manifest_path = "s3://{}/{}".format(self.manifest_bucket, manifest_key)
+        self.log.info("Executing Redshift COPY operation for batch {} of {} objects".format(batch_no, len(batch)))
+        self.telemetry.run(redshift, [
+            MicroBatchIngestOperator.stage_table_create.format(stage_table_name = self.stage_table_name,
+                                                               staging_table = self.target_table),
+            StageToRedshiftOperator.sql_template_json_manifest.format(
+                self.render_copy_target(self.stage_table_name),
+                manifest_path,
+                credentials.access_key,
+                credentials.secret_key,
+                self.render_json_path())
+        ])
+        self.run_post_copy(redshift)
+        for operator in load_operators:
+            self.log.info("Executing Redshift SQL operation in table {}".format(operator.target_table_name))
+            self.telemetry.run(redshift, self.render_load_sql(redshift, operator), phase=operator.task_id)
+        self.telemetry.run(redshift,
+                           self.render_high_water_mark_update(high_water_mark, batch) +
+                           [MicroBatchIngestOperator.stage_table_drop.format(stage_table_name = self.stage_table_name)],
+                           phase="high_water_mark")
+        return {"batch_no": batch_no,
+                "objects": len(batch),
+                "bytes": sum(obj["size"] for obj in batch),
+                "first_key": batch[0]["key"],
+                "last_key": batch[-1]["key"],
+                "oldest_last_modified": min(obj["last_modified"] for obj in batch)}
+
+    def read_high_water_mark(self, redshift):
+        """
+        Locks table of high-water marks until end of transaction (batches of stream are loaded one at a time)
+        and reads high-water mark of stream.
+        Returns dictionary with key of last loaded object (None for new stream), numbers of loaded batches and objects.
+        """
+        redshift.run(MicroBatchIngestOperator.high_water_mark_lock.format(
+                        high_water_mark_table = self.high_water_mark_table))
+        record = redshift.get_first(MicroBatchIngestOperator.high_water_mark_select.format(
+                                        high_water_mark_table = self.high_water_mark_table,
+                                        stream_name = sql_literal(self.stream_name)))
+        if record is None:
+            return {"object_key": None, "batch_count": 0, "object_count": 0}
+        object_key, batch_count, object_count = record
+        return {"object_key": object_key, "batch_count": batch_count, "object_count": object_count}
+
+    def select_batch(self, objects, now):
+        """
+        Selects next micro-batch from objects after high-water mark.
+        Returns pair of batch and flag if batch is ready to load.
+        """
+        return select_micro_batch(objects,
+                                  max_batch_bytes=self.max_batch_mb * 1024 * 1024,
+                                  max_batch_objects=self.max_batch_objects,
+                                  max_wait=datetime.timedelta(minutes=self.max_wait_minutes),
+                                  now=now)
+
+    def render_load_sql(self, redshift, operator):
+        """
+        Renders sql script of load operator for batch in session.
+        Fact load in 'window' mode reads window of batch from temp staging table first.
+        """
+        if getattr(operator, "insert_mode", None) == "window":
+            window = operator.read_window(redshift)
+            window_loaded = window is not None and operator.is_window_loaded(redshift, window)
+            return operator.render_sql(window, window_loaded)
+        return operator.render_sql()
+
+    def render_high_water_mark_update(self, high_water_mark, batch):
+        """
+        Renders sql statements that move high-water mark of stream to last object of batch.
+        """
+        stream_name = sql_literal(self.stream_name)
+        return [MicroBatchIngestOperator.high_water_mark_delete.format(
+                    high_water_mark_table = self.high_water_mark_table,
+                    stream_name = stream_name),
+                MicroBatchIngestOperator.high_water_mark_insert.format(
+                    high_water_mark_table = self.high_water_mark_table,
+                    stream_name = stream_name,
+                    object_key = sql_literal(batch[-1]["key"]),
+                    last_modified = sql_literal(max(obj["last_modified"] for obj in batch)),
+                    batch_count = high_water_mark["batch_count"] + 1,
+                    object_count = high_water_mark["object_count"] + len(batch))]
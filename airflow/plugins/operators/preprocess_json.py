@@ -0,0 +1,147 @@
+import math
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
+from helpers.s3_manifest import list_s3_objects, build_copy_manifest, split_objects_by_size
+from helpers.aws_hooks import get_s3_hook
+from helpers.json_records import parse_json_paths, iter_json_objects, extract_fields, write_csv_gzip
+
+
+def convert_objects(aws_credentials_id, s3_bucket, object_keys, paths, output_bucket, output_key):
+    """
+    Converts group of raw JSON objects in S3 into one gzip compressed CSV file.
+    Runs in worker process, so it opens its own S3 connection.
+    Returns statistics of converted file.
+    """
+    s3_hook = get_s3_hook(aws_credentials_id)
+    rows = []
+    raw_bytes = 0
+    for object_key in object_keys:
+        text = s3_hook.read_key(object_key, bucket_name=s3_bucket)
+        raw_bytes += len(text.encode("utf-8"))
+        rows.extend(extract_fields(record, paths) for record in iter_json_objects(text))
+    body = write_csv_gzip(rows)
+    s3_hook.load_bytes(body, key=output_key, bucket_name=output_bucket, replace=True)
+    return {"key": output_key, "rows": len(rows), "raw_bytes": raw_bytes, "size": len(body)}
+
+
+class PreprocessJsonOperator(BaseOperator):
+    """
+    Converts raw JSON objects from S3 into gzip compressed CSV files before COPY to staging table.
+    - List raw objects in S3 folder
+    - Read JSONPaths file (or use list of columns for 'auto' mapping)
+    - Coalesce small objects into files of target size, number of files is multiple of number of slices
+    - Convert groups of objects in pool of processes and write files to output bucket
+    - Write COPY manifest and publish its path to XCom (key 'manifest_path')
+    StageToRedshiftOperator copies converted files with manifest_path pulled from XCom.
+
+    Operator is opt-in and is not used by DAGs of project: it converts every object of folder on each run,
+    while incremental staging copies only new objects by ledger. It pays off for full loads of folder
+    with many small files (first load of song catalog, rebuild of staging area).
+
+    aws_credentials_id - name of AWS connection in Airflow
+    target_table - staging table that will be loaded from converted files
+    s3_bucket - name of bucket with raw objects
+    s3_key - name of folder (or object) in bucket
+    json_paths - name of json paths in bucket; "" for mapping by column_names
+    column_names - names of columns of staging table in order of table, used for 'auto' mapping
+    output_bucket - name of bucket with write access for converted files
+    output_prefix - name of folder in output bucket
+    target_file_size_mb - target size of raw data in one converted file
+    slice_count - number of slices in Redshift cluster
+    max_processes - number of processes converting files
+    """
+
+    ui_color = '#6FA8DC'
+    template_fields = ("s3_key", "output_bucket")
+
+    @apply_defaults
+    def __init__(self,
+                 aws_credentials_id="",
+                 target_table="",
+                 s3_bucket="",
+                 s3_key="",
+                 json_paths="",
+                 column_names=None,
+                 output_bucket="",
+                 output_prefix="preprocessed",
+                 target_file_size_mb=64,
+                 slice_count=2,
+                 max_processes=4,
+                 *args, **kwargs):
+
+        super(PreprocessJsonOperator, self).__init__(*args, **kwargs)
+        self.aws_credentials_id = aws_credentials_id
+        self.target_table = target_table
+        self.s3_bucket = s3_bucket
+        self.s3_key = s3_key
+        self.json_paths = json_paths
+        self.column_names = column_names
+        self.output_bucket = output_bucket
+        self.output_prefix = output_prefix
+        self.target_file_size_mb = target_file_size_mb
+        self.slice_count = slice_count
+        self.max_processes = max_processes
+
+    def execute(self, context):
+        # multiprocessing is imported at run of task, not at parsing of DAG
+        from concurrent.futures import ProcessPoolExecutor
+
+        self.log.info("Setting up S3 connection")
+        s3_hook = get_s3_hook(self.aws_credentials_id)
+
+        # Read mapping of JSON fields to columns
+        if self.json_paths == "":
+            paths = [[column] for column in self.column_names]
+        else:
+            paths = parse_json_paths(s3_hook.read_key(self.json_paths, bucket_name=self.s3_bucket))
+        self.log.info("Columns in converted files: {}".format(len(paths)))
+
+        # List raw objects and group them into files
+        self.log.info("Listing objects in s3://{}/{}".format(self.s3_bucket, self.s3_key))
+        objects = list_s3_objects(s3_hook.get_conn(), self.s3_bucket, self.s3_key)
+        if not objects:
+            raise ValueError("No objects in s3://{}/{}".format(self.s3_bucket, self.s3_key))
+        raw_size = sum(obj["size"] for obj in objects)
+        groups = self.group_objects(objects)
+        self.log.info("Objects: {}. Raw bytes: {}. Converted files: {}".format(len(objects), raw_size, len(groups)))
+
+        # Convert groups of objects in pool of processes
+        output_folder = "{}/{}/{}".format(self.output_prefix, self.target_table, context["ts_nodash"])
+        with ProcessPoolExecutor(max_workers=self.max_processes) as executor:
+            futures = [executor.submit(convert_objects,
+                                       self.aws_credentials_id,
+                                       self.s3_bucket,
+                                       [obj["key"] for obj in group],
+                                       paths,
+                                       self.output_bucket,
+                                       "{}/part-{:05d}.csv.gz".format(output_folder, file_no))
+                       for file_no, group in enumerate(groups)]
+            files = [future.result() for future in futures]
+
+        rows = sum(converted["rows"] for converted in files)
+        output_size = sum(converted["size"] for converted in files)
+        self.log.info("Converted rows: {}. Raw bytes: {}. Compressed CSV bytes: {} ({:.1%} of raw)".format(
+                            rows, raw_size, output_size, output_size / raw_size if raw_size else 0))
+
+        # Write COPY manifest of converted files
+        manifest_key = "{}/manifest".format(output_folder)
+        s3_hook.load_string(build_copy_manifest(self.output_bucket, files),
+                            key=manifest_key,
+                            bucket_name=self.output_bucket,
+                            replace=True)
+        manifest_path = "s3://{}/{}".format(self.output_bucket, manifest_key)
+        self.log.info("MANIFEST_PATH: {}".format(manifest_path))
+        context["ti"].xcom_push(key="manifest_path", value=manifest_path)
+        context["ti"].xcom_push(key="preprocess_stats",
+                                value={"objects": len(objects), "files": len(files), "rows": rows,
+                                       "raw_bytes": raw_size, "output_bytes": output_size})
+
+    def group_objects(self, objects):
+        """
+        Groups raw objects into converted files of target size balanced by size,
+        number of files is multiple of number of slices.
+        """
+        raw_size = sum(obj["size"] for obj in objects)
+        file_count = math.ceil(raw_size / (self.target_file_size_mb * 1024 * 1024))
+        file_count = max(self.slice_count, math.ceil(file_count / self.slice_count) * self.slice_count)
+        return split_objects_by_size(objects, file_count)
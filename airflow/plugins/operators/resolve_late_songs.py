@@ -0,0 +1,266 @@
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
+from airflow.exceptions import AirflowSkipException
+from helpers.sql_queries import SqlQueries
+from helpers.change_signal import is_staging_unchanged, pull_load_scopes
+from helpers.redshift_pool import redshift_session
+from helpers.telemetry import OperatorTelemetry
+
+class ResolveLateSongsOperator(BaseOperator):
+    """
+    Fills song_id and artist_id of songplays loaded before their song or artist was in catalog.
+    Fact load joins events with songs and artists by keys of title, duration and artist name, so events of songs
+    that arrive later get NULL song_id or artist_id and NOT EXISTS of fact load never revisits them.
+    Keys of such events are kept in compact pending table, and only pending rows that songs and artists
+    loaded in the run can resolve are patched, so cost follows number of new songs instead of size of fact table:
+    - Read scopes of songs and artists loaded in run (published by song catalog load)
+    - Match pending rows with new songs and new artists only (songs and artists in scopes) into temp table
+    - Copy matched songplays to delta table twice: with current keys and sign -1, with filled keys and sign 1,
+      so Maintain_aggregates moves their plays from groups of old keys to groups of new keys in rollups
+    - Fill NULL song_id and artist_id of matched songplays (UPDATE by key and start_time)
+    - Delete pending rows whose songplays are resolved completely
+    - Capture events of staging batch without song or artist in catalog (fact load of run inserted them with NULL
+      song_id or artist_id) into pending table
+    - Delete pending rows older than pending_retention_days (songs that never arrive)
+    All statements run in one transaction. Task is skipped if neither catalog nor staging events have changed.
+
+    redshift_conn_id - name of Rendsift connection in Airflow
+    fact_table - fact table, songplays
+    fact_table_fields - columns of fact table copied to delta table
+    delta_table - delta table folded into rollups by AggregateMaintenanceOperator (column sign: 1 adds row to
+                  rollups, -1 removes it); "" to not copy patched rows
+    pending_table - table of unresolved songplays with keys of their events
+    song_table_name - name of songs table
+    artist_table_name - name of artists table
+    catalog_task_ids - list of task ids loading songs and artists; their scopes (XCom 'load_scope') are new songs and artists
+    stage_task_ids - list of staging task ids of events; capture is skipped if all of them report unchanged staging
+    capture_sql - sql query returning unresolved events of staging batch: songplay_id, start_time, song_key,
+                  length_key, artist_key ({song_table_name} and {artist_table_name} are catalog tables)
+    pending_retention_days - days after which pending rows are dropped unresolved
+    """
+
+    ui_color = '#F7B267'
+
+    song_match_join = ("""
+        LEFT JOIN (SELECT title_key, duration_key, min(song_id) AS song_id
+                   FROM {song_table_name}
+                   WHERE song_id IN ({song_scope_sql})
+                   GROUP BY title_key, duration_key) new_songs
+               ON new_songs.title_key = pending.song_key
+              AND new_songs.duration_key = pending.length_key
+    """)
+
+    artist_match_join = ("""
+        LEFT JOIN (SELECT name_key, min(artist_id) AS artist_id
+                   FROM {artist_table_name}
+                   WHERE artist_id IN ({artist_scope_sql})
+                   GROUP BY name_key) new_artists
+               ON new_artists.name_key = pending.artist_key
+    """)
+
+    resolved_create_query = ("""
+        CREATE TEMP TABLE {resolved_table_name} AS
+        SELECT pending.songplay_id, pending.start_time, {song_id_field} AS song_id, {artist_id_field} AS artist_id
+        FROM {pending_table} pending
+        {match_joins}
+        WHERE {song_id_field} IS NOT NULL OR {artist_id_field} IS NOT NULL
+    """)
+
+    delta_insert_query = ("""
+        INSERT INTO {delta_table} ({fact_table_fields}, sign)
+        SELECT {signed_fields}, signed.sign
+        FROM {fact_table}
+        JOIN {resolved_table_name} resolved
+          ON {fact_table}.songplay_id = resolved.songplay_id
+         AND {fact_table}.start_time = resolved.start_time
+        CROSS JOIN (SELECT -1 AS sign UNION ALL SELECT 1 AS sign) signed
+        WHERE ({fact_table}.song_id IS NULL AND resolved.song_id IS NOT NULL)
+           OR ({fact_table}.artist_id IS NULL AND resolved.artist_id IS NOT NULL)
+    """)
+
+    # keys filled by UPDATE of fact table: new value in row with sign 1, current value in row with sign -1
+    signed_key_field = ("""
+        CASE WHEN signed.sign = 1 THEN COALESCE({fact_table}.{field}, resolved.{field}) ELSE {fact_table}.{field} END
+    """)
+
+    resolved_key_fields = ["song_id", "artist_id"]
+
+    fact_update_query = ("""
+        UPDATE {fact_table}
+        SET song_id = COALESCE({fact_table}.song_id, resolved.song_id),
+            artist_id = COALESCE({fact_table}.artist_id, resolved.artist_id)
+        FROM {resolved_table_name} resolved
+        WHERE {fact_table}.songplay_id = resolved.songplay_id
+          AND {fact_table}.start_time = resolved.start_time
+          AND (({fact_table}.song_id IS NULL AND resolved.song_id IS NOT NULL)
+               OR ({fact_table}.artist_id IS NULL AND resolved.artist_id IS NOT NULL))
+    """)
+
+    pending_delete_query = ("""
+        DELETE FROM {pending_table}
+        WHERE songplay_id IN (SELECT fact.songplay_id
+                              FROM {fact_table} fact
+                              JOIN {resolved_table_name} resolved
+                                ON fact.songplay_id = resolved.songplay_id
+                               AND fact.start_time = resolved.start_time
+                              WHERE fact.song_id IS NOT NULL AND fact.artist_id IS NOT NULL)
+    """)
+
+    drop_query = ("DROP TABLE {table_name}")
+
+    pending_insert_query = ("""
+        INSERT INTO {pending_table} (songplay_id, start_time, song_key, length_key, artist_key, captured_at)
+        SELECT unresolved.songplay_id, unresolved.start_time, unresolved.song_key, unresolved.length_key,
+               unresolved.artist_key, GETDATE()
+        FROM ({capture_sql}) unresolved
+        WHERE NOT EXISTS (SELECT 1
+                          FROM {pending_table}
+                          WHERE {pending_table}.songplay_id = unresolved.songplay_id)
+    """)
+
+    pending_retention_query = ("""
+        DELETE FROM {pending_table}
+        WHERE captured_at < GETDATE() - INTERVAL '{pending_retention_days} days'
+    """)
+
+    pending_count_query = ("SELECT count(1) FROM {pending_table}")
+
+    @apply_defaults
+    def __init__(self,
+                 redshift_conn_id="",
+                 fact_table="songplays",
+                 fact_table_fields=SqlQueries.songplay_table_fields,
+                 delta_table="songplays_delta",
+                 pending_table="songplays_unresolved",
+                 song_table_name="songs",
+                 artist_table_name="artists",
+                 catalog_task_ids=None,
+                 stage_task_ids=None,
+                 capture_sql=SqlQueries.songplay_unresolved_select,
+                 pending_retention_days=90,
+                 telemetry_path="",
+                 *args, **kwargs):
+
+        super(ResolveLateSongsOperator, self).__init__(*args, **kwargs)
+        self.redshift_conn_id = redshift_conn_id
+        self.fact_table = fact_table
+        self.fact_table_fields = fact_table_fields
+        self.delta_table = delta_table
+        self.pending_table = pending_table
+        self.song_table_name = song_table_name
+        self.artist_table_name = artist_table_name
+        self.catalog_task_ids = catalog_task_ids or []
+        self.stage_task_ids = stage_task_ids
+        self.capture_sql = capture_sql
+        self.pending_retention_days = pending_retention_days
+        self.telemetry_path = telemetry_path
+
+    def execute(self, context):
+        scopes = pull_load_scopes(context, self.catalog_task_ids)
+        song_scope_sql = scopes.get(self.short_name(self.song_table_name))
+        artist_scope_sql = scopes.get(self.short_name(self.artist_table_name))
+        capture = not is_staging_unchanged(context, self.stage_task_ids)
+        if not song_scope_sql and not artist_scope_sql and not capture:
+            raise AirflowSkipException("Catalog and staging events have not been changed. Late binding SKIPPED.")
+        telemetry = OperatorTelemetry(self.task_id, self.fact_table, self.telemetry_path, conn_id=self.redshift_conn_id)
+
+        self.log.info("Setting up Redshift connection")
+        report = {"patched_rows": 0, "captured_rows": 0}
+        with redshift_session(self.redshift_conn_id, operation="load",
+                              priority=self.priority_weight, owner=self.task_id) as redshift:
+            telemetry.add_phase("connect", redshift.checkout_seconds)
+            telemetry.add_phase("queue", redshift.queue_seconds)
+            if song_scope_sql or artist_scope_sql:
+                self.log.info("Resolving pending songplays with new {}".format(
+                                  " and ".join(table_name for table_name, scope_sql in
+                                               (("songs", song_scope_sql), ("artists", artist_scope_sql))
+                                               if scope_sql)))
+                statements, update_index = self.render_resolve_sql(song_scope_sql, artist_scope_sql)
+                report["patched_rows"] = telemetry.run(redshift, statements, phase="resolve")[update_index]
+            if capture:
+                report["captured_rows"] = telemetry.run(redshift, self.render_capture_sql(), phase="capture")[0]
+            report["expired_rows"] = telemetry.run(redshift, ResolveLateSongsOperator.pending_retention_query.format(
+                                                       pending_table = self.pending_table,
+                                                       pending_retention_days = int(self.pending_retention_days)),
+                                                   phase="retention")[0]
+            report["pending_rows"] = redshift.get_first(ResolveLateSongsOperator.pending_count_query.format(
+                                                            pending_table = self.pending_table))[0]
+        self.log.info("Late binding: {} songplays patched, {} captured, {} expired, {} pending".format(
+                          report["patched_rows"], report["captured_rows"], report["expired_rows"],
+                          report["pending_rows"]))
+        context["ti"].xcom_push(key="late_binding", value=report)
+        telemetry.publish(context, self.log)
+
+    @staticmethod
+    def short_name(table_name):
+        """
+        Returns name of table without schema and quotes, as in scopes of loads.
+        """
+        return table_name.split(".")[-1].strip('"')
+
+    def resolved_table_name(self):
+        """
+        Returns name of temp table with matched pending rows.
+        """
+        return "{}_resolved".format(self.short_name(self.pending_table))
+
+    def render_resolve_sql(self, song_scope_sql=None, artist_scope_sql=None):
+        """
+        Renders list of sql statements: match of pending rows with new songs and artists, copy of matched songplays
+        to delta table (if delta_table is set), UPDATE of fact table, delete of resolved pending rows and drop
+        of temp table. Tables without scope are not matched.
+        Returns list of sql statements and index of UPDATE of fact table in it (its row count is number
+        of patched songplays).
+        """
+        match_joins = []
+        song_id_field = artist_id_field = "CAST(NULL AS varchar(256))"
+        if song_scope_sql:
+            match_joins.append(ResolveLateSongsOperator.song_match_join.format(
+                                   song_table_name = self.song_table_name,
+                                   song_scope_sql = song_scope_sql))
+            song_id_field = "new_songs.song_id"
+        if artist_scope_sql:
+            match_joins.append(ResolveLateSongsOperator.artist_match_join.format(
+                                   artist_table_name = self.artist_table_name,
+                                   artist_scope_sql = artist_scope_sql))
+            artist_id_field = "new_artists.artist_id"
+        params = dict(fact_table = self.fact_table,
+                      pending_table = self.pending_table,
+                      resolved_table_name = self.resolved_table_name())
+        statements = [ResolveLateSongsOperator.resolved_create_query.format(song_id_field = song_id_field,
+                                                                           artist_id_field = artist_id_field,
+                                                                           match_joins = "".join(match_joins),
+                                                                           **params)]
+        if self.delta_table:
+            statements.append(ResolveLateSongsOperator.delta_insert_query.format(
+                                  delta_table = self.delta_table,
+                                  fact_table_fields = self.fact_table_fields,
+                                  signed_fields = self.render_signed_fields(),
+                                  **params))
+        update_index = len(statements)
+        statements += [ResolveLateSongsOperator.fact_update_query.format(**params),
+                       ResolveLateSongsOperator.pending_delete_query.format(**params),
+                       ResolveLateSongsOperator.drop_query.format(table_name = self.resolved_table_name())]
+        return statements, update_index
+
+    def render_signed_fields(self):
+        """
+        Renders select list of fact table fields for delta table, song_id and artist_id depend on sign of row.
+        """
+        fields = []
+        for field in [field.strip() for field in self.fact_table_fields.split(",")]:
+            if field in ResolveLateSongsOperator.resolved_key_fields:
+                fields.append(ResolveLateSongsOperator.signed_key_field.format(fact_table = self.fact_table,
+                                                                              field = field).strip())
+            else:
+                fields.append("{}.{}".format(self.fact_table, field))
+        return ", ".join(fields)
+
+    def render_capture_sql(self):
+        """
+        Renders sql statement saving unresolved events of staging batch to pending table.
+        """
+        return ResolveLateSongsOperator.pending_insert_query.format(
+                   pending_table = self.pending_table,
+                   capture_sql = self.capture_sql.format(song_table_name = self.song_table_name,
+                                                         artist_table_name = self.artist_table_name))
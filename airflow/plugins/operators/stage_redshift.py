@@ -1,8 +1,15 @@
 import datetime
-from airflow.hooks.postgres_hook import PostgresHook
+import json
+from contextlib import contextmanager
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
-from airflow.contrib.hooks.aws_hook import AwsHook
+from helpers.s3_manifest import list_s3_objects, object_fingerprint, select_new_objects, build_copy_manifest, \
+                                split_objects_by_size, split_objects_into_chunks
+from helpers.change_signal import push_staging_changed
+from helpers.aws_hooks import get_s3_hook, get_aws_credentials
+from helpers.sql_literals import sql_literal
+from helpers.redshift_pool import get_pool, redshift_session
+from helpers.telemetry import OperatorTelemetry
 
 class StageToRedshiftOperator(BaseOperator):
     """
@@ -16,6 +23,48 @@ class StageToRedshiftOperator(BaseOperator):
     - Preparation sql script from template
     - Copy from S3 to staging table
 
+    In incremental mode only objects that are new or changed since last load are copied:
+    - List objects in S3 folder
+    - Compare them with ledger of loaded objects (object key and ETag)
+    - Write COPY manifest with new objects to manifest bucket
+    - Copy objects from manifest and update ledger in one transaction
+    If there are no new objects, COPY is skipped and staging table is left empty.
+
+    In mode with skipping unchanged partitions fingerprint (ETag, size, last modified time)
+    of partition object is compared with ledger. If partition has not been changed since last load,
+    DELETE and COPY are skipped and staging table keeps the same data.
+    Both modes publish signal "staging_changed" to XCom, so load and data quality tasks can short-circuit.
+
+    In sharded mode objects of folder are split into shard_count manifests balanced by size
+    (shard_count should be multiple of number of slices) and copied concurrently into per-shard staging tables:
+    - Manifests of run are written once, retries of task reuse them
+    - Every shard is copied in its own transaction together with checkpoint row, at most max_concurrency at once;
+      with limit of WLM slots every shard session waits for its own lease of COPY
+    - Shards that are checkpointed for run are not copied again on retry, so only failed shards are re-copied
+    - When all shards are loaded, staging table is replaced by union of shards in one transaction
+
+    In resumable mode objects of folder (or only new objects with incremental load) are copied into staging table
+    in chunks of consecutive objects, so failure of one object does not cost full reload on every retry:
+    - Plan of chunks is written to manifest bucket once, retries of task copy the same chunks
+    - Staging table is cleared by first attempt of run only
+    - Every chunk is copied with MAXERROR in its own transaction (and lease of COPY) together with checkpoint row and lines
+      rejected by COPY (STL_LOAD_ERRORS) saved to quarantine table
+    - If COPY of chunk fails, files with errors of failed COPY are quarantined and chunk is copied again
+      without them, so malformed file is skipped instead of failing task
+    - Chunks that are checkpointed for run are not copied again on retry, so only failed chunks are re-copied
+    - When all chunks are copied, statements after COPY run, checkpoints of run are cleared and ledger is updated
+
+    In backfill mode (backfill_start_date and backfill_end_date are set) partition objects of all dates
+    in range are listed by month folders, written to one COPY manifest and copied in one pass,
+    so loads of dimension and fact tables run once over combined staging data. Ledger is updated
+    for copied objects, so scheduled runs for these dates skip unchanged partitions.
+
+    If manifest_path is set, gzip CSV files converted by PreprocessJsonOperator are copied from its COPY manifest
+    (gzip CSV is parsed by Redshift faster than JSON with JSONPaths).
+
+    In all modes COPY can be limited to list of columns and followed by sql statements in the same transaction,
+    e.g. start_time of staging events is computed once after COPY instead of in every load query.
+
     redshift_conn_id - name of Rendsift connection in Airflow
     aws_credentials_id - name of AWS connection in Airflow
     target_table - staging table
@@ -24,10 +73,30 @@ class StageToRedshiftOperator(BaseOperator):
     json_paths - name of json paths in biucket
     use_partitioned_data - variable for definitions what types of data used - partioned or not
     execution_date - execution date
+    use_incremental_load - variable for definitions if only new or changed objects are copied ("True"/"False")
+    manifest_bucket - name of bucket with write access for COPY manifests (incremental load)
+    manifest_prefix - name of folder in manifest bucket (incremental load)
+    ledger_table - table with objects that have been already loaded (incremental load)
+    skip_unchanged - variable for definitions if COPY of partition is skipped when its fingerprint has not been changed ("True"/"False")
+    manifest_path - path of COPY manifest of gzip CSV files converted by PreprocessJsonOperator; "" to copy raw JSON files
+    shard_count - number of shards in sharded mode; 0 to copy folder with one COPY
+    max_concurrency - maximum number of shards copied at the same time (sharded mode)
+    checkpoint_table - table with shards or chunks that have been already copied in run (sharded and resumable modes)
+    use_resumable_load - variable for definitions if objects are copied in checkpointed chunks ("True"/"False")
+    chunk_size_mb - maximum size of chunk in MB (resumable mode)
+    chunk_max_objects - maximum number of objects in chunk (resumable mode)
+    max_errors - number of rejected lines allowed in COPY of chunk (MAXERROR, resumable mode)
+    quarantine_table - table with lines and files rejected by COPY (resumable mode)
+    backfill_start_date - first date of backfill range (YYYY-MM-DD); "" for scheduled loading
+    backfill_end_date - last date of backfill range (YYYY-MM-DD), included in range
+    copy_columns - list of columns of staging table loaded by COPY; None to load all columns
+                   (needed when staging table has columns computed after COPY)
+    post_copy_sql - list of sql statements run after COPY in the same transaction (e.g. computed columns)
     """
     
     ui_color = '#358140'
-    template_fields = ("s3_key","execution_date")
+    template_fields = ("s3_key","execution_date","manifest_bucket","manifest_path",
+                       "backfill_start_date","backfill_end_date")
 
     sql_template_json = """
         COPY {}
@@ -37,6 +106,96 @@ class StageToRedshiftOperator(BaseOperator):
         format as json {}
     """
 
+    sql_template_json_manifest = """
+        COPY {}
+        FROM '{}'
+        ACCESS_KEY_ID '{}'
+        SECRET_ACCESS_KEY '{}'
+        format as json {}
+        manifest
+    """
+
+    sql_template_csv_manifest = """
+        COPY {}
+        FROM '{}'
+        ACCESS_KEY_ID '{}'
+        SECRET_ACCESS_KEY '{}'
+        format as csv gzip
+        NULL AS '\\N'
+        manifest
+    """
+
+    copy_max_errors = ("""
+        MAXERROR {max_errors}
+    """)
+
+    shard_table_create = ("""
+        CREATE TABLE IF NOT EXISTS {shard_table} (LIKE {target_table})
+    """)
+
+    checkpoint_select = ("""
+        SELECT chunk_no
+        FROM {checkpoint_table}
+        WHERE target_table = '{target_table}' AND run_id = {run_id}
+    """)
+
+    checkpoint_insert = ("""
+        INSERT INTO {checkpoint_table} (target_table, run_id, chunk_no, chunk_key, row_count, loaded_at)
+        SELECT '{target_table}', {run_id}, {chunk_no}, {chunk_key}, {row_count}, GETDATE()
+    """)
+
+    checkpoint_delete = ("""
+        DELETE FROM {checkpoint_table}
+        WHERE target_table = '{target_table}' AND run_id = {run_id}
+    """)
+
+    load_errors_select = ("""
+        SELECT TRIM(filename), line_number, TRIM(colname), err_code, TRIM(err_reason), TRIM(raw_line)
+        FROM stl_load_errors
+        WHERE query = pg_last_copy_id()
+        ORDER BY 1, 2
+    """)
+
+    quarantine_insert_lines = ("""
+        INSERT INTO {quarantine_table} (target_table, run_id, chunk_no, file_name, line_number, column_name,
+                                        error_code, error_reason, raw_line, rejection, quarantined_at)
+        SELECT '{target_table}', {run_id}, {chunk_no}, TRIM(filename), line_number, TRIM(colname),
+               err_code, TRIM(err_reason), TRIM(raw_line), 'line', GETDATE()
+        FROM stl_load_errors
+        WHERE query = pg_last_copy_id()
+    """)
+
+    quarantine_insert_files = ("""
+        INSERT INTO {quarantine_table} (target_table, run_id, chunk_no, file_name, line_number, column_name,
+                                        error_code, error_reason, raw_line, rejection, quarantined_at)
+        VALUES {values}
+    """)
+
+    quarantine_summary = ("""
+        SELECT count(CASE WHEN rejection = 'line' THEN 1 END),
+               count(DISTINCT CASE WHEN rejection = 'file' THEN file_name END)
+        FROM {quarantine_table}
+        WHERE target_table = '{target_table}' AND run_id = {run_id}
+    """)
+
+    ledger_select = ("""
+        SELECT object_key, etag, object_size, last_modified
+        FROM {ledger_table}
+        WHERE target_table = '{target_table}' AND {key_filter}
+    """)
+
+    ledger_delete = ("""
+        DELETE FROM {ledger_table}
+        WHERE target_table = '{target_table}' AND object_key IN ({object_keys})
+    """)
+
+    ledger_insert = ("""
+        INSERT INTO {ledger_table} (target_table, object_key, etag, object_size, last_modified, loaded_at)
+        VALUES {values}
+    """)
+
+    ledger_batch_size = 500
+
     @apply_defaults
     def __init__(self,
                  # Define operators params (with defaults)
@@ -48,6 +207,25 @@ class StageToRedshiftOperator(BaseOperator):
                  json_paths="\'auto\'",
                  use_partitioned_data="False",
                  execution_date="",
+                 use_incremental_load="False",
+                 manifest_bucket="",
+                 manifest_prefix="manifests",
+                 ledger_table="public.staging_load_ledger",
+                 skip_unchanged="False",
+                 manifest_path="",
+                 shard_count=0,
+                 max_concurrency=2,
+                 checkpoint_table="public.staging_load_checkpoint",
+                 use_resumable_load="False",
+                 chunk_size_mb=256,
+                 chunk_max_objects=1000,
+                 max_errors=0,
+                 quarantine_table="public.staging_load_quarantine",
+                 telemetry_path="",
+                 backfill_start_date="",
+                 backfill_end_date="",
+                 copy_columns=None,
+                 post_copy_sql=None,
                  *args, **kwargs):
 
         super(StageToRedshiftOperator, self).__init__(*args, **kwargs)
@@ -60,18 +238,88 @@ class StageToRedshiftOperator(BaseOperator):
         self.s3_key = s3_key
         self.json_paths = json_paths
         self.use_partitioned_data = use_partitioned_data
-        self.execution_date = execution_date        
+        self.execution_date = execution_date
+        self.use_incremental_load = use_incremental_load
+        self.manifest_bucket = manifest_bucket
+        self.manifest_prefix = manifest_prefix
+        self.ledger_table = ledger_table
+        self.skip_unchanged = skip_unchanged
+        self.manifest_path = manifest_path
+        self.shard_count = shard_count
+        self.max_concurrency = max_concurrency
+        self.checkpoint_table = checkpoint_table
+        self.use_resumable_load = use_resumable_load
+        self.chunk_size_mb = chunk_size_mb
+        self.chunk_max_objects = chunk_max_objects
+        self.max_errors = max_errors
+        self.quarantine_table = quarantine_table
+        self.telemetry_path = telemetry_path
+        self.backfill_start_date = backfill_start_date
+        self.backfill_end_date = backfill_end_date
+        self.copy_columns = copy_columns
+        self.post_copy_sql = post_copy_sql or []
+        self.telemetry = None
 
     def execute(self, context):
         # Set AWS S3 and Redshift connections
+        self.telemetry = OperatorTelemetry(self.task_id, self.target_table, self.telemetry_path,
+                                           conn_id=self.redshift_conn_id)
         self.log.info("Setting up Redshift connection")
-        aws_hook = AwsHook(self.aws_credentials_id)
-        credentials = aws_hook.get_credentials()
-        redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
-        self.log.info("Redshift connection created.")
+        with self.telemetry.phase("credentials"):
+            credentials = get_aws_credentials(self.aws_credentials_id)
+        if self.copies_in_own_sessions():
+            # Shards and chunks lease slots for their own sessions, so session of task is opened only for merge:
+            # lease of task held during copies would take slots its shards and chunks wait for
+            if self.shard_count > 0:
+                self.execute_sharded(context, credentials)
+            else:
+                self.execute_resumable(context, credentials)
+        else:
+            with self.task_session("copy") as redshift:
+                self.stage(context, redshift, credentials)
+        self.telemetry.publish(context, self.log)
+
+    @contextmanager
+    def task_session(self, operation):
+        """
+        Opens session scheduled with priority of task and records time of taking connection and of waiting for slots.
+
+        operation - operation type of session for slot scheduler ('copy', 'load', 'check')
+        """
+        with redshift_session(self.redshift_conn_id, operation=operation,
+                              priority=self.priority_weight, owner=self.task_id) as redshift:
+            self.telemetry.add_phase("connect", redshift.checkout_seconds)
+            self.telemetry.add_phase("queue", redshift.queue_seconds)
+            self.log.info("Redshift connection created.")
+            yield redshift
 
-        self.log.info("Clearing data from Redshift target table")
-        redshift.run("DELETE FROM {}".format(self.target_table))
+    def copies_in_own_sessions(self):
+        """
+        Returns True if objects are copied by shards or chunks in their own sessions (sharded and resumable staging).
+        """
+        if self.manifest_path != "" or self.backfill_start_date != "" or self.backfill_end_date != "":
+            return False
+        return self.shard_count > 0 or self.use_resumable_load == "True"
+
+    def stage(self, context, redshift, credentials):
+        """
+        Clears staging table and copies data from S3 in one Redshift session (one transaction).
+        """
+        if self.manifest_path != "":
+            self.execute_csv(context, redshift, credentials)
+            return
+
+        if self.backfill_start_date != "" or self.backfill_end_date != "":
+            self.execute_backfill(context, redshift, credentials)
+            return
+
+        if self.use_incremental_load == "True":
+            self.execute_incremental(context, redshift, credentials)
+            return
+
+        if self.skip_unchanged != "True":
+            self.log.info("Clearing data from Redshift target table")
+            self.telemetry.run(redshift, "DELETE FROM {}".format(self.target_table))
 
         # Prepare S3 paths
         self.log.info("Preparing Copying data from S3 to Redshift")
@@ -93,11 +341,7 @@ class StageToRedshiftOperator(BaseOperator):
         else:
             s3_path = "s3://{}/{}".format(self.s3_bucket, self.s3_key)
 
-        if self.json_paths == "":
-            s3_json_path = "\'auto\'"
-        else:
-            s3_json_path = "\'s3://{}/{}\'".format( self.s3_bucket, \
-                                                    self.json_paths)
+        s3_json_path = self.render_json_path()
 
         self.log.info("S3_PATH: {}".format(s3_path))
         self.log.info("S3_JSON_PATH: {}".format(s3_json_path))
@@ -105,14 +349,525 @@ class StageToRedshiftOperator(BaseOperator):
         # Copy data from S3 to Redshift
         self.log.info("Preparing for JSON input data")
         formatted_sql = StageToRedshiftOperator.sql_template_json.format(
-            self.target_table,
+            self.render_copy_target(self.target_table),
             s3_path,
             credentials.access_key,
             credentials.secret_key,
             s3_json_path
         )
 
+        if self.skip_unchanged == "True":
+            self.execute_if_changed(context, redshift, s3_path, formatted_sql)
+            return
+
         # Executing COPY operation
         self.log.info("Executing Redshift COPY operation")
-        redshift.run(formatted_sql)
-        self.log.info("Redshift COPY operation DONE.")
\ No newline at end of file
+        self.telemetry.run(redshift, formatted_sql)
+        self.run_post_copy(redshift)
+        self.log.info("Redshift COPY operation DONE.")
+
+    def render_json_path(self):
+        """
+        Renders json paths option for COPY.
+        """
+        if self.json_paths == "":
+            return "\'auto\'"
+        return "\'s3://{}/{}\'".format(self.s3_bucket, self.json_paths)
+
+    def render_copy_target(self, table):
+        """
+        Renders target of COPY: table with list of loaded columns, if it is set.
+        """
+        if not self.copy_columns:
+            return table
+        return "{} ({})".format(table, ", ".join(self.copy_columns))
+
+    def run_post_copy(self, redshift):
+        """
+        Runs statements that complete staging table after COPY (e.g. computed columns).
+        """
+        if self.post_copy_sql:
+            self.telemetry.run(redshift, self.post_copy_sql, phase="post_copy")
+
+    def render_partition_key(self, partition_date):
+        """
+        Renders key of partition object (daily log file) for date.
+        """
+        return "{s3_key}/{year}/{month}/{year}-{month:02d}-{day:02d}-events.json".format(
+                    s3_key = self.s3_key,
+                    year = partition_date.year,
+                    month = partition_date.month,
+                    day = partition_date.day)
+
+    def execute_backfill(self, context, redshift, credentials):
+        """
+        Copies partition objects of all dates in backfill range with one COPY from manifest.
+        """
+        start_date = datetime.datetime.strptime(self.backfill_start_date, '%Y-%m-%d').date()
+        end_date = datetime.datetime.strptime(self.backfill_end_date, '%Y-%m-%d').date()
+        if end_date < start_date:
+            raise ValueError("Backfill end date {} is before start date {}".format(end_date, start_date))
+        s3_hook = get_s3_hook(self.aws_credentials_id)
+
+        # List month folders of range once and select partition objects of dates in range
+        partition_keys = {self.render_partition_key(start_date + datetime.timedelta(days=day_no))
+                          for day_no in range((end_date - start_date).days + 1)}
+        month_prefixes = sorted({partition_key.rsplit("/", 1)[0] + "/" for partition_key in partition_keys})
+        objects = []
+        for month_prefix in month_prefixes:
+            self.log.info("Listing objects in s3://{}/{}".format(self.s3_bucket, month_prefix))
+            objects.extend(obj for obj in list_s3_objects(s3_hook.get_conn(), self.s3_bucket, month_prefix)
+                           if obj["key"] in partition_keys)
+        self.log.info("Backfill from {} to {}: {} dates, {} partition objects found".format(
+                            start_date, end_date, len(partition_keys), len(objects)))
+        if not objects:
+            raise ValueError("No partition objects in s3://{}/{} from {} to {}".format(
+                                self.s3_bucket, self.s3_key, start_date, end_date))
+
+        # Write COPY manifest with partition objects of range
+        manifest_key = "{}/{}/backfill-{}-{}.manifest".format(self.manifest_prefix,
+                                                              self.target_table,
+                                                              start_date.strftime('%Y%m%d'),
+                                                              end_date.strftime('%Y%m%d'))
+        s3_hook.load_string(build_copy_manifest(self.s3_bucket, objects),
+                            key=manifest_key,
+                            bucket_name=self.manifest_bucket,
+                            replace=True)
+        manifest_path = "s3://{}/{}".format(self.manifest_bucket, manifest_key)
+        s3_json_path = self.render_json_path()
+        self.log.info("MANIFEST_PATH: {}".format(manifest_path))
+        self.log.info("S3_JSON_PATH: {}".format(s3_json_path))
+
+        # Clear staging table, copy range and update ledger in one transaction
+        statements = ["DELETE FROM {}".format(self.target_table)]
+        statements.append(StageToRedshiftOperator.sql_template_json_manifest.format(
+            self.render_copy_target(self.target_table),
+            manifest_path,
+            credentials.access_key,
+            credentials.secret_key,
+            s3_json_path
+        ))
+
+        self.log.info("Executing Redshift COPY operation for {} partition objects".format(len(objects)))
+        self.telemetry.run(redshift, statements)
+        self.run_post_copy(redshift)
+        self.telemetry.run(redshift, self.render_ledger_update(objects), phase="ledger")
+        self.log.info("Redshift COPY operation DONE.")
+        push_staging_changed(context, True)
+
+    def execute_csv(self, context, redshift, credentials):
+        """
+        Copies gzip CSV files converted by PreprocessJsonOperator from their COPY manifest.
+        """
+        self.log.info("MANIFEST_PATH: {}".format(self.manifest_path))
+
+        statements = ["DELETE FROM {}".format(self.target_table)]
+        statements.append(StageToRedshiftOperator.sql_template_csv_manifest.format(
+            self.render_copy_target(self.target_table),
+            self.manifest_path,
+            credentials.access_key,
+            credentials.secret_key
+        ))
+
+        self.log.info("Executing Redshift COPY operation for converted files")
+        self.telemetry.run(redshift, statements)
+        self.run_post_copy(redshift)
+        self.log.info("Redshift COPY operation DONE.")
+        push_staging_changed(context, True)
+
+    def execute_sharded(self, context, credentials):
+        """
+        Copies objects of folder concurrently by shards into per-shard staging tables and merges them.
+        """
+        s3_hook = get_s3_hook(self.aws_credentials_id)
+        manifest_paths = self.get_shard_manifests(context, s3_hook)
+        shard_tables = ["{}_shard_{}".format(self.target_table, shard_no) for shard_no in range(len(manifest_paths))]
+        run_id = sql_literal(context["run_id"])
+
+        # Skip shards that have been already copied by previous attempts of run.
+        # Checkpoints are read in separate session: transaction of merge must start after shards are committed
+        with self.task_session("check") as checkpoint_session:
+            loaded_shards = {shard_no for (shard_no,) in checkpoint_session.get_records(
+                                    StageToRedshiftOperator.checkpoint_select.format(
+                                        checkpoint_table = self.checkpoint_table,
+                                        target_table = self.target_table,
+                                        run_id = run_id))}
+        pending_shards = [shard_no for shard_no in range(len(manifest_paths)) if shard_no not in loaded_shards]
+        self.log.info("Shards: {}. Already copied: {}. Pending: {}".format(
+                            len(manifest_paths), len(loaded_shards), len(pending_shards)))
+
+        # Copy pending shards concurrently, every shard in its own session
+        get_pool(self.redshift_conn_id, max_size=self.max_concurrency + 1)
+        failures = []
+        # concurrent.futures is imported at run of task, not at parsing of DAG
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = {shard_no: executor.submit(self.copy_shard,
+                                                 shard_no,
+                                                 shard_tables[shard_no],
+                                                 manifest_paths[shard_no],
+                                                 run_id,
+                                                 credentials)
+                       for shard_no in pending_shards}
+            for shard_no, future in futures.items():
+                try:
+                    future.result()
+                    self.log.info("Shard {} copied from {}".format(shard_no, manifest_paths[shard_no]))
+                except Exception as error:
+                    self.log.error("Shard {} failed: {}".format(shard_no, error))
+                    failures.append(shard_no)
+        if failures:
+            raise ValueError("Shards {} of {} failed, they will be copied again on retry".format(
+                                failures, self.target_table))
+
+        # Replace staging table with union of shards and clear checkpoints in one transaction
+        statements = ["DELETE FROM {}".format(self.target_table)]
+        statements.extend("INSERT INTO {} SELECT * FROM {}".format(self.target_table, shard_table)
+                          for shard_table in shard_tables)
+        statements.extend("DROP TABLE {}".format(shard_table) for shard_table in shard_tables)
+        statements.append(StageToRedshiftOperator.checkpoint_delete.format(
+                                checkpoint_table = self.checkpoint_table,
+                                target_table = self.target_table,
+                                run_id = run_id))
+        self.log.info("Merging {} shards into {}".format(len(shard_tables), self.target_table))
+        with self.task_session("load") as redshift:
+            self.telemetry.run(redshift, statements, phase="merge")
+            self.run_post_copy(redshift)
+        self.log.info("Redshift COPY operation DONE.")
+        push_staging_changed(context, True)
+
+    def get_shard_manifests(self, context, s3_hook):
+        """
+        Writes COPY manifests of shards balanced by size, or reads them if they have been written by previous attempt of run.
+        Returns list of manifest paths.
+        """
+        shard_folder = "{}/{}/{}".format(self.manifest_prefix, self.target_table, context["ts_nodash"])
+        index_key = "{}/shards.json".format(shard_folder)
+        if s3_hook.check_for_key(index_key, bucket_name=self.manifest_bucket):
+            self.log.info("Reusing shard manifests from s3://{}/{}".format(self.manifest_bucket, index_key))
+            return json.loads(s3_hook.read_key(index_key, bucket_name=self.manifest_bucket))["manifests"]
+
+        self.log.info("Listing objects in s3://{}/{}".format(self.s3_bucket, self.s3_key))
+        objects = list_s3_objects(s3_hook.get_conn(), self.s3_bucket, self.s3_key)
+        if not objects:
+            raise ValueError("No objects in s3://{}/{}".format(self.s3_bucket, self.s3_key))
+        manifest_paths = []
+        for shard_no, shard in enumerate(split_objects_by_size(objects, self.shard_count)):
+            manifest_key = "{}/shard-{:03d}.manifest".format(shard_folder, shard_no)
+            s3_hook.load_string(build_copy_manifest(self.s3_bucket, shard),
+                                key=manifest_key,
+                                bucket_name=self.manifest_bucket,
+                                replace=True)
+            manifest_paths.append("s3://{}/{}".format(self.manifest_bucket, manifest_key))
+            self.log.info("Shard {}: {} objects, {} bytes".format(shard_no, len(shard), sum(obj["size"] for obj in shard)))
+
+        # Index is written last, so retries reuse only complete set of manifests
+        s3_hook.load_string(json.dumps({"manifests": manifest_paths}),
+                            key=index_key,
+                            bucket_name=self.manifest_bucket,
+                            replace=True)
+        return manifest_paths
+
+    def copy_shard(self, shard_no, shard_table, manifest_path, run_id, credentials):
+        """
+        Copies one shard into its staging table and writes checkpoint in one transaction.
+        """
+        with self.task_session("copy") as redshift:
+            self.telemetry.run(redshift, [
+                StageToRedshiftOperator.shard_table_create.format(
+                    shard_table = shard_table,
+                    target_table = self.target_table),
+                "DELETE FROM {}".format(shard_table),
+                StageToRedshiftOperator.sql_template_json_manifest.format(
+                    self.render_copy_target(shard_table),
+                    manifest_path,
+                    credentials.access_key,
+                    credentials.secret_key,
+                    self.render_json_path()),
+                StageToRedshiftOperator.checkpoint_insert.format(
+                    checkpoint_table = self.checkpoint_table,
+                    target_table = self.target_table,
+                    run_id = run_id,
+                    chunk_no = shard_no,
+                    chunk_key = sql_literal(manifest_path),
+                    row_count = "pg_last_copy_count()")
+            ])
+
+    def execute_resumable(self, context, credentials):
+        """
+        Copies objects into staging table in checkpointed chunks, retries of run copy only chunks that failed.
+        """
+        s3_hook = get_s3_hook(self.aws_credentials_id)
+        run_folder = "{}/{}/{}".format(self.manifest_prefix, self.target_table, context["ts_nodash"])
+        run_id = sql_literal(context["run_id"])
+
+        # Plan is read and staging table is cleared in separate session:
+        # chunks are committed in their own sessions and transaction of merge must start after them
+        with self.task_session("load") as plan_session:
+            chunks = self.get_chunk_plan(run_folder, s3_hook, plan_session)
+            loaded_chunks = {chunk_no for (chunk_no,) in plan_session.get_records(
+                                    StageToRedshiftOperator.checkpoint_select.format(
+                                        checkpoint_table = self.checkpoint_table,
+                                        target_table = self.target_table,
+                                        run_id = run_id))}
+            if not loaded_chunks:
+                # First attempt of run, retries keep chunks copied before
+                self.log.info("Clearing data from Redshift target table")
+                self.telemetry.run(plan_session, "DELETE FROM {}".format(self.target_table))
+        if not chunks:
+            self.log.info("No new objects. Redshift COPY operation SKIPPED.")
+            push_staging_changed(context, False)
+            return
+
+        pending_chunks = [chunk_no for chunk_no in range(len(chunks)) if chunk_no not in loaded_chunks]
+        self.log.info("Chunks: {}. Already copied: {}. Pending: {}".format(
+                            len(chunks), len(loaded_chunks), len(pending_chunks)))
+        failures = []
+        for chunk_no in pending_chunks:
+            manifest_key = "{}/chunk-{:05d}.manifest".format(run_folder, chunk_no)
+            try:
+                self.copy_chunk(chunk_no, chunks[chunk_no], manifest_key, run_id, credentials, s3_hook)
+                self.log.info("Chunk {} of {} objects copied".format(chunk_no, len(chunks[chunk_no])))
+            except Exception as error:
+                self.log.error("Chunk {} failed: {}".format(chunk_no, error))
+                failures.append(chunk_no)
+        if failures:
+            raise ValueError("Chunks {} of {} failed, they will be copied again on retry".format(
+                                failures, self.target_table))
+
+        # Complete staging table, clear checkpoints of run and update ledger in one transaction
+        with self.task_session("load") as redshift:
+            self.run_post_copy(redshift)
+            self.telemetry.run(redshift, StageToRedshiftOperator.checkpoint_delete.format(
+                                            checkpoint_table = self.checkpoint_table,
+                                            target_table = self.target_table,
+                                            run_id = run_id), phase="checkpoint")
+            if self.use_incremental_load == "True":
+                self.telemetry.run(redshift, self.render_ledger_update([obj for chunk in chunks for obj in chunk]),
+                                   phase="ledger")
+            rejected_lines, rejected_files = redshift.get_first(StageToRedshiftOperator.quarantine_summary.format(
+                                                                    quarantine_table = self.quarantine_table,
+                                                                    target_table = self.target_table,
+                                                                    run_id = run_id))
+        if rejected_lines or rejected_files:
+            self.log.warning("Rejected by COPY: {} lines, {} files. See {} for run {}".format(
+                                rejected_lines, rejected_files, self.quarantine_table, context["run_id"]))
+        context["ti"].xcom_push(key="quarantine", value={"lines": rejected_lines, "files": rejected_files})
+        self.log.info("Redshift COPY operation DONE.")
+        push_staging_changed(context, True)
+
+    def get_chunk_plan(self, run_folder, s3_hook, redshift):
+        """
+        Splits objects into chunks and writes plan to manifest bucket, or reads plan written by previous attempt of run.
+        Returns list of chunks, every chunk is list of objects.
+        """
+        index_key = "{}/chunks.json".format(run_folder)
+        if s3_hook.check_for_key(index_key, bucket_name=self.manifest_bucket):
+            self.log.info("Reusing chunk plan from s3://{}/{}".format(self.manifest_bucket, index_key))
+            chunks = json.loads(s3_hook.read_key(index_key, bucket_name=self.manifest_bucket))["chunks"]
+            return [[dict(obj, last_modified=datetime.datetime.strptime(obj["last_modified"], '%Y-%m-%d %H:%M:%S')
+                                             if obj["last_modified"] else None)
+                     for obj in chunk]
+                    for chunk in chunks]
+
+        self.log.info("Listing objects in s3://{}/{}".format(self.s3_bucket, self.s3_key))
+        objects = list_s3_objects(s3_hook.get_conn(), self.s3_bucket, self.s3_key)
+        if self.use_incremental_load == "True":
+            objects = select_new_objects(objects, self.get_loaded_objects(redshift, "1=1"))
+        chunks = split_objects_into_chunks(objects, self.chunk_size_mb * 1024 * 1024, self.chunk_max_objects)
+        self.log.info("Objects to copy: {} in {} chunks".format(len(objects), len(chunks)))
+        s3_hook.load_string(json.dumps({"chunks": [[dict(obj, last_modified=obj["last_modified"].strftime('%Y-%m-%d %H:%M:%S')
+                                                                            if obj["last_modified"] else None)
+                                                     for obj in chunk]
+                                                    for chunk in chunks]}),
+                            key=index_key,
+                            bucket_name=self.manifest_bucket,
+                            replace=True)
+        return chunks
+
+    def copy_chunk(self, chunk_no, objects, manifest_key, run_id, credentials, s3_hook):
+        """
+        Copies one chunk and writes its checkpoint and rejected lines in one transaction.
+        If COPY fails, errors of failed COPY are read from STL_LOAD_ERRORS in the same session, their files are
+        quarantined and chunk is copied again without them; COPY failing without new rejected files fails chunk.
+        """
+        manifest_path = "s3://{}/{}".format(self.manifest_bucket, manifest_key)
+        chunk_key = sql_literal(manifest_path)
+        rejected_files = []
+        with self.task_session("copy") as redshift:
+            while True:
+                rejected_urls = {error[0] for error in rejected_files}
+                pending = [obj for obj in objects
+                           if "s3://{}/{}".format(self.s3_bucket, obj["key"]) not in rejected_urls]
+                if not pending:
+                    self.log.warning("All objects of chunk {} are quarantined".format(chunk_no))
+                    statements = [StageToRedshiftOperator.checkpoint_insert.format(
+                                      checkpoint_table = self.checkpoint_table,
+                                      target_table = self.target_table,
+                                      run_id = run_id,
+                                      chunk_no = chunk_no,
+                                      chunk_key = chunk_key,
+                                      row_count = 0)]
+                    break
+                s3_hook.load_string(build_copy_manifest(self.s3_bucket, pending),
+                                    key=manifest_key,
+                                    bucket_name=self.manifest_bucket,
+                                    replace=True)
+                try:
+                    self.telemetry.run(redshift, StageToRedshiftOperator.sql_template_json_manifest.format(
+                                                     self.render_copy_target(self.target_table),
+                                                     manifest_path,
+                                                     credentials.access_key,
+                                                     credentials.secret_key,
+                                                     self.render_json_path()) +
+                                                 StageToRedshiftOperator.copy_max_errors.format(
+                                                     max_errors = self.max_errors))
+                except Exception as error:
+                    # Failed COPY is rolled back, its errors stay in system table of the same session
+                    redshift.rollback()
+                    errors = [error_row for error_row in redshift.get_records(StageToRedshiftOperator.load_errors_select)
+                              if error_row[0] not in rejected_urls]
+                    if not errors:
+                        raise
+                    self.log.warning("COPY of chunk {} failed: {}. Quarantined files: {}".format(
+                                        chunk_no, error, sorted({error_row[0] for error_row in errors})))
+                    rejected_files.extend(errors)
+                    continue
+                statements = [StageToRedshiftOperator.checkpoint_insert.format(
+                                  checkpoint_table = self.checkpoint_table,
+                                  target_table = self.target_table,
+                                  run_id = run_id,
+                                  chunk_no = chunk_no,
+                                  chunk_key = chunk_key,
+                                  row_count = "pg_last_copy_count()"),
+                              StageToRedshiftOperator.quarantine_insert_lines.format(
+                                  quarantine_table = self.quarantine_table,
+                                  target_table = self.target_table,
+                                  run_id = run_id,
+                                  chunk_no = chunk_no)]
+                break
+            if rejected_files:
+                statements.append(StageToRedshiftOperator.quarantine_insert_files.format(
+                    quarantine_table = self.quarantine_table,
+                    values = ",\n".join("({}, {}, {}, {}, 'file', GETDATE())".format(
+                                            sql_literal(self.target_table),
+                                            run_id,
+                                            chunk_no,
+                                            ", ".join(sql_literal(value) for value in error_row))
+                                        for error_row in rejected_files)))
+            self.telemetry.run(redshift, statements, phase="checkpoint")
+
+    def execute_incremental(self, context, redshift, credentials):
+        """
+        Copies only objects that are new or changed since last load using ledger of loaded objects.
+        """
+        s3_hook = get_s3_hook(self.aws_credentials_id)
+
+        # List objects in S3 folder and compare them with ledger
+        self.log.info("Listing objects in s3://{}/{}".format(self.s3_bucket, self.s3_key))
+        objects = list_s3_objects(s3_hook.get_conn(), self.s3_bucket, self.s3_key)
+        loaded_objects = self.get_loaded_objects(redshift, "1=1")
+        new_objects = select_new_objects(objects, loaded_objects)
+        self.log.info("Objects in S3 folder: {}. New or changed objects: {}".format(len(objects), len(new_objects)))
+
+        if not new_objects:
+            self.log.info("Clearing data from Redshift target table")
+            self.telemetry.run(redshift, "DELETE FROM {}".format(self.target_table))
+            self.log.info("No new objects. Redshift COPY operation SKIPPED.")
+            push_staging_changed(context, False)
+            return
+
+        # Write COPY manifest with new objects
+        manifest_key = "{}/{}/{}.manifest".format(self.manifest_prefix,
+                                                  self.target_table,
+                                                  context["ts_nodash"])
+        s3_hook.load_string(build_copy_manifest(self.s3_bucket, new_objects),
+                            key=manifest_key,
+                            bucket_name=self.manifest_bucket,
+                            replace=True)
+        manifest_path = "s3://{}/{}".format(self.manifest_bucket, manifest_key)
+        s3_json_path = self.render_json_path()
+        self.log.info("MANIFEST_PATH: {}".format(manifest_path))
+        self.log.info("S3_JSON_PATH: {}".format(s3_json_path))
+
+        # Clear staging table, copy new objects and update ledger in one transaction
+        statements = ["DELETE FROM {}".format(self.target_table)]
+        statements.append(StageToRedshiftOperator.sql_template_json_manifest.format(
+            self.render_copy_target(self.target_table),
+            manifest_path,
+            credentials.access_key,
+            credentials.secret_key,
+            s3_json_path
+        ))
+
+        self.log.info("Executing Redshift COPY operation for {} objects".format(len(new_objects)))
+        self.telemetry.run(redshift, statements)
+        self.run_post_copy(redshift)
+        self.telemetry.run(redshift, self.render_ledger_update(new_objects), phase="ledger")
+        self.log.info("Redshift COPY operation DONE.")
+        push_staging_changed(context, True)
+
+    def execute_if_changed(self, context, redshift, s3_path, copy_sql):
+        """
+        Copies partition object only if its fingerprint differs from fingerprint in ledger.
+        """
+        s3_hook = get_s3_hook(self.aws_credentials_id)
+        object_key = s3_path[len("s3://{}/".format(self.s3_bucket)):]
+
+        self.log.info("Checking fingerprint of {}".format(s3_path))
+        objects = [obj for obj in list_s3_objects(s3_hook.get_conn(), self.s3_bucket, object_key)
+                   if obj["key"] == object_key]
+        loaded_objects = self.get_loaded_objects(redshift, "object_key = {}".format(sql_literal(object_key)))
+        if not objects:
+            raise ValueError("Partition object {} does not exist".format(s3_path))
+
+        if not select_new_objects(objects, loaded_objects):
+            self.log.info("Partition has not been changed since last load. Redshift COPY operation SKIPPED.")
+            push_staging_changed(context, False)
+            return
+
+        # Clear staging table, copy partition and update ledger in one transaction
+        statements = ["DELETE FROM {}".format(self.target_table), copy_sql]
+
+        self.log.info("Executing Redshift COPY operation")
+        self.telemetry.run(redshift, statements)
+        self.run_post_copy(redshift)
+        self.telemetry.run(redshift, self.render_ledger_update(objects), phase="ledger")
+        self.log.info("Redshift COPY operation DONE.")
+        push_staging_changed(context, True)
+
+    def get_loaded_objects(self, redshift, key_filter):
+        """
+        Reads ledger of loaded objects.
+        Returns dictionary with pairs of object key and fingerprint.
+        """
+        records = redshift.get_records(StageToRedshiftOperator.ledger_select.format(
+                                            ledger_table = self.ledger_table,
+                                            target_table = self.target_table,
+                                            key_filter = key_filter))
+        return {object_key: object_fingerprint(etag, object_size, last_modified)
+                for object_key, etag, object_size, last_modified in records}
+
+    def render_ledger_update(self, objects):
+        """
+        Renders sql scripts that replace ledger rows for copied objects.
+        """
+        loaded_at = datetime.datetime.utcnow()
+        statements = []
+        for start in range(0, len(objects), StageToRedshiftOperator.ledger_batch_size):
+            batch = objects[start:start + StageToRedshiftOperator.ledger_batch_size]
+            statements.append(StageToRedshiftOperator.ledger_delete.format(
+                ledger_table = self.ledger_table,
+                target_table = self.target_table,
+                object_keys = ", ".join(sql_literal(obj["key"]) for obj in batch)))
+            statements.append(StageToRedshiftOperator.ledger_insert.format(
+                ledger_table = self.ledger_table,
+                values = ",\n".join("({}, {}, {}, {}, {}, {})".format(
+                                        sql_literal(self.target_table),
+                                        sql_literal(obj["key"]),
+                                        sql_literal(obj["etag"]),
+                                        sql_literal(obj["size"]),
+                                        sql_literal(obj["last_modified"]),
+                                        sql_literal(loaded_at))
+                                    for obj in batch)))
+        return statements
@@ -0,0 +1,212 @@
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
+from airflow.exceptions import AirflowSkipException
+from helpers.sql_queries import SqlQueries
+from helpers.sql_literals import sql_literal
+from helpers.redshift_pool import redshift_session
+from helpers.telemetry import OperatorTelemetry, pull_table_rows
+
+class TableMaintenanceOperator(BaseOperator):
+    """
+    Keeps statistics and sort order of tables fresh after loads, only where it is needed:
+    - Read rows written and deleted in every table by load tasks of run (telemetry of load tasks in XCom);
+      tables without changes in run are not maintained
+    - Read state of tables from SVV_TABLE_INFO: rows, percent of unsorted rows, percent of stale statistics
+      and rows deleted but not reclaimed yet
+    - VACUUM tables past thresholds of unsorted or deleted rows (SORT ONLY, DELETE ONLY or FULL)
+    - ANALYZE (predicate columns) tables past threshold of stale statistics or of rows changed in run
+    - Run statements one at a time in autocommit mode (VACUUM can not run in transaction block)
+    Failed statements do not stop other tables, task fails after all of them with list of failures.
+
+    Advisor of keys (run_advisor="True") counts joins and filters of columns of star schema tables
+    in sql queries of SqlQueries (loads, data quality checks and analysis queries) and proposes
+    distribution style, distribution key and sort key for current sizes of tables. Proposals are logged
+    with ALTER TABLE statements and pushed to XCom (key 'key_advice'); they are not applied.
+
+    redshift_conn_id - name of Rendsift connection in Airflow
+    tables - list of maintained tables
+    load_task_ids - list of load task ids whose telemetry reports changed rows; None to maintain all tables
+    analyze_threshold_pct - percent of stale statistics (or of rows changed in run) from which table is analyzed
+    vacuum_sort_threshold_pct - percent of unsorted rows from which table is sorted by VACUUM
+    vacuum_delete_threshold_pct - percent of deleted rows from which their space is reclaimed by VACUUM
+    run_advisor - variable for definitions if advisor of distribution and sort keys runs ("True"/"False")
+    advisor_queries - list of sql queries analysed by advisor in addition to queries of SqlQueries
+    all_rows_threshold - number of rows from which advisor does not propose DISTSTYLE ALL
+    """
+
+    ui_color = '#C9A0DC'
+
+    table_info_query = ("""
+        SELECT "schema" || '.' || "table", tbl_rows, estimated_visible_rows, unsorted, stats_off, diststyle, sortkey1
+        FROM svv_table_info
+        WHERE "schema" || '.' || "table" IN ({table_names})
+    """)
+
+    analyze_query = ("ANALYZE {table_name} PREDICATE COLUMNS")
+
+    vacuum_query = ("VACUUM {vacuum_mode} {table_name}")
+
+    @apply_defaults
+    def __init__(self,
+                 redshift_conn_id="",
+                 tables=None,
+                 load_task_ids=None,
+                 analyze_threshold_pct=10,
+                 vacuum_sort_threshold_pct=20,
+                 vacuum_delete_threshold_pct=20,
+                 run_advisor="False",
+                 advisor_queries=None,
+                 all_rows_threshold=3000000,
+                 telemetry_path="",
+                 *args, **kwargs):
+
+        super(TableMaintenanceOperator, self).__init__(*args, **kwargs)
+        self.redshift_conn_id = redshift_conn_id
+        self.tables = tables or []
+        self.load_task_ids = load_task_ids
+        self.analyze_threshold_pct = analyze_threshold_pct
+        self.vacuum_sort_threshold_pct = vacuum_sort_threshold_pct
+        self.vacuum_delete_threshold_pct = vacuum_delete_threshold_pct
+        self.run_advisor = run_advisor
+        self.advisor_queries = advisor_queries or []
+        self.all_rows_threshold = all_rows_threshold
+        self.telemetry_path = telemetry_path
+
+    def execute(self, context):
+        telemetry = OperatorTelemetry(self.task_id, sink_path=self.telemetry_path, conn_id=self.redshift_conn_id)
+        changed_rows = None
+        if self.load_task_ids is not None:
+            changed_rows = pull_table_rows(context, self.load_task_ids)
+            self.log.info("Rows changed by loads: {}".format(changed_rows))
+        tables = [table_name for table_name in self.tables
+                  if changed_rows is None or self.short_name(table_name) in changed_rows]
+        if not tables and self.run_advisor != "True":
+            raise AirflowSkipException("Tables have not been changed by loads. Maintenance SKIPPED.")
+
+        self.log.info("Setting up Redshift connection")
+        with redshift_session(self.redshift_conn_id, operation="check",
+                              priority=self.priority_weight, owner=self.task_id) as redshift:
+            telemetry.add_phase("connect", redshift.checkout_seconds)
+            telemetry.add_phase("queue", redshift.queue_seconds)
+            with telemetry.phase("table_info"):
+                table_info = self.get_table_info(redshift)
+        actions = self.plan_maintenance(tables, table_info, changed_rows or {})
+
+        # VACUUM can not run in transaction block, statements run one by one in autocommit mode
+        failures = []
+        if actions:
+            with redshift_session(self.redshift_conn_id, autocommit=True, operation="maintenance",
+                                  priority=self.priority_weight, owner=self.task_id) as redshift:
+                telemetry.add_phase("queue", redshift.queue_seconds)
+                for action in actions:
+                    self.log.info("{} {}: {}".format(action["action"], action["table"], action["reason"]))
+                    try:
+                        telemetry.run(redshift, action["sql"])
+                    except Exception as error:
+                        self.log.error("{} {} failed: {}".format(action["action"], action["table"], error))
+                        failures.append("{} {}: {}".format(action["action"], action["table"], error))
+        else:
+            self.log.info("No table is past thresholds of maintenance.")
+        context["ti"].xcom_push(key="maintenance", value=actions)
+
+        if self.run_advisor == "True":
+            with telemetry.phase("advisor"):
+                advice = self.advise_keys(table_info)
+            context["ti"].xcom_push(key="key_advice", value=advice)
+
+        telemetry.publish(context, self.log)
+        if failures:
+            raise ValueError("Table maintenance failed. {}".format(" ".join(failures)))
+
+    @staticmethod
+    def short_name(table_name):
+        """
+        Returns name of table without schema and quotes, as in telemetry of loads.
+        """
+        return table_name.split(".")[-1].strip('"').lower()
+
+    @staticmethod
+    def info_name(table_name):
+        """
+        Returns name of table as schema.table in SVV_TABLE_INFO.
+        """
+        return table_name.replace('"', '').lower()
+
+    def get_table_info(self, redshift):
+        """
+        Reads state of maintained tables from SVV_TABLE_INFO (empty tables are not there).
+        Returns dictionary {schema.table: state}.
+        """
+        records = redshift.get_records(TableMaintenanceOperator.table_info_query.format(
+                                            table_names = ", ".join(sql_literal(self.info_name(table_name))
+                                                                    for table_name in self.tables)))
+        return {table_name: {"rows": rows or 0,
+                             "visible_rows": visible_rows or 0,
+                             "unsorted": float(unsorted or 0),
+                             "stats_off": float(stats_off or 0),
+                             "diststyle": diststyle,
+                             "sortkey": sortkey}
+                for table_name, rows, visible_rows, unsorted, stats_off, diststyle, sortkey in records}
+
+    def plan_maintenance(self, tables, table_info, changed_rows):
+        """
+        Selects VACUUM and ANALYZE statements for tables past thresholds.
+        Returns list of actions with table, action, reason and sql statement; VACUUM of table goes before its ANALYZE.
+
+        tables - list of tables changed in run
+        table_info - state of tables from get_table_info
+        changed_rows - dictionary {table name without schema: {"written": rows, "deleted": rows}} of run
+        """
+        actions = []
+        for table_name in tables:
+            info = table_info.get(self.info_name(table_name))
+            if info is None or info["rows"] == 0:
+                self.log.info("Table {} is empty. Maintenance SKIPPED.".format(table_name))
+                continue
+            changed = changed_rows.get(self.short_name(table_name), {"written": 0, "deleted": 0})
+            changed_pct = (changed["written"] + changed["deleted"]) * 100.0 / info["rows"]
+            deleted_pct = max(info["rows"] - info["visible_rows"], 0) * 100.0 / info["rows"]
+
+            vacuum_sort = info["unsorted"] >= self.vacuum_sort_threshold_pct
+            vacuum_delete = deleted_pct >= self.vacuum_delete_threshold_pct
+            if vacuum_sort or vacuum_delete:
+                vacuum_mode = "FULL" if vacuum_sort and vacuum_delete else "SORT ONLY" if vacuum_sort else "DELETE ONLY"
+                actions.append({"table": table_name,
+                                "action": "VACUUM {}".format(vacuum_mode),
+                                "reason": "{:.1f}% unsorted, {:.1f}% deleted rows".format(info["unsorted"], deleted_pct),
+                                "sql": TableMaintenanceOperator.vacuum_query.format(vacuum_mode = vacuum_mode,
+                                                                                    table_name = table_name)})
+            if max(info["stats_off"], changed_pct) >= self.analyze_threshold_pct:
+                actions.append({"table": table_name,
+                                "action": "ANALYZE",
+                                "reason": "{:.1f}% stale statistics, {:.1f}% rows changed in run".format(
+                                                info["stats_off"], changed_pct),
+                                "sql": TableMaintenanceOperator.analyze_query.format(table_name = table_name)})
+        return actions
+
+    def advise_keys(self, table_info):
+        """
+        Proposes distribution and sort keys of maintained tables of star schema from joins and filters of sql queries.
+        Returns list of proposals with current keys and ALTER TABLE statements which apply proposal.
+        """
+        # key advisor is imported at run of task, not at parsing of DAG
+        from helpers.key_advisor import collect_sql_texts, collect_column_usage, advise_table_keys, render_key_ddl
+        table_fields = {table_name: fields for table_name, fields in SqlQueries.table_fields.items()
+                        if self.info_name(table_name) in {self.info_name(name) for name in self.tables}}
+        if not table_fields:
+            return []
+        usage = collect_column_usage(collect_sql_texts(SqlQueries) + list(self.advisor_queries), table_fields)
+        table_rows = {table_name: table_info.get(self.info_name(table_name), {}).get("rows", 0)
+                      for table_name in table_fields}
+        advice = advise_table_keys(usage, table_fields, table_rows, self.all_rows_threshold)
+        for proposal in advice:
+            info = table_info.get(self.info_name(proposal["table"]), {})
+            proposal["current_diststyle"] = info.get("diststyle")
+            proposal["current_sortkey"] = info.get("sortkey")
+            proposal["ddl"] = render_key_ddl(proposal)
+            self.log.info("Keys of {}: current {} / sort key {}, proposed {} / sort key {} ({}). {}".format(
+                                proposal["table"], proposal["current_diststyle"], proposal["current_sortkey"],
+                                "KEY({})".format(proposal["distkey"]) if proposal["diststyle"] == "KEY"
+                                else proposal["diststyle"],
+                                proposal["sortkey"], proposal["reason"], "; ".join(proposal["ddl"])))
+        return advice
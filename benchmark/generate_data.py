@@ -0,0 +1,193 @@
+"""
+Synthetic Sparkify data for staging tables staging_events and staging_songs.
+
+Cardinalities are derived from number of events:
+ - users ~ events / 500, sessions of 20 events, ~82% of events are 'NextSong'
+ - songs ~ events / 100 with titles repeated across artists, artists ~ events / 400
+ - ~2% of song rows are duplicated with different spelling of title (deduplication in dimension loads)
+ - 75% of played songs are in catalog; their titles and artist names are written with random case
+   and surrounding whitespace, so they are matched only by upper(BTRIM(...)) keys
+
+Data is deterministic for the same seed and is streamed to Postgres by COPY in chunks.
+"""
+import csv
+import io
+import random
+
+CSV_NULL = "\\N"
+
+EVENT_COLUMNS = ["artist", "auth", "firstname", "gender", "iteminsession", "lastname", "length", "level",
+                 "location", "method", "page", "registration", "sessionid", "song", "status", "ts",
+                 "useragent", "userid"]
+
+SONG_COLUMNS = ["num_songs", "artist_id", "artist_name", "artist_latitude", "artist_longitude",
+                "artist_location", "song_id", "title", "duration", "year"]
+
+TITLE_WORDS = ["Love", "Night", "Home", "Fire", "Heart", "Dream", "Rain", "Summer", "Blue", "Road",
+               "Light", "Time", "Gold", "River", "Shadow", "Dance", "Sky", "Wild", "Stone", "Song"]
+
+FIRST_NAMES = ["Lily", "Kevin", "Chloe", "Jacob", "Tegan", "Aleena", "Ryan", "Jayden", "Kate", "Matthew"]
+
+LAST_NAMES = ["Koch", "Arellano", "Cuevas", "Levine", "Kirby", "Smith", "Lynch", "Harrell", "Roberts", "Hill"]
+
+LOCATIONS = ["San Francisco-Oakland-Hayward, CA", "Portland-South Portland, ME", "Chicago-Naperville-Elgin, IL-IN-WI",
+             "Atlanta-Sandy Springs-Roswell, GA", "Lansing-East Lansing, MI", "New York-Newark-Jersey City, NY-NJ-PA"]
+
+USER_AGENTS = ["Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 Chrome/36.0.1985.143 Safari/537.36",
+               "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.77.4 Safari/537.77.4",
+               "Mozilla/5.0 (X11; Linux x86_64; rv:31.0) Gecko/20100101 Firefox/31.0"]
+
+OTHER_PAGES = ["Home", "Logout", "Settings", "Help", "Upgrade"]
+
+FIRST_TS = 1541030400000  # 2018-11-01 00:00:00 UTC in milliseconds
+
+CHUNK_ROWS = 100000
+
+
+def cardinalities(events):
+    """
+    Returns numbers of users, artists and songs for number of events.
+    """
+    return {"users": max(20, events // 500),
+            "artists": max(10, events // 400),
+            "songs": max(50, events // 100)}
+
+
+def vary_spelling(text, rnd):
+    """
+    Changes case and surrounding whitespace of text as it happens in logs.
+    """
+    variant = rnd.random()
+    if variant < 0.4:
+        return text
+    if variant < 0.55:
+        return text.upper()
+    if variant < 0.7:
+        return text.lower()
+    if variant < 0.85:
+        return " " + text
+    return text + "  "
+
+
+def build_catalog(events, rnd):
+    """
+    Builds catalog of songs: list of tuples (song_id, title, artist_id, artist_name, duration).
+    """
+    counts = cardinalities(events)
+    artists = [("AR{:08d}".format(artist_no),
+                "{} {}".format(rnd.choice(TITLE_WORDS), rnd.choice(LAST_NAMES)) + " {}".format(artist_no))
+               for artist_no in range(counts["artists"])]
+    # Titles are repeated across artists, but pair of title and duration is unique as fact load matches songs by it
+    titles = ["{} {}".format(first, second) for first in TITLE_WORDS for second in TITLE_WORDS]
+    catalog = []
+    used = set()
+    for song_no in range(counts["songs"]):
+        artist_id, artist_name = artists[rnd.randrange(len(artists))]
+        title, duration = rnd.choice(titles), rnd.randint(90, 420)
+        while (title, duration) in used:
+            title = "{} {}".format(rnd.choice(titles), rnd.randrange(10 ** 6))
+        used.add((title, duration))
+        catalog.append(("SO{:08d}".format(song_no), title, artist_id, artist_name, duration))
+    return catalog
+
+
+def generate_song_rows(catalog, rnd):
+    """
+    Yields rows of staging_songs in order of SONG_COLUMNS.
+    """
+    for song_id, title, artist_id, artist_name, duration in catalog:
+        row = [1, artist_id, artist_name, rnd.randint(-60, 60), rnd.randint(-150, 150),
+               rnd.choice(LOCATIONS), song_id, title, duration, rnd.randint(1960, 2018)]
+        yield row
+        if rnd.random() < 0.02:
+            duplicate = list(row)
+            duplicate[7] = title + " (Remastered)"
+            yield duplicate
+
+
+def generate_event_rows(events, catalog, rnd):
+    """
+    Yields rows of staging_events in order of EVENT_COLUMNS.
+    """
+    counts = cardinalities(events)
+    users = [(user_no + 1,
+              rnd.choice(FIRST_NAMES),
+              rnd.choice(LAST_NAMES),
+              rnd.choice("FM"),
+              rnd.choice(LOCATIONS),
+              rnd.choice(USER_AGENTS))
+             for user_no in range(counts["users"])]
+    paid = set()
+    # Sessions start evenly over 30 days, events of session are 2-5 minutes apart
+    session_step = (30 * 86400 * 1000) // max(1, events // 20)
+    session_id = 0
+    user = users[0]
+    item_in_session = 0
+    ts = FIRST_TS
+    for event_no in range(events):
+        if event_no % 20 == 0:
+            session_id += 1
+            item_in_session = 0
+            ts = FIRST_TS + session_id * session_step
+            user = users[rnd.randrange(len(users))]
+            if rnd.random() < 0.05:
+                paid.add(user[0])
+        item_in_session += 1
+        user_id, first_name, last_name, gender, location, user_agent = user
+        ts += rnd.randint(120000, 300000)
+        if rnd.random() < 0.82:
+            page = "NextSong"
+            if rnd.random() < 0.75:
+                song_id, title, artist_id, artist_name, duration = catalog[rnd.randrange(len(catalog))]
+                song = vary_spelling(title, rnd)
+                artist = vary_spelling(artist_name, rnd)
+                length = duration
+            else:
+                song = "{} {}".format(rnd.choice(TITLE_WORDS), rnd.randrange(10 ** 6))
+                artist = "Unknown {}".format(rnd.randrange(10 ** 5))
+                length = rnd.randint(90, 420)
+        else:
+            page = rnd.choice(OTHER_PAGES)
+            song = artist = length = None
+        yield [artist, "Logged In", first_name, gender, item_in_session, last_name, length,
+               "paid" if user_id in paid else "free", location, "PUT" if page == "NextSong" else "GET",
+               page, 1540000000000 + user_id, session_id, song, 200, ts, user_agent, user_id]
+
+
+def copy_rows(cursor, table, columns, rows):
+    """
+    Streams rows to table by COPY FROM STDIN in chunks.
+    Returns number of copied rows.
+    """
+    copy_sql = "COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '{}')".format(table, ", ".join(columns), CSV_NULL)
+    copied = 0
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    chunk = 0
+    for row in rows:
+        writer.writerow([CSV_NULL if value is None else value for value in row])
+        chunk += 1
+        if chunk == CHUNK_ROWS:
+            buffer.seek(0)
+            cursor.copy_expert(copy_sql, buffer)
+            copied += chunk
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator="\n")
+            chunk = 0
+    if chunk:
+        buffer.seek(0)
+        cursor.copy_expert(copy_sql, buffer)
+        copied += chunk
+    return copied
+
+
+def load_staging(cursor, events, seed=42):
+    """
+    Fills staging tables with synthetic data for number of events.
+    Returns numbers of copied rows per staging table.
+    """
+    rnd = random.Random(seed)
+    catalog = build_catalog(events, rnd)
+    return {"staging_songs": copy_rows(cursor, "staging_songs", SONG_COLUMNS, generate_song_rows(catalog, rnd)),
+            "staging_events": copy_rows(cursor, "staging_events", EVENT_COLUMNS,
+                                        generate_event_rows(events, catalog, rnd))}
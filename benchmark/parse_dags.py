@@ -0,0 +1,162 @@
+"""
+Benchmark of parsing of DAG files as scheduler does it on every parse loop.
+
+For every DAG file of airflow/dags:
+ 1. In fresh Python process Airflow is imported and plugins are loaded as plugins_manager of Airflow 1.10 does
+    (every .py file of plugins folder is imported), time of loading and modules imported by plugins are measured
+ 2. DAG file is imported with plugins already loaded (as in scheduler),
+    time of import and modules imported by DAG file (operators, boto3, NumPy, psycopg2, ...) are measured
+ 3. Import is repeated --repeats times, median and minimum times are reported
+ 4. With --variants N: N copies of pipeline are built by DAG factory from config of DAG file
+ 5. With --baseline-ref: the same is measured for DAG files and plugins of git revision (e.g. before lazy imports)
+Results are written to JSON file with --output.
+
+Usage (from root of repository, Airflow installed):
+    python benchmark/parse_dags.py --repeats 20 --variants 50 --baseline-ref HEAD~1
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Packages which are expensive to import and are needed only at run of tasks
+HEAVY_PACKAGES = ("boto3", "botocore", "numpy", "psycopg2", "multiprocessing")
+
+PARSE_SCRIPT = """
+import importlib.util, json, os, re, sys, time
+plugins_folder, dag_file, variants = sys.argv[1], sys.argv[2], int(sys.argv[3])
+sys.path.insert(0, plugins_folder)
+import airflow, airflow.models
+
+def load_source(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+# Crawl of plugins folder as in plugins_manager of Airflow 1.10
+modules_before = set(sys.modules)
+plugin_errors = 0
+start = time.perf_counter()
+for root, dirs, files in os.walk(plugins_folder):
+    for name in sorted(files):
+        if name.endswith(".py"):
+            try:
+                load_source("_".join([re.sub(r"[/|.]", "__", root), name[:-3]]), os.path.join(root, name))
+            except Exception:
+                plugin_errors += 1
+result = {"plugins_seconds": time.perf_counter() - start, "plugin_errors": plugin_errors,
+          "plugin_modules": sorted(set(sys.modules) - modules_before)}
+
+modules_before = set(sys.modules)
+start = time.perf_counter()
+module = load_source("parsed_dag", dag_file)
+result.update({"seconds": time.perf_counter() - start, "modules": sorted(set(sys.modules) - modules_before)})
+if variants and hasattr(module, "PIPELINE"):
+    from helpers import build_dags
+    start = time.perf_counter()
+    build_dags(module.PIPELINE, [{"dag_id": "variant_{}".format(n)} for n in range(variants)])
+    result["variants_seconds"] = time.perf_counter() - start
+print(json.dumps(result))
+"""
+
+
+def parse_dag_file(airflow_folder, dag_file, variants):
+    """
+    Loads plugins and imports DAG file in fresh Python process.
+    Returns dictionary with seconds of loading of plugins and of import of DAG file, lists of modules imported by both
+    and seconds of building of variants.
+    """
+    output = subprocess.check_output([sys.executable, "-c", PARSE_SCRIPT,
+                                      os.path.join(airflow_folder, "plugins"),
+                                      os.path.join(airflow_folder, "dags", dag_file),
+                                      str(variants)])
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def measure(airflow_folder, repeats, variants):
+    """
+    Measures parsing of every DAG file of Airflow folder.
+    Returns dictionary {dag_file: statistics}.
+    """
+    results = {}
+    for dag_file in sorted(os.listdir(os.path.join(airflow_folder, "dags"))):
+        if not dag_file.endswith(".py"):
+            continue
+        runs = [parse_dag_file(airflow_folder, dag_file, variants) for _ in range(repeats)]
+        seconds = [run["seconds"] for run in runs]
+        modules = runs[-1]["modules"]
+        plugin_modules = runs[-1]["plugin_modules"]
+        result = {"median_seconds": statistics.median(seconds),
+                  "min_seconds": min(seconds),
+                  "modules": len(modules),
+                  "heavy_packages": [package for package in HEAVY_PACKAGES if package in modules],
+                  "plugins_median_seconds": statistics.median(run["plugins_seconds"] for run in runs),
+                  "plugin_modules": len(plugin_modules),
+                  "plugin_heavy_packages": [package for package in HEAVY_PACKAGES if package in plugin_modules],
+                  "plugin_errors": runs[-1]["plugin_errors"]}
+        if "variants_seconds" in runs[-1]:
+            result["variants"] = variants
+            result["variants_seconds"] = statistics.median(run["variants_seconds"] for run in runs)
+        results[dag_file] = result
+    return results
+
+
+def export_revision(ref, folder):
+    """
+    Extracts airflow folder of git revision into folder and returns path of extracted airflow folder.
+    """
+    archive = subprocess.check_output(["git", "archive", "--format=tar", ref, "airflow"], cwd=ROOT)
+    archive_path = os.path.join(folder, "airflow.tar")
+    with open(archive_path, "wb") as archive_file:
+        archive_file.write(archive)
+    with tarfile.open(archive_path) as tar:
+        tar.extractall(folder)
+    return os.path.join(folder, "airflow")
+
+
+def print_results(label, results):
+    for dag_file, result in results.items():
+        line = "  {:>9} {:<18} plugins {:>6.1f} ms {:>4} modules, heavy: {}; DAG {:>6.1f} ms median {:>6.1f} ms min" \
+               " {:>4} modules, heavy: {}".format(
+                    label, dag_file, result["plugins_median_seconds"] * 1000, result["plugin_modules"],
+                    ", ".join(result["plugin_heavy_packages"]) or "-",
+                    result["median_seconds"] * 1000, result["min_seconds"] * 1000,
+                    result["modules"], ", ".join(result["heavy_packages"]) or "-")
+        if "variants_seconds" in result:
+            line += ", {} variants {:.1f} ms".format(result["variants"], result["variants_seconds"] * 1000)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of parsing of DAG files")
+    parser.add_argument("--repeats", type=int, default=10, help="number of imports of every DAG file")
+    parser.add_argument("--variants", type=int, default=0,
+                        help="number of copies of pipeline built by DAG factory; 0 to skip")
+    parser.add_argument("--baseline-ref", default=None, help="git revision measured for comparison")
+    parser.add_argument("--output", default=None, help="path of results file")
+    args = parser.parse_args()
+
+    results = {"current": measure(os.path.join(ROOT, "airflow"), args.repeats, args.variants)}
+    print_results("current", results["current"])
+    if args.baseline_ref:
+        with tempfile.TemporaryDirectory() as folder:
+            results["baseline"] = measure(export_revision(args.baseline_ref, folder), args.repeats, args.variants)
+        results["baseline_ref"] = args.baseline_ref
+        print_results("baseline", results["baseline"])
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+        print("Results: {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""
+Benchmark of pre-processing of raw JSON files (PreprocessJsonOperator) on local Postgres as stand-in for Redshift.
+
+Synthetic songs are written to local folder as small JSON files (one song per file, as song_data) and staged twice:
+ 1. Raw JSON: every file is read by COPY and documents are mapped to columns by names of fields
+    (stand-in of COPY format as json 'auto')
+ 2. Pre-processing: files are grouped as by PreprocessJsonOperator.group_objects and converted into gzip CSV files
+    by helpers of operator (in one process), converted files are loaded by COPY of CSV
+Numbers of files, bytes scanned by COPY and times of conversion and COPY are printed; both ways must stage
+the same rows.
+
+Usage (from root of repository, Airflow and psycopg2 installed):
+    python benchmark/preprocess_json.py --dsn "host=localhost dbname=sparkify user=postgres" --files 10000
+"""
+import argparse
+import gzip
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import psycopg2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "airflow", "plugins"))
+
+from helpers import SqlQueries, iter_json_objects, extract_fields, write_csv_gzip
+from helpers.json_records import CSV_NULL
+from operators import PreprocessJsonOperator
+
+# Temporary table with columns of public.staging_songs
+STAGING_TABLE_DDL = """
+    CREATE TEMP TABLE benchmark_staging_songs (
+        num_songs int4,
+        artist_id varchar(256),
+        artist_name varchar(256),
+        artist_latitude numeric(18,0),
+        artist_longitude numeric(18,0),
+        artist_location varchar(256),
+        song_id varchar(256),
+        title varchar(256),
+        duration numeric(18,0),
+        "year" int4
+    )
+"""
+
+
+def generate_songs(files, seed):
+    """
+    Generates song documents as in song_data: one song per document, 4 songs per artist on average,
+    location of artist is known for 40% of artists.
+    """
+    rnd = random.Random(seed)
+    artists = max(files // 4, 1)
+    for song_no in range(files):
+        artist_no = rnd.randrange(artists)
+        located = artist_no % 5 < 2
+        yield {"num_songs": 1,
+               "artist_id": "AR{:016X}".format(artist_no),
+               "artist_latitude": round(rnd.uniform(-60, 60), 5) if located else None,
+               "artist_longitude": round(rnd.uniform(-180, 180), 5) if located else None,
+               "artist_location": "City {}".format(artist_no % 500) if located else "",
+               "artist_name": "Artist {}".format(artist_no),
+               "song_id": "SO{:016X}".format(song_no),
+               "title": "Song {} of artist {}".format(song_no, artist_no),
+               "duration": round(rnd.uniform(60, 600), 5),
+               "year": rnd.choice([0] + list(range(1960, 2019)))}
+
+
+def write_song_files(folder, files, seed):
+    """
+    Writes songs as JSON files of folder song_data.
+    Returns objects of files as by list_s3_objects.
+    """
+    objects = []
+    for song_no, song in enumerate(generate_songs(files, seed)):
+        key = "song_data/{:03d}/song-{:07d}.json".format(song_no // 1000, song_no)
+        path = os.path.join(folder, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as song_file:
+            song_file.write(json.dumps(song))
+        objects.append({"key": key, "etag": "", "size": os.path.getsize(path), "last_modified": None})
+    return objects
+
+
+def copy_raw_json(connection, folder, objects, columns):
+    """
+    Stages raw JSON files: every file is read, documents are copied and mapped to columns by names of fields.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("TRUNCATE benchmark_staging_songs")
+        cursor.execute("CREATE TEMP TABLE benchmark_song_documents (document text)")
+        buffer = io.BytesIO()
+        for obj in objects:
+            with open(os.path.join(folder, obj["key"]), "rb") as object_file:
+                buffer.write(object_file.read().replace(b"\n", b" ") + b"\n")
+        buffer.seek(0)
+        cursor.copy_expert("COPY benchmark_song_documents FROM STDIN WITH (FORMAT csv, QUOTE e'\\x01', "
+                           "DELIMITER e'\\x02')", buffer)
+        cursor.execute("""
+            INSERT INTO benchmark_staging_songs ({columns})
+            SELECT {columns}
+            FROM benchmark_song_documents, json_populate_record(NULL::benchmark_staging_songs, document::json)
+        """.format(columns = ", ".join(columns)))
+        cursor.execute("DROP TABLE benchmark_song_documents")
+    connection.commit()
+
+
+def convert_objects(folder, operator, objects, columns):
+    """
+    Converts groups of raw files into gzip CSV files as PreprocessJsonOperator (in one process).
+    Returns paths of converted files.
+    """
+    paths = [[column] for column in columns]
+    converted = []
+    for file_no, group in enumerate(operator.group_objects(objects)):
+        rows = []
+        for obj in group:
+            with open(os.path.join(folder, obj["key"])) as object_file:
+                rows.extend(extract_fields(record, paths) for record in iter_json_objects(object_file.read()))
+        path = os.path.join(folder, "preprocessed", "part-{:05d}.csv.gz".format(file_no))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as converted_file:
+            converted_file.write(write_csv_gzip(rows))
+        converted.append(path)
+    return converted
+
+
+def copy_converted(connection, converted, columns):
+    """
+    Stages converted gzip CSV files.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("TRUNCATE benchmark_staging_songs")
+        for path in converted:
+            with gzip.open(path, "rb") as converted_file:
+                cursor.copy_expert("COPY benchmark_staging_songs ({}) FROM STDIN WITH (FORMAT csv, NULL '{}')".format(
+                                       ", ".join(columns), CSV_NULL), converted_file)
+    connection.commit()
+
+
+def run_preprocess(connection, files, seed):
+    """
+    Compares staging of raw JSON files with staging of the same songs pre-processed into gzip CSV files.
+    Returns numbers of files, bytes and seconds of both ways and number of rows that differ between them.
+    """
+    columns = SqlQueries.staging_songs_columns
+    folder = tempfile.mkdtemp(prefix="sparkify_preprocess_")
+    with connection.cursor() as cursor:
+        cursor.execute(STAGING_TABLE_DDL)
+    connection.commit()
+    objects = write_song_files(folder, files, seed)
+
+    start = time.monotonic()
+    copy_raw_json(connection, folder, objects, columns)
+    json_seconds = time.monotonic() - start
+    with connection.cursor() as cursor:
+        cursor.execute("CREATE TEMP TABLE benchmark_songs_json AS SELECT * FROM benchmark_staging_songs")
+    connection.commit()
+
+    operator = PreprocessJsonOperator(task_id="Preprocess_songs", column_names=columns)
+    start = time.monotonic()
+    converted = convert_objects(folder, operator, objects, columns)
+    preprocess_seconds = time.monotonic() - start
+
+    start = time.monotonic()
+    copy_converted(connection, converted, columns)
+    csv_seconds = time.monotonic() - start
+
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT count(1)
+            FROM ((SELECT {columns} FROM benchmark_songs_json EXCEPT ALL SELECT {columns} FROM benchmark_staging_songs)
+                  UNION ALL
+                  (SELECT {columns} FROM benchmark_staging_songs EXCEPT ALL SELECT {columns} FROM benchmark_songs_json)) diff
+        """.format(columns = ", ".join(columns)))
+        mismatches = cursor.fetchone()[0]
+        cursor.execute("SELECT count(1) FROM benchmark_staging_songs")
+        rows = cursor.fetchone()[0]
+        cursor.execute("DROP TABLE benchmark_songs_json")
+        cursor.execute("DROP TABLE benchmark_staging_songs")
+    connection.commit()
+    result = {"objects": len(objects),
+              "json_bytes": sum(obj["size"] for obj in objects),
+              "json_seconds": json_seconds,
+              "files": len(converted),
+              "csv_bytes": sum(os.path.getsize(path) for path in converted),
+              "preprocess_seconds": preprocess_seconds,
+              "csv_seconds": csv_seconds,
+              "rows": rows,
+              "mismatches": mismatches}
+    shutil.rmtree(folder)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dsn", required=True, help="connection string of local Postgres database")
+    parser.add_argument("--files", type=int, default=10000, help="number of song files")
+    parser.add_argument("--seed", type=int, default=42, help="seed of generated songs")
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(args.dsn)
+    try:
+        result = run_preprocess(connection, args.files, args.seed)
+    finally:
+        connection.close()
+    print("{:<24} {:>9.3f} s {:>7} files {:>10} bytes".format(
+              "copy raw json", result["json_seconds"], result["objects"], result["json_bytes"]))
+    print("{:<24} {:>9.3f} s {:>7} files".format("convert to gzip csv", result["preprocess_seconds"], result["files"]))
+    print("{:<24} {:>9.3f} s {:>7} files {:>10} bytes".format(
+              "copy gzip csv", result["csv_seconds"], result["files"], result["csv_bytes"]))
+    print("rows {}, mismatched rows {}".format(result["rows"], result["mismatches"]))
+    if result["mismatches"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
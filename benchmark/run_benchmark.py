@@ -0,0 +1,1097 @@
+"""
+Benchmark of SQL of the pipeline on local Postgres as stand-in for Redshift.
+
+For every scale (number of events):
+ 1. Tables are created from datawarehouse/create_tables.sql (Redshift-only clauses and not enforced
+    foreign keys are stripped, sort keys are replaced by indexes)
+ 2. Staging tables are filled with synthetic data (generate_data.py), start_time of events is computed
+    by post-COPY statement of Stage_events
+ 3. Load tasks of DAG run their rendered SQL in order of DAG, every task in one transaction
+    (time dimension builder copies its gzip CSV batches by COPY FROM STDIN instead of S3)
+ 4. Load tasks run again on the same staging data (cost of rerun of hour)
+ 5. Time table is loaded into empty table by SQL (DISTINCT and EXTRACT) and by vectorized builder,
+    results of both ways are compared row by row
+ 6. Users table is loaded in 'delete-load' and 'merge' modes on rerun of hour (some levels changed)
+    and on staging data of last day only; orphaned songplays (user missing in users) are counted
+ 7. Data quality checks of DAG run one by one and as one UNION ALL statement; offending rows of null rate check
+    (songplays without song_id) are read all at once and as capped sample through server-side cursor
+ 8. With --backfill-days: loads of history day by day (staging of one day and all loads per day,
+    as scheduled catchup does) are compared with one pass over staging data of whole range (backfill_dag.py)
+ 9. With --history-days: fact load in 'append' and 'window' modes is timed day by day as history grows
+10. With --stream-hours: event stream of first hours is loaded in micro-batches as by stream_dag.py
+    (objects of every minute in local folder), rows are compared with loading of the same hours in one pass
+11. With --resume-files: staging of objects with one malformed object is retried as by Airflow, full reload
+    on every attempt is compared with checkpointed chunks of resumable mode (malformed object is quarantined)
+12. With --aggregate-days: days are loaded one by one and new rows of every day are folded into rollups
+    as by Maintain_aggregates; folding is compared with full recompute of rollups, rollups are checked
+    against full recompute
+13. With --late-song-pct: songs arrive after their events, songplays without song_id are captured to pending table
+    and resolved when songs are loaded as by Resolve_late_songs; resolution is compared with full rebuild of songplays,
+    rollups folded after resolution are checked against full recompute
+14. With --wlm-pipelines: sessions of DAG (read-only stand-ins of COPY, loads and checks) run for many pipelines
+    at the same time, without limit and with slot scheduler limited to --wlm-slots; maximal weight of running
+    statements, time of statements and time in queue by operation type and priority are reported
+Timings and row counts are written to JSON file; with --baseline results are compared with previous file
+and script fails if some timing is slower than baseline by more than --tolerance.
+
+Usage (from root of repository, Airflow and psycopg2 installed):
+    python benchmark/run_benchmark.py --dsn "host=localhost dbname=sparkify user=postgres" --scales 10000,100000
+"""
+import argparse
+import datetime
+import gzip
+import importlib.util
+import io
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import psycopg2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "airflow", "plugins"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from generate_data import load_staging, cardinalities, FIRST_TS, CSV_NULL
+from helpers import SqlQueries, RedshiftSession, OperatorTelemetry, list_folder_objects, split_objects_into_chunks
+
+MAX_EVENTS = 10000000
+
+# Redshift-only clauses of DDL
+REDSHIFT_CLAUSES = re.compile(r"\b(DISTSTYLE\s+\w+|DISTKEY\s*(\(\s*\w+\s*\))?|(COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\)|"
+                              r"SORTKEY|ENCODE\s+\w+)", re.IGNORECASE)
+
+# IDENTITY columns of Redshift are identity columns of Postgres
+IDENTITY_COLUMNS = re.compile(r"\bIDENTITY\s*\(\s*\d+\s*,\s*\d+\s*\)", re.IGNORECASE)
+
+# Foreign keys are not enforced by Redshift, so they are not created in Postgres either
+FOREIGN_KEYS = re.compile(r",\s*CONSTRAINT\s+\w+\s+FOREIGN\s+KEY\s*\([^)]*\)\s*REFERENCES\s+\w+\s*\([^)]*\)", re.IGNORECASE)
+
+# Functions and operators of Redshift used by pipeline SQL
+POSTGRES_SHIMS = [
+    "CREATE OR REPLACE FUNCTION len(text) RETURNS int AS 'SELECT length($1)' LANGUAGE sql IMMUTABLE",
+    "CREATE OR REPLACE FUNCTION getdate() RETURNS timestamp AS 'SELECT now()::timestamp' LANGUAGE sql STABLE",
+    "CREATE OR REPLACE FUNCTION rs_concat(int, timestamp) RETURNS text AS 'SELECT $1::text || $2::text' "
+    "LANGUAGE sql IMMUTABLE",
+    "DO $$BEGIN CREATE OPERATOR || (LEFTARG = int, RIGHTARG = timestamp, FUNCTION = rs_concat); "
+    "EXCEPTION WHEN duplicate_function THEN NULL; END$$"
+]
+
+# Sort keys of Redshift are emulated by indexes, so range-restricted queries can prune in Postgres too
+SORT_KEYS = re.compile(r"CREATE\s+TABLE\s+([\w.\"]+)\s*\((?:[^;]*?)\)\s*(?:COMPOUND\s+)?SORTKEY\s*\(([^)]*)\)",
+                       re.IGNORECASE)
+
+STAGING_TABLES = ["public.staging_events", "public.staging_songs"]
+
+
+def postgres_ddl(ddl):
+    """
+    Strips Redshift-only clauses and foreign keys from DDL, sort keys are replaced by indexes,
+    IDENTITY columns by identity columns of Postgres.
+    """
+    indexes = ["CREATE INDEX ON {} ({});".format(table, columns) for table, columns in SORT_KEYS.findall(ddl)]
+    ddl = IDENTITY_COLUMNS.sub("GENERATED BY DEFAULT AS IDENTITY", REDSHIFT_CLAUSES.sub("", ddl))
+    return "\n".join([FOREIGN_KEYS.sub("", ddl)] + indexes)
+
+
+def load_dag_module(file_name="dag.py"):
+    """
+    Imports DAG file, so benchmark runs the same tasks with the same parameters.
+    """
+    spec = importlib.util.spec_from_file_location("pipeline_" + file_name[:-len(".py")],
+                                                  os.path.join(ROOT, "airflow", "dags", file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_dag():
+    return load_dag_module("dag.py").dag
+
+
+def git_version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def reset_schema(cursor):
+    with open(os.path.join(ROOT, "datawarehouse", "create_tables.sql")) as ddl_file:
+        cursor.execute(postgres_ddl(ddl_file.read()))
+    for shim in POSTGRES_SHIMS:
+        cursor.execute(shim)
+
+
+def run_timed(connection, statements):
+    """
+    Runs statements in one transaction.
+    Returns seconds and total number of affected rows.
+    """
+    start = time.monotonic()
+    rows = 0
+    with connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+            rows += max(cursor.rowcount, 0)
+    connection.commit()
+    return time.monotonic() - start, rows
+
+
+def stage_start_time(cursor):
+    """
+    Computes start_time of staging events as post-COPY statement of Stage_events does.
+    """
+    cursor.execute(SqlQueries.staging_events_start_time_update)
+
+
+def run_load(connection, task):
+    """
+    Runs load task in one transaction.
+    Time dimension builder copies its gzip CSV batches from memory by COPY FROM STDIN instead of S3.
+    Returns seconds and total number of affected rows.
+    """
+    if getattr(task, "insert_mode", None) == "window" and hasattr(task, "read_window"):
+        start = time.monotonic()
+        redshift = RedshiftSession(connection)
+        window = task.read_window(redshift)
+        window_loaded = window is not None and task.is_window_loaded(redshift, window)
+        seconds, rows = run_timed(connection, task.render_sql(window, window_loaded))
+        return time.monotonic() - start, rows
+    if hasattr(task, "render_sql"):
+        return run_timed(connection, task.render_sql())
+    start = time.monotonic()
+    copy_sql = "COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '{}')".format(
+                    task.target_table_name, SqlQueries.time_table_fields, CSV_NULL)
+    buffers = list(task.build_batches(RedshiftSession(connection), OperatorTelemetry(task.task_id)))
+    rows = 0
+    with connection.cursor() as cursor:
+        for buffer in buffers:
+            cursor.copy_expert(copy_sql, gzip.GzipFile(fileobj=io.BytesIO(buffer)))
+            rows += max(cursor.rowcount, 0)
+    connection.commit()
+    return time.monotonic() - start, rows
+
+
+def is_load_task(task):
+    return hasattr(task, "render_sql") or hasattr(task, "build_batches")
+
+
+def compare_time_loads(connection):
+    """
+    Loads time table into empty table by SQL and by vectorized builder.
+    Returns timings of both ways and number of rows that differ.
+    """
+    from operators import LoadDimensionOperator, LoadTimeDimensionOperator
+
+    sql_task = LoadDimensionOperator(task_id="time_sql",
+                                     target_table_name="time",
+                                     target_table_fields=SqlQueries.time_table_fields,
+                                     target_table_key=SqlQueries.time_table_key,
+                                     sql_query_insert=SqlQueries.time_table_insert)
+    builder_task = LoadTimeDimensionOperator(task_id="time_vectorized", target_table_name="time")
+    run_timed(connection, ["TRUNCATE TABLE time"])
+    sql_seconds, _ = run_load(connection, sql_task)
+    run_timed(connection, ["DROP TABLE IF EXISTS benchmark_time_sql",
+                           "CREATE TABLE benchmark_time_sql AS SELECT * FROM time",
+                           "TRUNCATE TABLE time"])
+    builder_seconds, _ = run_load(connection, builder_task)
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT count(1) FROM ((SELECT * FROM time EXCEPT SELECT * FROM benchmark_time_sql)
+                                  UNION ALL
+                                  (SELECT * FROM benchmark_time_sql EXCEPT SELECT * FROM time)) diff
+        """)
+        mismatches = cursor.fetchone()[0]
+        cursor.execute("DROP TABLE benchmark_time_sql")
+    connection.commit()
+    print("  {:>9} {:<32} {:>9.3f} s".format("time", "sql (DISTINCT, EXTRACT)", sql_seconds))
+    print("  {:>9} {:<32} {:>9.3f} s {:>10} mismatches".format("time", "vectorized builder", builder_seconds,
+                                                                mismatches))
+    return sql_seconds, builder_seconds, mismatches
+
+
+def compare_dimension_modes(connection, task):
+    """
+    Loads users table in 'delete-load' and 'merge' modes on rerun of hour (staging data of all events,
+    level of every tenth user changed since last load) and on staging data of last day only (as hourly run sees).
+    Every run starts from users loaded from all events. Returns seconds, affected rows, rows of users
+    and songplays whose user is missing in users for both modes and staging data.
+    """
+    insert_mode = task.insert_mode
+    reload_sql = ["TRUNCATE TABLE users",
+                  "INSERT INTO users ({}) ".format(task.target_table_fields) + task.sql_query_insert.replace(
+                      "FROM staging_events", "FROM benchmark_staging_events").format(INSERT_MODE_QUERY = "1=1")]
+    change_sql = ["UPDATE users SET level = CASE WHEN level = 'free' THEN 'paid' ELSE 'free' END "
+                  "WHERE user_id % 10 = 0"]
+    orphans_sql = ("SELECT count(1) FROM songplays WHERE user_id IS NOT NULL "
+                   "AND NOT EXISTS (SELECT 1 FROM users WHERE users.user_id = songplays.user_id)")
+    result = {}
+    run_timed(connection, ["DROP TABLE IF EXISTS benchmark_staging_events",
+                           "CREATE TABLE benchmark_staging_events AS SELECT * FROM staging_events"])
+    for staging in ("rerun", "last day"):
+        if staging == "last day":
+            run_timed(connection, ["DELETE FROM staging_events WHERE ts < (SELECT max(ts) - 86400000::int8 "
+                                   "FROM benchmark_staging_events)"])
+        for mode in ("delete-load", "merge"):
+            run_timed(connection, reload_sql + (change_sql if staging == "rerun" else []))
+            task.insert_mode = mode
+            seconds, rows = run_load(connection, task)
+            with connection.cursor() as cursor:
+                cursor.execute(orphans_sql)
+                orphans = cursor.fetchone()[0]
+            connection.commit()
+            users = count_rows(connection, ["users"])["users"]
+            result["{}.{}".format(staging, mode)] = {"seconds": seconds, "rows": rows, "users": users,
+                                                     "orphaned_songplays": orphans}
+            print("  {:>9} {:<32} {:>9.3f} s {:>10} rows, {} users, {} orphaned songplays".format(
+                        "users", "{} {}".format(mode, staging), seconds, rows, users, orphans))
+    task.insert_mode = insert_mode
+    run_timed(connection, ["TRUNCATE TABLE staging_events",
+                           "INSERT INTO staging_events SELECT * FROM benchmark_staging_events"]
+                          + reload_sql + ["DROP TABLE benchmark_staging_events"])
+    return result
+
+
+def compare_sample_fetch(connection, task):
+    """
+    Reads offending rows of null rate check of songplays.song_id (plays of songs missing in catalog) without limit
+    all at once (fetchall) and as capped sample through server-side cursor of data quality operator.
+    Returns rows, seconds and peak of Python memory of both ways.
+    """
+    check = task.compile_value_check({"type": "null_rate", "table_name": "public.songplays", "column": "song_id"})
+    check["sample_sql"] = task.null_rate_sample_sql.format(table_name = check["table"],
+                                                           table_key = "songplay_id",
+                                                           column = check["column"],
+                                                           scope_filter = task.full_scope_filter,
+                                                           sample_rows = "ALL")
+    result = {}
+    for mode in ("fetchall", "cursor"):
+        tracemalloc.start()
+        start = time.monotonic()
+        if mode == "fetchall":
+            rows = len(RedshiftSession(connection).get_records(check["sample_sql"]))
+        else:
+            rows = len(task.fetch_sample(RedshiftSession(connection), check)["rows"])
+        seconds = time.monotonic() - start
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        connection.commit()
+        result[mode] = {"rows": rows, "seconds": seconds, "peak_bytes": peak_bytes}
+        print("  {:>9} {:<32} {:>9.3f} s {:>10} rows, peak {:.1f} MB".format(
+                    "dq", "sample {}".format(mode), seconds, rows, peak_bytes / 1024 / 1024))
+    return result
+
+
+def count_rows(connection, tables):
+    counts = {}
+    with connection.cursor() as cursor:
+        for table in tables:
+            cursor.execute("SELECT count(1) FROM {}".format(table))
+            counts[table] = cursor.fetchone()[0]
+    connection.commit()
+    return counts
+
+
+def run_scale(connection, dag, events, seed):
+    """
+    Runs benchmark for one scale. Returns dictionary with timings and row counts.
+    """
+    from operators import DataQualityOperator
+
+    tasks = dag.topological_sort()
+    load_tasks = [task for task in tasks if is_load_task(task)]
+    dq_tasks = [task for task in tasks if isinstance(task, DataQualityOperator)]
+    result = {"events": events, "cardinalities": cardinalities(events), "timings": {}, "rows": {}}
+
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        reset_schema(cursor)
+        start = time.monotonic()
+        result["staging_rows"] = load_staging(cursor, events, seed)
+        result["generate_seconds"] = time.monotonic() - start
+        start = time.monotonic()
+        stage_start_time(cursor)
+        result["timings"]["stage.start_time"] = time.monotonic() - start
+        for table in STAGING_TABLES:
+            cursor.execute("ANALYZE {}".format(table))
+    connection.autocommit = False
+
+    for phase in ("load", "reload"):
+        for task in load_tasks:
+            seconds, rows = run_load(connection, task)
+            result["timings"]["{}.{}".format(phase, task.task_id)] = seconds
+            result["rows"]["{}.{}".format(phase, task.task_id)] = rows
+            print("  {:>9} {:<32} {:>9.3f} s {:>10} rows".format(phase, task.task_id, seconds, rows))
+
+    sql_seconds, builder_seconds, result["time_mismatches"] = compare_time_loads(connection)
+    result["dimension_modes"] = compare_dimension_modes(connection, dag.get_task("Load_user_dim_table"))
+    for name, mode in result["dimension_modes"].items():
+        result["timings"]["users.{}".format(name.replace(" ", "_"))] = mode["seconds"]
+    result["timings"]["time.sql"] = sql_seconds
+    result["timings"]["time.vectorized"] = builder_seconds
+
+    for task in dq_tasks:
+        checks = task.compile_checks(None)
+        for check in checks:
+            seconds, _ = run_timed(connection, [check["sql"]])
+            checked = check["table"] + (".{}".format(check["column"]) if "column" in check else "")
+            name = "dq.{}.{}.{}".format(task.task_id, check["type"], checked)
+            result["timings"][name] = seconds
+            print("  {:>9} {:<32} {:>9.3f} s".format("dq", "{} {}".format(check["type"], checked), seconds))
+        union_sql = "\n        UNION ALL".join(
+            DataQualityOperator.sql_template_union_item.format(check_no = check_no, check_sql = check["sql"])
+            for check_no, check in enumerate(checks))
+        seconds, _ = run_timed(connection, [union_sql])
+        result["timings"]["dq.{}.union".format(task.task_id)] = seconds
+        print("  {:>9} {:<32} {:>9.3f} s".format("dq", "union of {} checks".format(len(checks)), seconds))
+        result["dq_samples"] = compare_sample_fetch(connection, task)
+
+    result["table_rows"] = count_rows(connection, [table["table_name"] for task in dq_tasks
+                                                   for table in task.table_key_list])
+    return result
+
+
+def create_events_source(connection, events, seed):
+    """
+    Generates events of all days once into table benchmark_events_source, staging table is filled from it by days.
+    """
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        reset_schema(cursor)
+        load_staging(cursor, events, seed)
+        stage_start_time(cursor)
+        cursor.execute("DROP TABLE IF EXISTS benchmark_events_source")
+        cursor.execute("CREATE TABLE benchmark_events_source AS SELECT * FROM staging_events")
+    connection.autocommit = False
+
+
+def drop_events_source(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("DROP TABLE benchmark_events_source")
+    connection.commit()
+
+
+def stage_days(connection, start, end):
+    """
+    Replaces staging events with events of days from start to end (excluded). Returns seconds.
+    """
+    day_filter = "ts >= {first_ts} + {start} * 86400000::int8 AND ts < {first_ts} + {end} * 86400000::int8"
+    return run_timed(connection, [
+        "DELETE FROM staging_events",
+        "INSERT INTO staging_events SELECT * FROM benchmark_events_source WHERE " + day_filter.format(
+            first_ts = FIRST_TS, start = start, end = end),
+        "ANALYZE staging_events"])[0]
+
+
+def run_backfill(connection, dag, events, seed, days):
+    """
+    Compares loading of first days of data day by day with loading of whole range in one pass.
+    Returns dictionary with timings of both ways.
+    """
+    load_tasks = [task for task in dag.topological_sort() if is_load_task(task)]
+    create_events_source(connection, events, seed)
+
+    def load_all():
+        return sum(run_load(connection, task)[0] for task in load_tasks)
+
+    daily_seconds = 0.0
+    for day_no in range(days):
+        daily_seconds += stage_days(connection, day_no, day_no + 1) + load_all()
+    daily_rows = count_rows(connection, ["public.songplays", "public.users", "public.time"])
+
+    run_timed(connection, ["TRUNCATE TABLE songplays, users, songs, artists, time"])
+    range_seconds = stage_days(connection, 0, days) + load_all()
+    range_rows = count_rows(connection, ["public.songplays", "public.users", "public.time"])
+
+    drop_events_source(connection)
+    print("  {:>9} {:<32} {:>9.3f} s".format("backfill", "{} days day by day".format(days), daily_seconds))
+    print("  {:>9} {:<32} {:>9.3f} s".format("backfill", "{} days in one pass".format(days), range_seconds))
+    return {"days": days,
+            "daily_seconds": daily_seconds,
+            "range_seconds": range_seconds,
+            "speedup": daily_seconds / range_seconds if range_seconds else None,
+            "daily_rows": daily_rows,
+            "range_rows": range_rows}
+
+
+def run_fact_history(connection, dag, events, seed, days):
+    """
+    Loads days one by one into growing history with 'append' and 'window' modes of fact load.
+    Returns timings of fact load for every day in both modes.
+    """
+    from operators import LoadFactOperator
+
+    load_tasks = [task for task in dag.topological_sort() if is_load_task(task)]
+    fact_tasks = [task for task in load_tasks if isinstance(task, LoadFactOperator)]
+    insert_modes = [task.insert_mode for task in fact_tasks]
+    create_events_source(connection, events, seed)
+
+    result = {"days": days}
+    for insert_mode in ("append", "window"):
+        for task in fact_tasks:
+            task.insert_mode = insert_mode
+        run_timed(connection, ["TRUNCATE TABLE songplays, users, songs, artists, time"])
+        fact_seconds = []
+        for day_no in range(days):
+            stage_days(connection, day_no, day_no + 1)
+            seconds = 0.0
+            for task in load_tasks:
+                task_seconds, _ = run_load(connection, task)
+                if task in fact_tasks:
+                    seconds += task_seconds
+            fact_seconds.append(seconds)
+        result[insert_mode] = fact_seconds
+        result["{}_rows".format(insert_mode)] = count_rows(connection, ["public.songplays"])
+        print("  {:>9} {:<32} {:>9.3f} s first day, {:.3f} s last day".format(
+                    "history", "fact load {} {} days".format(insert_mode, days), fact_seconds[0], fact_seconds[-1]))
+    for task, insert_mode in zip(fact_tasks, insert_modes):
+        task.insert_mode = insert_mode
+
+    drop_events_source(connection)
+    return result
+
+
+def write_stream_objects(connection, folder, prefix, hours):
+    """
+    Writes events of first hours of data to local folder as stream objects: one CSV object per minute
+    with modification time at end of minute (time of arrival). Returns time of first event.
+    """
+    first_time = datetime.datetime.fromtimestamp(FIRST_TS // 1000, datetime.timezone.utc)
+    export_sql = ("COPY (SELECT {columns} FROM benchmark_events_source WHERE ts >= {start} AND ts < {end} ORDER BY ts) "
+                  "TO STDOUT WITH (FORMAT csv)")
+    with connection.cursor() as cursor:
+        for minute in range(hours * 60):
+            minute_time = first_time + datetime.timedelta(minutes=minute)
+            key = "{}{:%Y/%m/%d/%H}/events-{:%Y-%m-%d-%H-%M}.csv".format(prefix, minute_time, minute_time)
+            path = os.path.join(folder, *key.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as object_file:
+                cursor.copy_expert(export_sql.format(columns = ", ".join(SqlQueries.staging_events_columns),
+                                                     start = FIRST_TS + minute * 60000,
+                                                     end = FIRST_TS + (minute + 1) * 60000), object_file)
+            arrival = (minute_time + datetime.timedelta(minutes=1)).timestamp()
+            os.utime(path, (arrival, arrival))
+    connection.commit()
+    return first_time
+
+
+def run_stream(connection, dag, events, seed, hours):
+    """
+    Simulates runs of stream_dag over first hours of data. Objects of every minute arrive in local folder
+    (stand-in of stream prefix); every POLL_MINUTES ready micro-batches are loaded as by MicroBatchIngestOperator
+    (with COPY FROM STDIN instead of S3), one batch fails before commit and is loaded again by next run.
+    Returns timings and latencies of batches, and rows of tables compared with loading of the same hours in one pass.
+    """
+    from operators import LoadSongCatalogOperator
+
+    stream_module = load_dag_module("stream_dag.py")
+    operator = stream_module.stream_dag.get_task("Ingest_micro_batches")
+    load_operators = operator.get_load_operators()
+    poll = datetime.timedelta(minutes=stream_module.POLL_MINUTES)
+    create_events_source(connection, events, seed)
+    for task in dag.topological_sort():
+        if isinstance(task, LoadSongCatalogOperator):
+            run_load(connection, task)
+    run_timed(connection, ["DELETE FROM staging_events"])
+
+    folder = tempfile.mkdtemp(prefix="sparkify_stream_")
+    first_time = write_stream_objects(connection, folder, operator.s3_key, hours)
+    copy_sql = "COPY {} FROM STDIN WITH (FORMAT csv)".format(operator.render_copy_target(operator.stage_table_name))
+    redshift = RedshiftSession(connection)
+    batch_seconds, latencies, objects_count = [], [], 0
+    failed_batches = 0
+    now = first_time + poll
+    while now <= first_time + datetime.timedelta(hours=hours, minutes=operator.max_wait_minutes) + 2 * poll:
+        for _ in range(operator.max_batches_per_run):
+            start = time.monotonic()
+            high_water_mark = operator.read_high_water_mark(redshift)
+            objects = [obj for obj in list_folder_objects(folder, operator.s3_key, high_water_mark["object_key"])
+                       if obj["last_modified"] <= now]
+            batch, ready = operator.select_batch(objects, now)
+            if not ready:
+                connection.commit()
+                break
+            with connection.cursor() as cursor:
+                cursor.execute(operator.stage_table_create.format(stage_table_name = operator.stage_table_name,
+                                                                  staging_table = operator.target_table))
+                for obj in batch:
+                    with open(os.path.join(folder, *obj["key"].split("/")), "rb") as object_file:
+                        cursor.copy_expert(copy_sql, object_file)
+                statements = list(operator.post_copy_sql)
+                for statement in statements:
+                    cursor.execute(statement)
+                for load_operator in load_operators:
+                    for statement in operator.render_load_sql(redshift, load_operator):
+                        cursor.execute(statement)
+                if len(batch_seconds) == 2 and not failed_batches:
+                    # Failure before commit: COPY and loads of batch are rolled back with high-water mark
+                    connection.rollback()
+                    failed_batches += 1
+                    break
+                for statement in operator.render_high_water_mark_update(high_water_mark, batch) + [
+                        operator.stage_table_drop.format(stage_table_name = operator.stage_table_name)]:
+                    cursor.execute(statement)
+            connection.commit()
+            seconds = time.monotonic() - start
+            batch_seconds.append(seconds)
+            latencies.append((now - min(obj["last_modified"] for obj in batch)).total_seconds() + seconds)
+            objects_count += len(batch)
+        now += poll
+    shutil.rmtree(folder)
+    tables = ["public.songplays", "public.users", "public.time"]
+    stream_rows = count_rows(connection, tables)
+
+    # The same hours loaded in one pass by the same load operators (they read staging table of stream)
+    run_timed(connection, ["TRUNCATE TABLE songplays, users, time",
+                           "INSERT INTO {} SELECT * FROM benchmark_events_source WHERE ts < {}".format(
+                                operator.target_table, FIRST_TS + hours * 3600000)])
+    for load_operator in load_operators:
+        run_load(connection, load_operator)
+    run_timed(connection, ["DELETE FROM {}".format(operator.target_table)])
+    range_rows = count_rows(connection, tables)
+    drop_events_source(connection)
+
+    result = {"hours": hours,
+              "poll_minutes": stream_module.POLL_MINUTES,
+              "latency_bound_seconds": stream_module.STREAM_LATENCY_MINUTES * 60,
+              "batches": len(batch_seconds),
+              "objects": objects_count,
+              "failed_batches": failed_batches,
+              "mean_batch_seconds": sum(batch_seconds) / len(batch_seconds) if batch_seconds else None,
+              "max_batch_seconds": max(batch_seconds, default=None),
+              "max_latency_seconds": max(latencies, default=None),
+              "stream_rows": stream_rows,
+              "range_rows": range_rows}
+    print("  {:>9} {:<32} {:>9.3f} s mean batch, {} batches, {} objects, max latency {:.0f} s (bound {} s)".format(
+                "stream", "{} hours".format(hours), result["mean_batch_seconds"] or 0.0, result["batches"],
+                objects_count, result["max_latency_seconds"] or 0.0, result["latency_bound_seconds"]))
+    print("  {:>9} {:<32} {} stream rows, {} rows of one pass".format(
+                "stream", "exactly once", stream_rows, range_rows))
+    return result
+
+
+def copy_objects(connection, folder, objects):
+    """
+    Copies CSV objects of local folder into staging events with COPY FROM STDIN in open transaction.
+    Returns key of object whose COPY failed (stand-in of file name in STL_LOAD_ERRORS), or None.
+    """
+    copy_sql = "COPY staging_events ({}) FROM STDIN WITH (FORMAT csv)".format(", ".join(SqlQueries.staging_events_columns))
+    with connection.cursor() as cursor:
+        for obj in objects:
+            with open(os.path.join(folder, obj["key"]), "rb") as object_file:
+                try:
+                    cursor.copy_expert(copy_sql, object_file)
+                except psycopg2.DataError:
+                    return obj["key"]
+    return None
+
+
+def run_resumable(connection, events, seed, files, chunks):
+    """
+    Compares retries of staging with one malformed object: full reload on every attempt (one COPY of all objects,
+    as before resumable mode) with checkpointed chunks (resumable mode of StageToRedshiftOperator).
+    Events are written to local folder as files objects, object in the middle gets malformed line.
+    In resumable mode one more chunk fails once by transient error, so retry copies only this chunk.
+    Returns seconds and copied bytes of all attempts of both modes and rows staged by resumable mode.
+    """
+    retries = load_dag_module("dag.py").default_args["retries"]
+    create_events_source(connection, events, seed)
+    folder = tempfile.mkdtemp(prefix="sparkify_resumable_")
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT max(ts) FROM benchmark_events_source")
+        step = -(-(cursor.fetchone()[0] + 1 - FIRST_TS) // files)
+    export_sql = ("COPY (SELECT {columns} FROM benchmark_events_source WHERE ts >= {start} AND ts < {end} ORDER BY ts) "
+                  "TO STDOUT WITH (FORMAT csv)")
+    with connection.cursor() as cursor:
+        for file_no in range(files):
+            with open(os.path.join(folder, "events-{:05d}.csv".format(file_no)), "wb") as object_file:
+                cursor.copy_expert(export_sql.format(columns = ", ".join(SqlQueries.staging_events_columns),
+                                                     start = FIRST_TS + file_no * step,
+                                                     end = FIRST_TS + (file_no + 1) * step), object_file)
+    connection.commit()
+    bad_key = "events-{:05d}.csv".format(files // 2)
+    with open(os.path.join(folder, bad_key), "ab") as object_file:
+        object_file.write(b"malformed line\n")
+    objects = list_folder_objects(folder)
+    sizes = {obj["key"]: obj["size"] for obj in objects}
+
+    # Full reload: every attempt clears staging table and copies all objects in one transaction
+    full = {"attempts": 0, "seconds": 0.0, "bytes": 0}
+    for _ in range(retries + 1):
+        start = time.monotonic()
+        run_timed(connection, ["DELETE FROM staging_events"])
+        failed_key = copy_objects(connection, folder, objects)
+        connection.rollback()
+        full["attempts"] += 1
+        full["seconds"] += time.monotonic() - start
+        # Redshift COPY fails after slices have parsed all objects
+        full["bytes"] += sum(sizes.values())
+        if failed_key is None:
+            break
+
+    # Resumable: chunks are copied and checkpointed one by one, malformed object is quarantined
+    plan = split_objects_into_chunks(objects, sum(sizes.values()), -(-files // chunks))
+    resumable = {"attempts": 0, "seconds": 0.0, "bytes": 0, "chunks": len(plan), "chunk_copies": 0, "quarantined": []}
+    checkpoints = set()
+    transient_chunk = len(plan) - 1 if plan[-1][0]["key"] != bad_key else 0
+    while len(checkpoints) < len(plan) and resumable["attempts"] < retries + 1:
+        start = time.monotonic()
+        if not checkpoints:
+            run_timed(connection, ["DELETE FROM staging_events"])
+        for chunk_no, chunk in enumerate(plan):
+            if chunk_no in checkpoints:
+                continue
+            while True:
+                pending = [obj for obj in chunk if obj["key"] not in resumable["quarantined"]]
+                resumable["chunk_copies"] += 1
+                resumable["bytes"] += sum(obj["size"] for obj in pending)
+                failed_key = copy_objects(connection, folder, pending)
+                if failed_key is None and not (chunk_no == transient_chunk and resumable["attempts"] == 0):
+                    connection.commit()
+                    checkpoints.add(chunk_no)
+                    break
+                connection.rollback()
+                if failed_key is None:
+                    break
+                resumable["quarantined"].append(failed_key)
+        resumable["attempts"] += 1
+        resumable["seconds"] += time.monotonic() - start
+    resumable["rows"] = count_rows(connection, ["staging_events"])["staging_events"]
+    shutil.rmtree(folder)
+    drop_events_source(connection)
+
+    result = {"files": files, "full": full, "resumable": resumable}
+    for mode in ("full", "resumable"):
+        print("  {:>9} {:<32} {:>9.3f} s in {} attempts, {} MB copied".format(
+                    "resume", mode, result[mode]["seconds"], result[mode]["attempts"],
+                    result[mode]["bytes"] // (1024 * 1024)))
+    print("  {:>9} {:<32} {} chunk copies of {} chunks, quarantined {}, {} rows staged".format(
+                "resume", "resumable chunks", resumable["chunk_copies"], resumable["chunks"],
+                resumable["quarantined"], resumable["rows"]))
+    return result
+
+
+def render_fold_run(aggregate_task):
+    """
+    Returns list of sql statements of one run of Maintain_aggregates without check: snapshot and fold of delta table.
+    """
+    from operators import AggregateMaintenanceOperator
+
+    return ([AggregateMaintenanceOperator.delta_lock_query.format(delta_table = aggregate_task.delta_table),
+             AggregateMaintenanceOperator.delta_analyze_query.format(delta_table = aggregate_task.delta_table),
+             AggregateMaintenanceOperator.fold_create_query.format(
+                 fold_table_name = aggregate_task.fold_table_name(),
+                 delta_table = aggregate_task.delta_table)]
+            + aggregate_task.render_fold_sql()
+            + [AggregateMaintenanceOperator.drop_query.format(table_name = aggregate_task.fold_table_name())])
+
+
+def count_rollup_mismatches(connection, aggregate_task):
+    """
+    Returns dictionary {rollup table: number of groups that differ from full recompute from fact table}.
+    """
+    mismatches = {}
+    with connection.cursor() as cursor:
+        for rollup in aggregate_task.rollups:
+            cursor.execute(aggregate_task.render_check_sql(rollup))
+            mismatches[rollup["table_name"]] = cursor.fetchone()[0]
+    connection.commit()
+    return mismatches
+
+
+def run_aggregates(connection, dag, events, seed, days):
+    """
+    Loads days one by one (fact load copies new rows to songplays_delta) and folds new rows of every day
+    into rollups as Maintain_aggregates does. After last day every rollup is recomputed from songplays
+    (full scan of dashboards without rollups), read from rollup table and compared with full recompute.
+    Returns timings of folds, recomputes and reads, and numbers of mismatched groups.
+    """
+    from operators import AggregateMaintenanceOperator
+
+    tasks = dag.topological_sort()
+    load_tasks = [task for task in tasks if is_load_task(task)]
+    aggregate_task = next(task for task in tasks if isinstance(task, AggregateMaintenanceOperator))
+    create_events_source(connection, events, seed)
+    fold_sql = render_fold_run(aggregate_task)
+
+    fold_seconds = []
+    for day_no in range(days):
+        stage_days(connection, day_no, day_no + 1)
+        for task in load_tasks:
+            run_load(connection, task)
+        fold_seconds.append(run_timed(connection, fold_sql)[0])
+    result = {"days": days,
+              "fold_seconds": fold_seconds,
+              "delta_rows": count_rows(connection, [aggregate_task.delta_table])[aggregate_task.delta_table],
+              "rollups": {}}
+    print("  {:>9} {:<32} {:>9.3f} s first day, {:.3f} s last day".format(
+                "aggregate", "fold {} days".format(days), fold_seconds[0], fold_seconds[-1]))
+
+    for rollup in aggregate_task.rollups:
+        recompute_seconds, _ = run_timed(connection, [rollup["select"].format(source_table = aggregate_task.fact_table)])
+        read_seconds, groups = run_timed(connection, ["SELECT {} FROM {}".format(
+                                                          aggregate_task.rollup_fields(rollup), rollup["table_name"])])
+        with connection.cursor() as cursor:
+            cursor.execute(aggregate_task.render_check_sql(rollup))
+            mismatches = cursor.fetchone()[0]
+        connection.commit()
+        result["rollups"][rollup["table_name"]] = {"recompute_seconds": recompute_seconds,
+                                                   "read_seconds": read_seconds,
+                                                   "groups": groups,
+                                                   "mismatches": mismatches}
+        print("  {:>9} {:<32} {:>9.3f} s recompute, {:.3f} s read {} groups, {} mismatches".format(
+                    "aggregate", rollup["table_name"], recompute_seconds, read_seconds, groups, mismatches))
+    result["rows"] = count_rows(connection, ["public.songplays"] + ["public.{}".format(rollup["table_name"])
+                                                                     for rollup in aggregate_task.rollups])
+    drop_events_source(connection)
+    return result
+
+
+def run_late_songs(connection, dag, events, seed, late_pct):
+    """
+    Loads events with late_pct percent of songs missing from catalog (their songplays get no song_id and are captured
+    into pending table as by Resolve_late_songs), then loads late songs and resolves pending songplays with them.
+    Rollups are folded after load and after resolution (as by Maintain_aggregates) and compared with full recompute.
+    Resolution is compared with full rebuild of songplays on complete catalog: timings and mismatched rows.
+    """
+    from operators import LoadSongCatalogOperator, ResolveLateSongsOperator, AggregateMaintenanceOperator
+
+    tasks = dag.topological_sort()
+    load_tasks = [task for task in tasks if is_load_task(task)]
+    catalog_task = next(task for task in tasks if isinstance(task, LoadSongCatalogOperator))
+    fact_task = next(task for task in load_tasks if task.task_id == "Load_songplays_fact_table")
+    resolve_task = next(task for task in tasks if isinstance(task, ResolveLateSongsOperator))
+    aggregate_task = next(task for task in tasks if isinstance(task, AggregateMaintenanceOperator))
+    late_filter = "abs(hashtext(song_id)) % 100 < {}".format(int(late_pct))
+
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        reset_schema(cursor)
+        load_staging(cursor, events, seed)
+        stage_start_time(cursor)
+        cursor.execute("CREATE TEMP TABLE late_songs AS SELECT * FROM staging_songs WHERE " + late_filter)
+        cursor.execute("DELETE FROM staging_songs WHERE " + late_filter)
+        for table in STAGING_TABLES:
+            cursor.execute("ANALYZE {}".format(table))
+    connection.autocommit = False
+    for task in load_tasks:
+        run_load(connection, task)
+    capture_seconds, captured = run_timed(connection, [resolve_task.render_capture_sql()])
+    run_timed(connection, render_fold_run(aggregate_task))
+
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM staging_songs")
+        cursor.execute("INSERT INTO staging_songs SELECT * FROM late_songs")
+        cursor.execute("ANALYZE staging_songs")
+    connection.commit()
+    catalog_seconds, late_rows = run_load(connection, catalog_task)
+    scopes = dict(catalog_task.load_scopes)
+    resolve_statements, _ = resolve_task.render_resolve_sql(scopes.get(resolve_task.song_table_name),
+                                                            scopes.get(resolve_task.artist_table_name))
+    resolve_seconds, _ = run_timed(connection, resolve_statements)
+    pending = count_rows(connection, [resolve_task.pending_table])[resolve_task.pending_table]
+    delta_rows = count_rows(connection, [aggregate_task.delta_table])[aggregate_task.delta_table]
+    fold_seconds, _ = run_timed(connection, render_fold_run(aggregate_task))
+    rollup_mismatches = count_rollup_mismatches(connection, aggregate_task)
+
+    # Full rebuild of songplays on complete catalog: staging events are the same, so it is reference of resolution
+    with connection.cursor() as cursor:
+        cursor.execute("CREATE TEMP TABLE resolved_songplays AS SELECT songplay_id, song_id, artist_id FROM songplays")
+    connection.commit()
+    rebuild_seconds, _ = run_timed(connection, ["DELETE FROM {}".format(fact_task.target_table_name)]
+                                               + fact_task.render_insert(fact_task.sql_query_select))
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT count(1)
+            FROM ((SELECT songplay_id, song_id, artist_id FROM resolved_songplays
+                   EXCEPT
+                   SELECT songplay_id, song_id, artist_id FROM songplays)
+                  UNION ALL
+                  (SELECT songplay_id, song_id, artist_id FROM songplays
+                   EXCEPT
+                   SELECT songplay_id, song_id, artist_id FROM resolved_songplays)) mismatches
+        """)
+        mismatches = cursor.fetchone()[0]
+        cursor.execute("SELECT count(1) FROM songplays WHERE song_id IS NULL")
+        unmatched = cursor.fetchone()[0]
+        cursor.execute("DROP TABLE resolved_songplays")
+        cursor.execute("DROP TABLE late_songs")
+    connection.commit()
+    result = {"late_pct": late_pct,
+              "late_catalog_rows": late_rows,
+              "captured_rows": captured,
+              "pending_rows": pending,
+              "unmatched_rows": unmatched,
+              "capture_seconds": capture_seconds,
+              "catalog_seconds": catalog_seconds,
+              "resolve_seconds": resolve_seconds,
+              "rebuild_seconds": rebuild_seconds,
+              "mismatches": mismatches,
+              "delta_rows": delta_rows,
+              "fold_seconds": fold_seconds,
+              "rollup_mismatches": rollup_mismatches}
+    print("  {:>9} {:<32} {:>9.3f} s, {} captured, {} still pending".format(
+                "late", "capture", capture_seconds, captured, pending))
+    print("  {:>9} {:<32} {:>9.3f} s resolve, {:.3f} s full rebuild, {} mismatches".format(
+                "late", "{}% late songs".format(late_pct), resolve_seconds, rebuild_seconds, mismatches))
+    print("  {:>9} {:<32} {:>9.3f} s fold of {} delta rows, {} mismatched groups of rollups".format(
+                "late", "fold of patched songplays", fold_seconds, delta_rows, sum(rollup_mismatches.values())))
+    return result
+
+
+def workload_sessions(dag):
+    """
+    Returns sessions of one run of DAG as (task id, operation type, priority, sql) in order of DAG,
+    with read-only stand-ins of statements, so pipelines can run concurrently on the same tables:
+    COPY of staging table is COPY TO STDOUT, loads are SELECT of fact load, checks are data quality checks.
+    """
+    from operators import StageToRedshiftOperator, AggregateMaintenanceOperator, DataQualityOperator
+    from operators import TableMaintenanceOperator
+
+    load_sql = "SELECT count(1) FROM ({}) load_select".format(SqlQueries.songplay_table_insert)
+    sessions = []
+    for task in dag.topological_sort():
+        if isinstance(task, StageToRedshiftOperator):
+            sessions.append((task.task_id, "copy", task.priority_weight,
+                             "COPY (SELECT * FROM {}) TO STDOUT".format(task.target_table)))
+        elif is_load_task(task) or isinstance(task, AggregateMaintenanceOperator):
+            sessions.append((task.task_id, "load", task.priority_weight, load_sql))
+        elif isinstance(task, DataQualityOperator):
+            sessions += [(task.task_id, "check", task.priority_weight, check["sql"])
+                         for check in task.compile_checks(None)]
+        elif isinstance(task, TableMaintenanceOperator):
+            sessions.append((task.task_id, "maintenance", task.priority_weight, "ANALYZE public.songplays"))
+    return sessions
+
+
+def run_wlm(dsn, dag, pipelines, slots, poll_seconds):
+    """
+    Runs sessions of DAG for number of pipelines (sources) at the same time, each pipeline in its own thread
+    and its sessions in order of DAG, without limit and with slot scheduler limited to slots
+    (lease table in local Postgres). Measures time of all pipelines, maximal weight of statements
+    running at the same time, time of statements and time spent in queue by operation type and priority.
+    """
+    import threading
+    from helpers import RedshiftConnectionPool, SlotScheduler
+    from helpers.wlm_scheduler import OPERATION_WEIGHTS
+
+    class Discard(io.RawIOBase):
+        def write(self, data):
+            return len(data)
+
+    sessions = workload_sessions(dag)
+    ddl = open(os.path.join(ROOT, "datawarehouse", "create_tables.sql")).read()
+    lease_ddl = ddl[ddl.index("CREATE TABLE public.wlm_slot_lease"):]
+    lease_ddl = lease_ddl[:lease_ddl.index(";")]
+    result = {"pipelines": pipelines, "slots": slots, "sessions": len(sessions) * pipelines}
+
+    for mode in ("unlimited", "scheduled"):
+        pool = RedshiftConnectionPool("benchmark", max_size=pipelines * 2)
+        pool.connect_args = {"dsn": dsn}
+        scheduler = None
+        if mode == "scheduled":
+            with pool.session(autocommit=True) as session:
+                session.run(["DROP TABLE IF EXISTS public.wlm_slot_lease", postgres_ddl(lease_ddl)])
+            scheduler = SlotScheduler(pool, slots, poll_seconds=poll_seconds)
+        lock = threading.Lock()
+        state = {"weight": 0, "max_weight": 0}
+        timings = []
+
+        def run_pipeline(pipeline_no):
+            for task_id, operation, priority, sql in sessions:
+                lease = scheduler.acquire(operation, priority, task_id) if scheduler else None
+                weight = lease.weight if lease else min(OPERATION_WEIGHTS[operation], slots)
+                with lock:
+                    state["weight"] += weight
+                    state["max_weight"] = max(state["max_weight"], state["weight"])
+                start = time.monotonic()
+                try:
+                    with pool.session() as session:
+                        with session.connection.cursor() as cursor:
+                            if sql.startswith("COPY"):
+                                cursor.copy_expert(sql, Discard())
+                            else:
+                                cursor.execute(sql)
+                finally:
+                    with lock:
+                        state["weight"] -= weight
+                    if lease:
+                        scheduler.release(lease)
+                timings.append({"operation": operation, "priority": priority,
+                                "seconds": time.monotonic() - start,
+                                "queue_seconds": lease.wait_seconds if lease else 0.0})
+
+        start = time.monotonic()
+        threads = [threading.Thread(target=run_pipeline, args=(pipeline_no,)) for pipeline_no in range(pipelines)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+        pool.close()
+        if len(timings) != len(sessions) * pipelines:
+            raise RuntimeError("{} of {} sessions failed".format(len(sessions) * pipelines - len(timings),
+                                                                 len(sessions) * pipelines))
+
+        groups = {}
+        for timing in timings:
+            for key in (timing["operation"], "priority_{}".format(timing["priority"])):
+                group = groups.setdefault(key, {"sessions": 0, "seconds": 0.0, "queue_seconds": 0.0,
+                                                "max_queue_seconds": 0.0})
+                group["sessions"] += 1
+                group["seconds"] += timing["seconds"]
+                group["queue_seconds"] += timing["queue_seconds"]
+                group["max_queue_seconds"] = max(group["max_queue_seconds"], timing["queue_seconds"])
+        for group in groups.values():
+            group["avg_seconds"] = group["seconds"] / group["sessions"]
+            group["avg_queue_seconds"] = group["queue_seconds"] / group["sessions"]
+        result[mode] = {"seconds": elapsed, "max_weight": state["max_weight"], "groups": groups,
+                        "scheduler": scheduler.report() if scheduler else None}
+        print("  {:>9} {:<32} {:>9.3f} s, max weight {} of {} slots".format(
+                    "wlm", "{} pipelines {}".format(pipelines, mode), elapsed, state["max_weight"], slots))
+        if scheduler:
+            print("  {:>9} {:<32} {:>9} polls, {} dispatches with lock of lease table".format(
+                        "wlm", "scheduler", result[mode]["scheduler"]["polls"], result[mode]["scheduler"]["dispatches"]))
+        for key, group in sorted(groups.items()):
+            print("  {:>9} {:<32} {:>9.3f} s avg statement, {:.3f} s avg queue, {:.3f} s max queue".format(
+                        "wlm", "{} {}".format(mode, key), group["avg_seconds"], group["avg_queue_seconds"],
+                        group["max_queue_seconds"]))
+    return result
+
+
+def compare(results, baseline, tolerance, min_seconds):
+    """
+    Compares timings with baseline.
+    Returns list of regressions (timings slower than baseline by more than tolerance).
+    """
+    regressions = []
+    baseline_scales = {scale["events"]: scale for scale in baseline["scales"]}
+    for scale in results["scales"]:
+        previous = baseline_scales.get(scale["events"])
+        if previous is None:
+            continue
+        for name, seconds in scale["timings"].items():
+            previous_seconds = previous["timings"].get(name)
+            if previous_seconds is None or max(seconds, previous_seconds) < min_seconds:
+                continue
+            if seconds > previous_seconds * (1 + tolerance):
+                regressions.append({"events": scale["events"], "timing": name,
+                                    "baseline_seconds": previous_seconds, "seconds": seconds})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of pipeline SQL on local Postgres")
+    parser.add_argument("--dsn", default=os.environ.get("BENCHMARK_DSN", "dbname=postgres"),
+                        help="libpq connection string of benchmark database (tables are dropped!)")
+    parser.add_argument("--scales", default="10000,100000,1000000",
+                        help="comma separated numbers of events, up to {}".format(MAX_EVENTS))
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=None, help="path of results file")
+    parser.add_argument("--baseline", default=None, help="results file of previous version for comparison")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown against baseline (0.25 = 25%%)")
+    parser.add_argument("--backfill-days", type=int, default=0,
+                        help="number of days for comparison of day by day catchup with one pass backfill; 0 to skip")
+    parser.add_argument("--history-days", type=int, default=0,
+                        help="number of days loaded one by one for comparison of 'append' and 'window' modes "
+                             "of fact load as history grows; 0 to skip")
+    parser.add_argument("--stream-hours", type=int, default=0,
+                        help="number of hours of event stream loaded in micro-batches by stream_dag; 0 to skip")
+    parser.add_argument("--resume-files", type=int, default=0,
+                        help="number of staged objects (one of them malformed) in comparison of full reload "
+                             "with resumable chunked COPY; 0 to skip")
+    parser.add_argument("--resume-chunks", type=int, default=10, help="number of chunks of resumable COPY")
+    parser.add_argument("--aggregate-days", type=int, default=0,
+                        help="number of days loaded one by one with folding of new rows into rollups; 0 to skip")
+    parser.add_argument("--late-song-pct", type=int, default=0,
+                        help="percent of songs arriving after events, resolution of their songplays is compared "
+                             "with full rebuild of songplays; 0 to skip")
+    parser.add_argument("--wlm-pipelines", type=int, default=0,
+                        help="number of pipelines running sessions of DAG at the same time without limit "
+                             "and with slot scheduler; 0 to skip")
+    parser.add_argument("--wlm-slots", type=int, default=4, help="artificial limit of WLM slots of slot scheduler")
+    parser.add_argument("--wlm-poll-seconds", type=float, default=0.05, help="poll interval of waiting leases")
+    parser.add_argument("--min-seconds", type=float, default=0.05, help="timings faster than this are not compared")
+    args = parser.parse_args()
+
+    scales = [int(scale) for scale in args.scales.split(",")]
+    if any(scale < 1 or scale > MAX_EVENTS for scale in scales):
+        parser.error("scales must be between 1 and {}".format(MAX_EVENTS))
+    output = args.output or os.path.join(ROOT, "benchmark", "results", "results-{}.json".format(
+                                            datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S")))
+
+    dag = load_dag()
+    connection = psycopg2.connect(args.dsn)
+    with connection.cursor() as cursor:
+        cursor.execute("SHOW server_version")
+        server_version = cursor.fetchone()[0]
+    connection.commit()
+
+    results = {"version": git_version(),
+               "created_at": datetime.datetime.utcnow().isoformat(),
+               "postgres_version": server_version,
+               "python_version": platform.python_version(),
+               "seed": args.seed,
+               "scales": []}
+    for events in scales:
+        print("Scale: {} events".format(events))
+        result = run_scale(connection, dag, events, args.seed)
+        if args.backfill_days > 0:
+            result["backfill"] = run_backfill(connection, dag, events, args.seed, args.backfill_days)
+            result["timings"]["backfill.daily"] = result["backfill"]["daily_seconds"]
+            result["timings"]["backfill.range"] = result["backfill"]["range_seconds"]
+        if args.history_days > 0:
+            result["fact_history"] = run_fact_history(connection, dag, events, args.seed, args.history_days)
+            for insert_mode in ("append", "window"):
+                result["timings"]["history.{}.last_day".format(insert_mode)] = result["fact_history"][insert_mode][-1]
+        if args.stream_hours > 0:
+            result["stream"] = run_stream(connection, dag, events, args.seed, args.stream_hours)
+            result["timings"]["stream.mean_batch"] = result["stream"]["mean_batch_seconds"]
+        if args.resume_files > 0:
+            result["resumable"] = run_resumable(connection, events, args.seed, args.resume_files, args.resume_chunks)
+            result["timings"]["resumable.full"] = result["resumable"]["full"]["seconds"]
+            result["timings"]["resumable.chunks"] = result["resumable"]["resumable"]["seconds"]
+        if args.aggregate_days > 0:
+            result["aggregates"] = run_aggregates(connection, dag, events, args.seed, args.aggregate_days)
+            result["timings"]["aggregates.fold.last_day"] = result["aggregates"]["fold_seconds"][-1]
+            for table_name, rollup in result["aggregates"]["rollups"].items():
+                result["timings"]["aggregates.recompute.{}".format(table_name)] = rollup["recompute_seconds"]
+                result["timings"]["aggregates.read.{}".format(table_name)] = rollup["read_seconds"]
+        if args.late_song_pct > 0:
+            result["late_songs"] = run_late_songs(connection, dag, events, args.seed, args.late_song_pct)
+            result["timings"]["late_songs.resolve"] = result["late_songs"]["resolve_seconds"]
+            result["timings"]["late_songs.rebuild"] = result["late_songs"]["rebuild_seconds"]
+        if args.wlm_pipelines > 0:
+            result["wlm"] = run_wlm(args.dsn, dag, args.wlm_pipelines, args.wlm_slots, args.wlm_poll_seconds)
+            result["timings"]["wlm.unlimited"] = result["wlm"]["unlimited"]["seconds"]
+            result["timings"]["wlm.scheduled"] = result["wlm"]["scheduled"]["seconds"]
+        results["scales"].append(result)
+    connection.close()
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as output_file:
+        json.dump(results, output_file, indent=2, sort_keys=True)
+    print("Results: {}".format(output))
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance, args.min_seconds)
+        for regression in regressions:
+            print("REGRESSION at {events} events: {timing} {baseline_seconds:.3f} s -> {seconds:.3f} s".format(
+                        **regression))
+        if regressions:
+            sys.exit(1)
+        print("No regressions against {}".format(args.baseline))
+
+
+if __name__ == "__main__":
+    main()
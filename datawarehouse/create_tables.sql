@@ -5,6 +5,18 @@ DROP TABLE IF EXISTS public.songs;
 DROP TABLE IF EXISTS public.artists;
 DROP TABLE IF EXISTS public."time";
 DROP TABLE IF EXISTS public.users;
+DROP TABLE IF EXISTS public.staging_load_ledger;
+DROP TABLE IF EXISTS public.staging_load_checkpoint;
+DROP TABLE IF EXISTS public.staging_load_quarantine;
+DROP TABLE IF EXISTS public.query_plan_baseline;
+DROP TABLE IF EXISTS public.stream_high_water_mark;
+DROP TABLE IF EXISTS public.stream_staging_events;
+DROP TABLE IF EXISTS public.wlm_slot_lease;
+DROP TABLE IF EXISTS public.songplays_delta;
+DROP TABLE IF EXISTS public.songplays_daily_user;
+DROP TABLE IF EXISTS public.songplays_daily_song;
+DROP TABLE IF EXISTS public.songplays_hourly;
+DROP TABLE IF EXISTS public.songplays_unresolved;
 
 CREATE TABLE public.staging_events (
 	artist varchar(256),
@@ -24,7 +36,8 @@ CREATE TABLE public.staging_events (
 	status int4,
 	ts int8,
 	useragent varchar(256),
-	userid int4
+	userid int4,
+	start_time timestamp
 );
 
 CREATE TABLE public.staging_songs (
@@ -40,6 +53,95 @@ CREATE TABLE public.staging_songs (
 	"year" int4
 );
 
+CREATE TABLE public.staging_load_ledger (
+	target_table varchar(256) NOT NULL,
+	object_key varchar(1024) NOT NULL,
+	etag varchar(256),
+	object_size int8,
+	last_modified timestamp,
+	loaded_at timestamp,
+	CONSTRAINT staging_load_ledger_pkey PRIMARY KEY (target_table, object_key)
+);
+
+CREATE TABLE public.staging_load_checkpoint (
+	target_table varchar(256) NOT NULL,
+	run_id varchar(256) NOT NULL,
+	chunk_no int4 NOT NULL,
+	chunk_key varchar(1024),
+	row_count int8,
+	loaded_at timestamp,
+	CONSTRAINT staging_load_checkpoint_pkey PRIMARY KEY (target_table, run_id, chunk_no)
+);
+
+CREATE TABLE public.staging_load_quarantine (
+	target_table varchar(256) NOT NULL,
+	run_id varchar(256) NOT NULL,
+	chunk_no int4 NOT NULL,
+	file_name varchar(1024),
+	line_number int8,
+	column_name varchar(127),
+	error_code int4,
+	error_reason varchar(512),
+	raw_line varchar(1024),
+	rejection varchar(16),
+	quarantined_at timestamp
+);
+
+CREATE TABLE public.query_plan_baseline (
+	query_name varchar(256) NOT NULL,
+	plan_cost float8,
+	has_nested_loop boolean,
+	plan_hash varchar(32),
+	captured_at timestamp,
+	CONSTRAINT query_plan_baseline_pkey PRIMARY KEY (query_name)
+);
+
+CREATE TABLE public.stream_staging_events (
+	artist varchar(256),
+	auth varchar(256),
+	firstname varchar(256),
+	gender varchar(256),
+	iteminsession int4,
+	lastname varchar(256),
+	length numeric(18,0),
+	"level" varchar(256),
+	location varchar(256),
+	"method" varchar(256),
+	page varchar(256),
+	registration numeric(18,0),
+	sessionid int4,
+	song varchar(256),
+	status int4,
+	ts int8,
+	useragent varchar(256),
+	userid int4,
+	start_time timestamp
+);
+
+CREATE TABLE public.stream_high_water_mark (
+	stream_name varchar(256) NOT NULL,
+	object_key varchar(1024),
+	last_modified timestamp,
+	batch_count int8,
+	object_count int8,
+	loaded_at timestamp,
+	CONSTRAINT stream_high_water_mark_pkey PRIMARY KEY (stream_name)
+);
+
+CREATE TABLE public.wlm_slot_lease (
+	conn_id varchar(256) NOT NULL,
+	lease_id varchar(32) NOT NULL,
+	"owner" varchar(256),
+	operation varchar(32),
+	weight int4,
+	priority int4,
+	state varchar(16),
+	requested_at timestamp,
+	granted_at timestamp,
+	expires_at timestamp,
+	CONSTRAINT wlm_slot_lease_pkey PRIMARY KEY (conn_id, lease_id)
+);
+
 
 CREATE TABLE public."time" (
 	start_time timestamp NOT NULL,
@@ -68,6 +170,7 @@ CREATE TABLE public.artists (
 	location varchar(256),
 	latitude numeric(18,0),
 	longitude numeric(18,0),
+	name_key varchar(256),
 	CONSTRAINT artists_pkey PRIMARY KEY (artist_id)
 );
 
@@ -77,6 +180,8 @@ CREATE TABLE public.songs (
 	artist_id varchar(256),
 	"year" int4,
 	duration numeric(18,0),
+	title_key varchar(256),
+	duration_key numeric(18,0),
 	CONSTRAINT songs_pkey PRIMARY KEY (song_id),
 	CONSTRAINT fk_artist FOREIGN KEY(artist_id) REFERENCES artists(artist_id)
 );
@@ -96,5 +201,53 @@ CREATE TABLE public.songplays (
     CONSTRAINT fk_song FOREIGN KEY(song_id) REFERENCES songs(song_id),
     CONSTRAINT fk_artist FOREIGN KEY(artist_id) REFERENCES artists(artist_id),
     CONSTRAINT fk_start_time FOREIGN KEY(start_time) REFERENCES time(start_time)
-);
+)
+SORTKEY(start_time);
 
+CREATE TABLE public.songplays_delta (
+	delta_id int8 IDENTITY(1,1) NOT NULL,
+	songplay_id varchar(32) NOT NULL,
+	start_time timestamp NOT NULL,
+	user_id int4 NOT NULL,
+	"level" varchar(256),
+	song_id varchar(256),
+	artist_id varchar(256),
+	session_id int4,
+	location varchar(256),
+	user_agent varchar(256),
+	sign int2 NOT NULL DEFAULT 1
+)
+SORTKEY(start_time);
+
+CREATE TABLE public.songplays_daily_user (
+	play_date date NOT NULL,
+	user_id int4 NOT NULL,
+	"level" varchar(256) NOT NULL,
+	plays int8
+)
+SORTKEY(play_date);
+
+CREATE TABLE public.songplays_daily_song (
+	play_date date NOT NULL,
+	song_id varchar(256) NOT NULL,
+	artist_id varchar(256) NOT NULL,
+	plays int8
+)
+SORTKEY(play_date);
+
+CREATE TABLE public.songplays_hourly (
+	play_hour timestamp NOT NULL,
+	"level" varchar(256) NOT NULL,
+	plays int8
+)
+SORTKEY(play_hour);
+
+CREATE TABLE public.songplays_unresolved (
+	songplay_id varchar(32) NOT NULL,
+	start_time timestamp NOT NULL,
+	song_key varchar(256),
+	length_key numeric(18,0),
+	artist_key varchar(256),
+	captured_at timestamp
+)
+SORTKEY(song_key);
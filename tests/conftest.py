@@ -0,0 +1,88 @@
+import logging
+import os
+import sys
+import types
+
+# Plugins folder is on path of Airflow workers, tests import helpers and operators the same way
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "airflow", "plugins"))
+
+
+class BaseOperator(object):
+    """
+    Stand-in of Airflow BaseOperator with attributes read by operators of plugin.
+    """
+
+    def __init__(self, task_id=None, priority_weight=1, *args, **kwargs):
+        self.task_id = task_id
+        self.priority_weight = priority_weight
+        self.log = logging.getLogger(task_id)
+
+
+class Hook(object):
+    """
+    Stand-in of Airflow hook; tests replace hooks of operators with fakes, so hook is never created.
+    """
+
+    def __init__(self, *args, **kwargs):
+        raise RuntimeError("{} is not replaced by fake in test".format(type(self).__name__))
+
+
+def apply_defaults(function):
+    return function
+
+
+class AirflowSkipException(Exception):
+    pass
+
+
+class Stats(object):
+    """
+    Stand-in of Airflow Stats (StatsD client), metrics are dropped.
+    """
+
+    @staticmethod
+    def timing(stat, dt):
+        pass
+
+    @staticmethod
+    def gauge(stat, value):
+        pass
+
+    @staticmethod
+    def incr(stat, count=1):
+        pass
+
+
+# Modules of Airflow imported by tested operators and helpers, with their names used by plugin
+AIRFLOW_STUBS = {
+    "airflow.models": {"BaseOperator": BaseOperator},
+    "airflow.utils.decorators": {"apply_defaults": apply_defaults},
+    "airflow.exceptions": {"AirflowSkipException": AirflowSkipException},
+    "airflow.stats": {"Stats": Stats},
+    "airflow.hooks.base_hook": {"BaseHook": type("BaseHook", (Hook,), {})},
+}
+
+
+def install_airflow_stubs():
+    """
+    Registers stand-ins of Airflow modules, so tests run without Airflow installed
+    (folder airflow of repository is not Airflow package).
+    """
+    modules = {}
+    for name, attributes in sorted(AIRFLOW_STUBS.items()):
+        parts = name.split(".")
+        for depth in range(1, len(parts) + 1):
+            module_name = ".".join(parts[:depth])
+            if module_name not in modules:
+                modules[module_name] = types.ModuleType(module_name)
+                modules[module_name].__path__ = []
+                if depth > 1:
+                    setattr(modules[".".join(parts[:depth - 1])], parts[depth - 1], modules[module_name])
+        modules[name].__dict__.update(attributes)
+    sys.modules.update(modules)
+
+
+try:
+    import airflow.models
+except ImportError:
+    install_airflow_stubs()
@@ -0,0 +1,13 @@
+from helpers import SqlQueries
+from operators.aggregate_maintenance import AggregateMaintenanceOperator
+
+
+def test_fold_deletes_folded_rows_by_delta_key():
+    operator = AggregateMaintenanceOperator(task_id="Maintain_aggregates", rollups=SqlQueries.songplay_rollups)
+    statements = operator.render_fold_sql()
+
+    # Aggregation of snapshot, update, delete of empty groups, insert and drop for every rollup
+    assert len(statements) == 5 * len(SqlQueries.songplay_rollups) + 1
+    # Rows written to delta table after snapshot (e.g. -1/+1 pair of songplay that is in snapshot) are kept
+    assert " ".join(statements[-1].split()) == ("DELETE FROM songplays_delta "
+                                                "WHERE delta_id IN (SELECT delta_id FROM songplays_delta_fold)")
@@ -0,0 +1,50 @@
+import sqlite3
+
+import pytest
+
+from helpers import SqlQueries
+from operators.data_quality import DataQualityOperator
+
+
+@pytest.fixture
+def connection():
+    connection = sqlite3.connect(":memory:")
+    connection.executescript("""
+        CREATE TABLE staging_events (userid INTEGER, page TEXT);
+        CREATE TABLE users (user_id INTEGER, level TEXT);
+        INSERT INTO users VALUES (1, 'free'), (2, 'paid');
+    """)
+    yield connection
+    connection.close()
+
+
+def run_checks(connection, operator, scopes):
+    checks = operator.compile_checks(scopes)
+    return {check["type"]: operator.evaluate_check(check, connection.execute(check["sql"]).fetchone()[0])
+            for check in checks}
+
+
+def user_checks():
+    return DataQualityOperator(task_id="Run_data_quality_checks",
+                               table_key_list=[{"table_name": "users", "table_key": "user_id"}],
+                               dq_checks=SqlQueries.dq_checks,
+                               scope_mode="run")
+
+
+def test_fill_check_passes_when_run_scope_has_no_rows(connection):
+    assert run_checks(connection, user_checks(), {"users": SqlQueries.user_table_scope}) == {"fill": None,
+                                                                                             "double": None}
+
+
+def test_fill_check_fails_when_scoped_rows_are_missing(connection):
+    connection.execute("INSERT INTO staging_events VALUES (3, 'NextSong')")
+
+    failures = run_checks(connection, user_checks(), {"users": SqlQueries.user_table_scope})
+
+    assert failures == {"fill": "users contained 0 rows.", "double": None}
+
+
+def test_fill_check_of_full_scope_counts_rows(connection):
+    connection.execute("DELETE FROM users")
+
+    assert run_checks(connection, user_checks(), None)["fill"] == "users contained 0 rows."
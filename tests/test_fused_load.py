@@ -0,0 +1,77 @@
+import re
+from contextlib import contextmanager
+
+import pytest
+
+from helpers import SqlQueries
+from helpers.telemetry import pull_table_rows
+from operators import fused_load
+from operators.fused_load import FusedLoadOperator
+from operators.load_dimension import LoadDimensionOperator
+
+
+class ScriptSession:
+    """
+    Redshift session running single script; rows of statement number n of stored procedure are n * 10.
+    """
+
+    def __init__(self):
+        self.scripts = []
+        self.checkout_seconds = 0.0
+        self.queue_seconds = 0.0
+
+    def get_records(self, sql, parameters=None):
+        self.scripts.append(sql)
+        return [(int(statement_no), int(statement_no) * 10)
+                for statement_no in re.findall(r"VALUES \((\d+), fused_row_count\)", sql)]
+
+
+class FakeTaskInstance:
+    def __init__(self):
+        self.xcom = {}
+
+    def xcom_push(self, key, value):
+        self.xcom[key] = value
+
+    def xcom_pull(self, task_ids, key):
+        return [self.xcom.get(key) for _ in task_ids]
+
+
+def dimension_load(task_id, table_name, insert_mode):
+    return LoadDimensionOperator(task_id=task_id,
+                                 target_table_name=table_name,
+                                 target_table_fields=SqlQueries.user_table_fields,
+                                 target_table_key=SqlQueries.user_table_key,
+                                 sql_query_insert=SqlQueries.user_table_insert,
+                                 insert_mode=insert_mode)
+
+
+def test_single_script_reports_rows_of_every_statement(monkeypatch):
+    session = ScriptSession()
+
+    @contextmanager
+    def redshift_session(conn_id, autocommit=False, operation=None, priority=0, owner=""):
+        yield session
+
+    monkeypatch.setattr(fused_load, "redshift_session", redshift_session)
+    loads = [dimension_load("Load_user_dim_table", "users", "merge"),
+             dimension_load("Load_guest_dim_table", "guests", "append")]
+    operator = FusedLoadOperator(task_id="Load_tables", load_operators=loads, single_script="True")
+    ti = FakeTaskInstance()
+
+    operator.execute({"ti": ti})
+
+    assert len(session.scripts) == 1
+    assert re.search(r"CALL (fused_load_\w+)\(\);\s+DROP PROCEDURE \1\(\)", session.scripts[0])
+    statements = ti.xcom["telemetry"]["statements"]
+    assert [statement["rows"] for statement in statements] == [statement_no * 10
+                                                               for statement_no in range(len(statements))]
+    # Rows of single script are seen by table maintenance: UPDATE and INSERT of merge, INSERT of append
+    assert pull_table_rows({"ti": ti}, ["Load_tables"])["guests"] == {"written": 60, "deleted": 0}
+    assert pull_table_rows({"ti": ti}, ["Load_tables"])["users"] == {"written": 70, "deleted": 30}
+
+
+def test_delete_load_is_rejected():
+    with pytest.raises(ValueError, match="delete-load"):
+        FusedLoadOperator(task_id="Load_tables",
+                          load_operators=[dimension_load("Load_user_dim_table", "users", "delete-load")])
@@ -0,0 +1,46 @@
+import csv
+import gzip
+import io
+
+import pytest
+
+from helpers.json_records import CSV_NULL, parse_json_paths, iter_json_objects, extract_fields, csv_value, \
+                                 write_csv_gzip
+
+
+def test_parse_json_paths_supports_quoted_names_indexes_and_dots():
+    document = """{"jsonpaths": ["$['artist']", "$[\\"auth\\"]", "$.song.title", "$['tags'][0]"]}"""
+    assert parse_json_paths(document) == [["artist"], ["auth"], ["song", "title"], ["tags", 0]]
+
+
+def test_parse_json_paths_rejects_expression_without_root():
+    with pytest.raises(ValueError):
+        parse_json_paths('{"jsonpaths": ["artist"]}')
+
+
+def test_iter_json_objects_reads_concatenated_and_line_separated_objects():
+    text = '{"a": 1}{"a": 2}\n\n  {"a": {"b": [3]}}\n'
+    assert list(iter_json_objects(text)) == [{"a": 1}, {"a": 2}, {"a": {"b": [3]}}]
+    assert list(iter_json_objects("  \n")) == []
+
+
+def test_extract_fields_returns_none_for_missing_fields():
+    record = {"artist": "Muse", "song": {"title": "Uprising"}, "tags": ["rock"], "length": None}
+    paths = [["artist"], ["song", "title"], ["tags", 0], ["tags", 5], ["missing"], ["artist", "name"], ["length"]]
+    assert extract_fields(record, paths) == ["Muse", "Uprising", "rock", None, None, None, None]
+
+
+def test_csv_value():
+    assert csv_value(None) == CSV_NULL
+    assert csv_value(True) == "true"
+    assert csv_value(False) == "false"
+    assert csv_value({"a": [1]}) == '{"a": [1]}'
+    assert csv_value(0) == 0
+    assert csv_value("text") == "text"
+
+
+def test_write_csv_gzip_round_trip():
+    rows = [["Muse", 237.1, None, 'say "hi", bye'], ["", 0, True, "line\nbreak"]]
+    text = gzip.decompress(write_csv_gzip(rows)).decode("utf-8")
+    assert list(csv.reader(io.StringIO(text))) == [["Muse", "237.1", CSV_NULL, 'say "hi", bye'],
+                                                   ["", "0", "true", "line\nbreak"]]
@@ -0,0 +1,74 @@
+from helpers.key_advisor import short_table_name, collect_sql_texts, collect_column_usage, advise_table_keys, \
+                                render_key_ddl
+
+TABLE_FIELDS = {"public.songplays": ["songplay_id", "start_time", "user_id", "song_id", "artist_id"],
+                "public.songs": ["song_id", "title", "artist_id"],
+                "public.users": ["user_id", "level"]}
+
+QUERIES = [
+    """
+    SELECT count(1)
+    FROM public.songplays sp
+    JOIN songs s ON sp.song_id = s.song_id
+    JOIN {user_table_name} AS u ON u.user_id = sp.user_id
+    WHERE sp.start_time >= '2018-11-01' AND u.level = 'paid'
+    """,
+    """
+    SELECT s.title FROM songs s JOIN songplays ON songplays.song_id = s.song_id
+    WHERE songplays.start_time BETWEEN '2018-11-01' AND '2018-11-02'
+    """
+]
+
+
+class Queries:
+    single = "SELECT 1"
+    listed = ["SELECT 2", ("SELECT 3",)]
+    mapped = {"check": "SELECT 4"}
+    number = 5
+    _private = "SELECT 6"
+
+
+def test_short_table_name():
+    assert short_table_name('public."SongPlays"') == "songplays"
+
+
+def test_collect_sql_texts_reads_nested_attributes():
+    assert sorted(collect_sql_texts(Queries)) == ["SELECT 1", "SELECT 2", "SELECT 3", "SELECT 4"]
+
+
+def test_collect_column_usage():
+    usage = collect_column_usage(QUERIES, TABLE_FIELDS)
+    songplays = usage["public.songplays"]
+    assert songplays["join"] == {"song_id": 2, "user_id": 1}
+    assert songplays["range"] == {"start_time": 2}
+    assert songplays["partners"] == {"song_id": {"public.songs"}, "user_id": {"public.users"}}
+    assert usage["public.users"]["filter"] == {"level": 1}
+    assert usage["public.songs"]["join"] == {"song_id": 2}
+
+
+def test_advise_table_keys():
+    usage = collect_column_usage(QUERIES, TABLE_FIELDS)
+    advice = {item["table"]: item for item in advise_table_keys(usage, TABLE_FIELDS,
+                                                                 {"public.songplays": 5000000,
+                                                                  "public.songs": 3000000,
+                                                                  "public.users": 100})}
+    # Fact table and big dimension are distributed by column of their join, small dimension is copied to all nodes
+    assert (advice["public.songplays"]["diststyle"], advice["public.songplays"]["distkey"]) == ("KEY", "song_id")
+    assert advice["public.songplays"]["sortkey"] == "start_time"
+    assert (advice["public.songs"]["diststyle"], advice["public.songs"]["distkey"]) == ("KEY", "song_id")
+    assert (advice["public.users"]["diststyle"], advice["public.users"]["distkey"]) == ("ALL", None)
+    assert advice["public.users"]["sortkey"] == "user_id"
+
+
+def test_advise_table_keys_without_joins_is_even():
+    usage = collect_column_usage(["SELECT 1 FROM songplays WHERE songplays.user_id = 5"], TABLE_FIELDS)
+    advice = advise_table_keys(usage, TABLE_FIELDS, {"public.songplays": 10})
+    assert (advice[0]["diststyle"], advice[0]["distkey"], advice[0]["sortkey"]) == ("EVEN", None, "user_id")
+    assert advice[2]["sortkey"] is None
+
+
+def test_render_key_ddl():
+    assert render_key_ddl({"table": "songplays", "diststyle": "KEY", "distkey": "song_id", "sortkey": "start_time"}) == \
+           ["ALTER TABLE songplays ALTER DISTKEY song_id", "ALTER TABLE songplays ALTER SORTKEY (start_time)"]
+    assert render_key_ddl({"table": "users", "diststyle": "ALL", "distkey": None, "sortkey": None}) == \
+           ["ALTER TABLE users ALTER DISTSTYLE ALL"]
@@ -0,0 +1,36 @@
+from helpers import SqlQueries
+from operators.load_dimension import LoadDimensionOperator
+
+
+def statement_kinds(statements):
+    return [" ".join(statement.split()[:2]) for statement in statements]
+
+
+def user_load(**kwargs):
+    return LoadDimensionOperator(task_id="Load_user_dim_table",
+                                 target_table_name="users",
+                                 target_table_fields=SqlQueries.user_table_fields,
+                                 target_table_key=SqlQueries.user_table_key,
+                                 sql_query_insert=SqlQueries.user_table_insert,
+                                 insert_mode="merge",
+                                 **kwargs)
+
+
+def test_merge_updates_rows_in_place_and_inserts_new_keys():
+    statements = user_load().render_sql()
+
+    assert statement_kinds(statements) == ["CREATE TEMP", "INSERT INTO", "DELETE FROM", "UPDATE users",
+                                           "INSERT INTO", "DROP TABLE"]
+    # Rows of target table are never deleted, so rows referenced by songplays stay
+    assert all("users_merge_stage" in statement.split()[2] for statement in statements
+               if statement.split()[0] == "DELETE")
+    assert "SET first_name = users_merge_stage.first_name" in statements[3]
+    assert "user_id = users_merge_stage.user_id" not in statements[3].split("FROM")[0]
+    assert "NOT EXISTS" in statements[4]
+
+
+def test_merge_command_replaces_update_and_insert():
+    statements = user_load(use_merge_command="True").render_sql()
+
+    assert statement_kinds(statements) == ["CREATE TEMP", "INSERT INTO", "DELETE FROM", "MERGE INTO",
+                                           "DROP TABLE"]
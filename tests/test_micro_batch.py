@@ -0,0 +1,64 @@
+import datetime
+import os
+
+from helpers.micro_batch import select_micro_batch, list_folder_objects
+
+NOW = datetime.datetime(2018, 11, 1, 12, 0, tzinfo=datetime.timezone.utc)
+
+MAX_WAIT = datetime.timedelta(minutes=5)
+
+
+def make_object(key, size=10, age_minutes=0):
+    return {"key": key, "etag": key, "size": size, "last_modified": NOW - datetime.timedelta(minutes=age_minutes)}
+
+
+def test_no_objects_is_not_ready():
+    assert select_micro_batch([], 100, 10, MAX_WAIT, NOW) == ([], False)
+
+
+def test_small_fresh_batch_waits():
+    batch, ready = select_micro_batch([make_object("b", age_minutes=1), make_object("a")], 100, 10, MAX_WAIT, NOW)
+    assert [obj["key"] for obj in batch] == ["a", "b"]
+    assert not ready
+
+
+def test_batch_is_ready_when_oldest_object_waited_max_wait():
+    _, ready = select_micro_batch([make_object("a", age_minutes=5)], 100, 10, MAX_WAIT, NOW)
+    assert ready
+
+
+def test_batch_is_ready_when_limit_of_objects_is_reached():
+    objects = [make_object(key) for key in "cba"]
+    batch, ready = select_micro_batch(objects, 100, 2, MAX_WAIT, NOW)
+    assert [obj["key"] for obj in batch] == ["a", "b"]
+    assert ready
+
+
+def test_batch_is_ready_when_limit_of_bytes_is_reached():
+    batch, ready = select_micro_batch([make_object("a", 60), make_object("b", 60)], 100, 10, MAX_WAIT, NOW)
+    assert [obj["key"] for obj in batch] == ["a"]
+    assert ready
+    batch, ready = select_micro_batch([make_object("a", 100)], 100, 10, MAX_WAIT, NOW)
+    assert ready
+
+
+def test_object_bigger_than_limit_is_batch_of_its_own():
+    batch, ready = select_micro_batch([make_object("a", 500), make_object("b")], 100, 10, MAX_WAIT, NOW)
+    assert [obj["key"] for obj in batch] == ["a"]
+    assert ready
+
+
+def test_list_folder_objects(tmp_path):
+    for relative_path, content in (("log_stream/2018/0001.json", b"{}"), ("log_stream/2018/0002.json", b"{}{}"),
+                                   ("other/0001.json", b"{}")):
+        path = tmp_path.joinpath(*relative_path.split("/"))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+    os.utime(tmp_path / "log_stream" / "2018" / "0001.json", (1541073600, 1541073600))
+
+    objects = list_folder_objects(str(tmp_path), "log_stream/")
+    assert [(obj["key"], obj["size"]) for obj in objects] == [("log_stream/2018/0001.json", 2),
+                                                              ("log_stream/2018/0002.json", 4)]
+    assert objects[0]["last_modified"] == datetime.datetime(2018, 11, 1, 12, 0, tzinfo=datetime.timezone.utc)
+    assert [obj["key"] for obj in list_folder_objects(str(tmp_path), "log_stream/", "log_stream/2018/0001.json")] == \
+           ["log_stream/2018/0002.json"]
@@ -0,0 +1,49 @@
+import re
+
+from helpers import SqlQueries
+from operators.micro_batch_ingest import MicroBatchIngestOperator
+
+DAILY_STAGING = re.compile(r"(?<![\w.])staging_events\b")
+
+
+def make_operator(staging_table):
+    return MicroBatchIngestOperator(
+        task_id="Ingest_micro_batches",
+        staging_table=staging_table,
+        s3_bucket="udacity-dend",
+        s3_key="log_stream/",
+        post_copy_sql=[SqlQueries.staging_events_start_time_update],
+        loads=[{"operator": "LoadDimensionOperator",
+                "params": {"target_table_name": "users",
+                           "target_table_fields": SqlQueries.user_table_fields,
+                           "target_table_key": SqlQueries.user_table_key,
+                           "sql_query_insert": SqlQueries.user_table_insert,
+                           "insert_mode": "merge"}},
+               {"operator": "LoadFactOperator",
+                "params": {"target_table_name": "songplays",
+                           "target_table_fields": SqlQueries.songplay_table_fields,
+                           "target_table_key": SqlQueries.songplay_table_key,
+                           "sql_query_insert": SqlQueries.songplay_table_insert,
+                           "insert_mode": "window",
+                           "sql_query_select": SqlQueries.songplay_table_select,
+                           "window_query": SqlQueries.songplay_table_window}}])
+
+
+def test_loads_read_own_staging_table_of_stream():
+    operator = make_operator("public.stream_staging_events")
+    users, songplays = operator.get_load_operators()
+
+    assert operator.stage_table_name == "stream_staging_events"
+    for sql in operator.post_copy_sql + [users.sql_query_insert, songplays.sql_query_insert,
+                                         songplays.sql_query_select, songplays.window_query]:
+        assert "stream_staging_events" in sql
+        assert not DAILY_STAGING.search(sql)
+    assert (users.target_table_name, songplays.target_table_name) == ("users", "songplays")
+
+
+def test_loads_are_unchanged_with_daily_staging_table():
+    operator = make_operator("public.staging_events")
+    users, _ = operator.get_load_operators()
+
+    assert operator.post_copy_sql == [SqlQueries.staging_events_start_time_update]
+    assert users.sql_query_insert == SqlQueries.user_table_insert
@@ -0,0 +1,29 @@
+from operators.resolve_late_songs import ResolveLateSongsOperator
+
+SONG_SCOPE_SQL = "SELECT song_id FROM songs_scope"
+ARTIST_SCOPE_SQL = "SELECT artist_id FROM artists_scope"
+
+
+def statement_kinds(statements):
+    return [" ".join(statement.split()[:2]) for statement in statements]
+
+
+def test_render_resolve_sql_with_delta_table():
+    operator = ResolveLateSongsOperator(task_id="Resolve_late_songs")
+    statements, update_index = operator.render_resolve_sql(SONG_SCOPE_SQL, ARTIST_SCOPE_SQL)
+
+    assert statement_kinds(statements) == ["CREATE TEMP", "INSERT INTO", "UPDATE songplays", "DELETE FROM",
+                                           "DROP TABLE"]
+    assert statements[1].split()[2] == "songplays_delta"
+    assert statement_kinds([statements[update_index]]) == ["UPDATE songplays"]
+    assert SONG_SCOPE_SQL in statements[0] and ARTIST_SCOPE_SQL in statements[0]
+
+
+def test_render_resolve_sql_without_delta_table():
+    operator = ResolveLateSongsOperator(task_id="Resolve_late_songs", delta_table="")
+    statements, update_index = operator.render_resolve_sql(SONG_SCOPE_SQL)
+
+    assert statement_kinds(statements) == ["CREATE TEMP", "UPDATE songplays", "DELETE FROM", "DROP TABLE"]
+    assert statement_kinds([statements[update_index]]) == ["UPDATE songplays"]
+    # Without scope of artists pending rows are matched with new songs only
+    assert "new_artists" not in statements[0]
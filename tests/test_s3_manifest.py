@@ -0,0 +1,90 @@
+import datetime
+import json
+
+from helpers.s3_manifest import list_s3_objects, object_fingerprint, select_new_objects, build_copy_manifest, \
+                                split_objects_by_size, split_objects_into_chunks
+
+MODIFIED = datetime.datetime(2018, 11, 1, 12, 30, 15)
+
+
+class FakePaginator:
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+
+    def paginate(self, **kwargs):
+        self.calls.append(kwargs)
+        return iter(self.pages)
+
+
+class FakeS3Client:
+    def __init__(self, pages):
+        self.paginator = FakePaginator(pages)
+
+    def get_paginator(self, operation):
+        assert operation == "list_objects_v2"
+        return self.paginator
+
+
+def make_object(key, size=100, etag="e", last_modified=MODIFIED):
+    return {"key": key, "etag": etag, "size": size, "last_modified": last_modified}
+
+
+def test_list_s3_objects_reads_all_pages_and_skips_folders():
+    client = FakeS3Client([
+        {"Contents": [{"Key": "song_data/", "Size": 0},
+                      {"Key": "song_data/A/a.json", "ETag": '"abc"', "Size": 10, "LastModified": MODIFIED}]},
+        {},
+        {"Contents": [{"Key": "song_data/B/b.json", "ETag": '"def"', "Size": 20, "LastModified": MODIFIED}]}
+    ])
+    objects = list_s3_objects(client, "udacity-dend", "song_data")
+    assert objects == [make_object("song_data/A/a.json", 10, "abc"), make_object("song_data/B/b.json", 20, "def")]
+    assert client.paginator.calls == [{"Bucket": "udacity-dend", "Prefix": "song_data"}]
+
+
+def test_list_s3_objects_passes_start_after():
+    client = FakeS3Client([])
+    list_s3_objects(client, "bucket", "log_stream/", start_after="log_stream/0001")
+    assert client.paginator.calls[0]["StartAfter"] == "log_stream/0001"
+
+
+def test_object_fingerprint_truncates_time_to_seconds():
+    assert object_fingerprint("e", "100", MODIFIED.replace(microsecond=999)) == ("e", 100, "2018-11-01 12:30:15")
+    assert object_fingerprint("e", None, None) == ("e", 0, None)
+
+
+def test_select_new_objects_returns_new_and_changed_objects():
+    objects = [make_object("a"), make_object("b", etag="changed"), make_object("c")]
+    loaded_objects = {"a": object_fingerprint("e", 100, MODIFIED),
+                      "b": object_fingerprint("e", 100, MODIFIED)}
+    assert [obj["key"] for obj in select_new_objects(objects, loaded_objects)] == ["b", "c"]
+
+
+def test_build_copy_manifest():
+    manifest = json.loads(build_copy_manifest("bucket", [make_object("song_data/a.json", 42)]))
+    assert manifest == {"entries": [{"url": "s3://bucket/song_data/a.json",
+                                     "mandatory": True,
+                                     "meta": {"content_length": 42}}]}
+
+
+def test_split_objects_by_size_balances_groups():
+    objects = [make_object(key, size) for key, size in (("a", 50), ("b", 40), ("c", 30), ("d", 20), ("e", 10))]
+    groups = split_objects_by_size(objects, 2)
+    assert [[obj["key"] for obj in group] for group in groups] == [["a", "d", "e"], ["b", "c"]]
+    assert sorted(sum(obj["size"] for obj in group) for group in groups) == [70, 80]
+
+
+def test_split_objects_by_size_drops_empty_groups():
+    assert len(split_objects_by_size([make_object("a")], 4)) == 1
+    assert split_objects_by_size([], 4) == []
+
+
+def test_split_objects_into_chunks_limits_bytes_and_objects():
+    objects = [make_object(key, size) for key, size in (("d", 10), ("a", 60), ("b", 50), ("c", 10), ("e", 10))]
+    chunks = split_objects_into_chunks(objects, 100, 2)
+    assert [[obj["key"] for obj in chunk] for chunk in chunks] == [["a"], ["b", "c"], ["d", "e"]]
+
+
+def test_split_objects_into_chunks_keeps_big_object_in_own_chunk():
+    chunks = split_objects_into_chunks([make_object("a", 500), make_object("b", 10)], 100, 10)
+    assert [[obj["key"] for obj in chunk] for chunk in chunks] == [["a"], ["b"]]
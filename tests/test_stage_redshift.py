@@ -0,0 +1,200 @@
+import collections
+import datetime
+import sqlite3
+from contextlib import contextmanager
+
+import pytest
+
+from operators import stage_redshift
+from operators.stage_redshift import StageToRedshiftOperator
+
+Credentials = collections.namedtuple("Credentials", ["access_key", "secret_key"])
+
+MODIFIED = datetime.datetime(2018, 11, 1, 12, 30, 15)
+
+
+class FakeS3Client:
+    """
+    S3 client with paginator of list_objects_v2 over dictionary {key: (etag, size)}.
+    """
+
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_paginator(self, operation):
+        assert operation == "list_objects_v2"
+        return self
+
+    def paginate(self, Bucket, Prefix, StartAfter=None):
+        keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        # Two objects per page, as continuation tokens of S3 split listing
+        for start in range(0, len(keys), 2):
+            yield {"Contents": [{"Key": key, "ETag": '"{}"'.format(self.objects[key][0]), "Size": self.objects[key][1],
+                                 "LastModified": MODIFIED}
+                                for key in keys[start:start + 2]]}
+
+
+class FakeS3Hook:
+    def __init__(self, objects):
+        self.client = FakeS3Client(objects)
+        self.written = {}
+
+    def get_conn(self):
+        return self.client
+
+    def load_string(self, string_data, key, bucket_name=None, replace=False):
+        self.written[(bucket_name, key)] = string_data
+
+    def check_for_key(self, key, bucket_name=None):
+        return (bucket_name, key) in self.written
+
+    def read_key(self, key, bucket_name=None):
+        return self.written[(bucket_name, key)]
+
+
+class InMemorySession:
+    """
+    Redshift session with ledger of loaded objects in in-memory SQLite database; other statements are recorded only
+    and other queries return no rows.
+    """
+
+    def __init__(self, ledger_table):
+        self.ledger_table = ledger_table
+        # Shards of sharded mode run in pool of threads
+        self.database = sqlite3.connect(":memory:", check_same_thread=False)
+        self.database.execute("ATTACH DATABASE ':memory:' AS public")
+        self.database.execute("""
+            CREATE TABLE {} (target_table text, object_key text, etag text, object_size integer,
+                             last_modified text, loaded_at text)
+        """.format(ledger_table))
+        self.statements = []
+        self.checkout_seconds = 0.0
+        self.queue_seconds = 0.0
+
+    def copies(self):
+        return [statement for statement in self.statements if statement.split()[0].upper() == "COPY"]
+
+    def run(self, sql, parameters=None):
+        if isinstance(sql, str):
+            sql = [sql]
+        rowcounts = []
+        for statement in sql:
+            self.statements.append(statement)
+            if self.ledger_table in statement:
+                rowcounts.append(self.database.execute(statement).rowcount)
+            else:
+                rowcounts.append(0)
+        self.database.commit()
+        return rowcounts
+
+    def get_records(self, sql, parameters=None):
+        if self.ledger_table not in sql:
+            self.statements.append(sql)
+            return []
+        return [(object_key, etag, object_size, datetime.datetime.strptime(last_modified, '%Y-%m-%d %H:%M:%S'))
+                for object_key, etag, object_size, last_modified in self.database.execute(sql).fetchall()]
+
+    def get_first(self, sql, parameters=None):
+        # Row count and bytes of COPY read by telemetry
+        return (0,)
+
+
+class FakeTaskInstance:
+    def __init__(self):
+        self.xcom = {}
+
+    def xcom_push(self, key, value):
+        self.xcom[key] = value
+
+
+@pytest.fixture
+def staging(monkeypatch):
+    objects = {"song_data/A/A/TRAAAAK.json": ("e1", 200),
+               "song_data/A/B/TRAABBB.json": ("e2", 300),
+               "song_data/B/A/TRABAAA.json": ("e3", 100)}
+    s3_hook = FakeS3Hook(objects)
+    session = InMemorySession("public.staging_load_ledger")
+
+    @contextmanager
+    def redshift_session(conn_id, autocommit=False, operation=None, priority=0, owner=""):
+        yield session
+
+    monkeypatch.setattr(stage_redshift, "get_s3_hook", lambda aws_credentials_id: s3_hook)
+    monkeypatch.setattr(stage_redshift, "get_aws_credentials", lambda aws_credentials_id: Credentials("key", "secret"))
+    monkeypatch.setattr(stage_redshift, "redshift_session", redshift_session)
+    operator = StageToRedshiftOperator(task_id="Stage_songs",
+                                       redshift_conn_id="redshift",
+                                       aws_credentials_id="aws_credentials",
+                                       target_table="staging_songs",
+                                       s3_bucket="udacity-dend",
+                                       s3_key="song_data",
+                                       use_incremental_load="True",
+                                       manifest_bucket="manifests")
+    return operator, objects, s3_hook, session
+
+
+def run_task(operator, ts_nodash):
+    ti = FakeTaskInstance()
+    operator.execute({"ti": ti, "ts_nodash": ts_nodash, "run_id": "scheduled__{}".format(ts_nodash)})
+    return ti
+
+
+def test_second_run_copies_no_objects(staging):
+    operator, objects, s3_hook, session = staging
+
+    ti = run_task(operator, "20181101T000000")
+    assert len(session.copies()) == 1
+    assert ti.xcom["staging_changed"] is True
+    manifest = s3_hook.written[("manifests", "manifests/staging_songs/20181101T000000.manifest")]
+    assert all("s3://udacity-dend/{}".format(key) in manifest for key in objects)
+    assert session.database.execute("SELECT count(1) FROM public.staging_load_ledger").fetchone() == (3,)
+
+    ti = run_task(operator, "20181102T000000")
+    assert len(session.copies()) == 1
+    assert ti.xcom["staging_changed"] is False
+    assert ("manifests", "manifests/staging_songs/20181102T000000.manifest") not in s3_hook.written
+    assert session.statements[-1] == "DELETE FROM staging_songs"
+
+
+def test_changed_and_new_objects_are_copied(staging):
+    operator, objects, s3_hook, session = staging
+    run_task(operator, "20181101T000000")
+
+    objects["song_data/A/B/TRAABBB.json"] = ("e2-changed", 310)
+    objects["song_data/C/A/TRACAAA.json"] = ("e4", 50)
+    ti = run_task(operator, "20181102T000000")
+    assert len(session.copies()) == 2
+    assert ti.xcom["staging_changed"] is True
+    manifest = s3_hook.written[("manifests", "manifests/staging_songs/20181102T000000.manifest")]
+    assert "TRAABBB.json" in manifest and "TRACAAA.json" in manifest and "TRAAAAK.json" not in manifest
+    assert session.database.execute("""
+        SELECT etag FROM public.staging_load_ledger WHERE object_key = 'song_data/A/B/TRAABBB.json'
+    """).fetchall() == [("e2-changed",)]
+
+
+def test_sharded_copy_leases_slots_for_every_shard(staging, monkeypatch):
+    operator, objects, s3_hook, session = staging
+    operator.shard_count = 2
+    operator.max_concurrency = 1
+    leases = []
+    held = []
+
+    @contextmanager
+    def redshift_session(conn_id, autocommit=False, operation=None, priority=0, owner=""):
+        # Operation of session and leases held by task when session asks for its lease
+        leases.append((operation, priority, owner, list(held)))
+        held.append(operation)
+        try:
+            yield session
+        finally:
+            held.remove(operation)
+
+    monkeypatch.setattr(stage_redshift, "redshift_session", redshift_session)
+    monkeypatch.setattr(stage_redshift, "get_pool", lambda conn_id, max_size=4: None)
+    ti = run_task(operator, "20181101T000000")
+
+    assert len(session.copies()) == 2
+    assert ti.xcom["staging_changed"] is True
+    assert [(operation, held_leases) for operation, _, _, held_leases in leases] == \
+        [("check", []), ("copy", []), ("copy", []), ("load", [])]
+    assert {(priority, owner) for _, priority, owner, _ in leases} == {(operator.priority_weight, "Stage_songs")}
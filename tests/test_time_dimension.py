@@ -0,0 +1,60 @@
+import calendar
+import csv
+import datetime
+import io
+
+import numpy as np
+
+from helpers.time_dimension import time_attributes, time_csv
+
+# Leap years, ISO weeks 52/53 and 1 crossing years, Sundays and Saturdays, last second of day
+TIMESTAMPS = [datetime.datetime(1970, 1, 1, 0, 0, 0),
+              datetime.datetime(2004, 12, 31, 23, 59, 59),
+              datetime.datetime(2005, 1, 2, 8, 15, 1),
+              datetime.datetime(2008, 12, 29, 12, 0, 0),
+              datetime.datetime(2016, 2, 29, 6, 7, 8),
+              datetime.datetime(2018, 11, 3, 21, 5, 30),
+              datetime.datetime(2018, 11, 4, 0, 0, 1),
+              datetime.datetime(2021, 1, 3, 17, 45, 59)]
+
+
+def epoch(timestamp):
+    return calendar.timegm(timestamp.timetuple())
+
+
+def expected_attributes(timestamp):
+    # Redshift extract(WEEK) is ISO week, to_char(ts, 'D') is 1 for Sunday
+    return {"hour": timestamp.hour,
+            "minute": timestamp.minute,
+            "second": timestamp.second,
+            "day": timestamp.day,
+            "week": timestamp.isocalendar()[1],
+            "month": timestamp.month,
+            "year": timestamp.year,
+            "weekday": timestamp.isoweekday() % 7 + 1}
+
+
+def test_time_attributes_match_calendar():
+    attributes = time_attributes([epoch(timestamp) for timestamp in TIMESTAMPS])
+    for row_no, timestamp in enumerate(TIMESTAMPS):
+        assert {field: int(attributes[field][row_no]) for field in expected_attributes(timestamp)} == \
+               expected_attributes(timestamp)
+        assert attributes["start_time"][row_no] == np.datetime64(timestamp, "s")
+
+
+def test_time_csv_rows_are_sorted_and_zero_padded():
+    rows = list(csv.reader(io.StringIO(time_csv([epoch(timestamp) for timestamp in reversed(TIMESTAMPS)]).decode())))
+    assert len(rows) == len(TIMESTAMPS)
+    for row, timestamp in zip(rows, TIMESTAMPS):
+        attributes = expected_attributes(timestamp)
+        assert row == [timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+                       "{:02d}".format(attributes["hour"]),
+                       "{:02d}".format(attributes["day"]),
+                       "{:02d}".format(attributes["week"]),
+                       "{:02d}".format(attributes["month"]),
+                       "{:04d}".format(attributes["year"]),
+                       str(attributes["weekday"])]
+
+
+def test_time_csv_of_no_timestamps_is_empty():
+    assert time_csv([]) == b""
@@ -0,0 +1,179 @@
+import re
+from contextlib import contextmanager
+
+import pytest
+
+from helpers import wlm_scheduler
+from helpers.wlm_scheduler import SlotLease, SlotScheduler
+
+
+class FakeLeaseTable:
+    """
+    Lease table of one connection with fake clock; statements of SlotScheduler are recognized by their clauses.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.leases = {}
+        self.requests = 0
+        self.locks = 0
+        self.transactions = 0
+
+    def add(self, lease_id, weight, priority, state="waiting", expires_in=60):
+        self.requests += 1
+        self.leases[lease_id] = {"weight": weight, "priority": priority, "state": state,
+                                 "requested": self.requests, "expires": self.now + expires_in}
+
+    def states(self):
+        return {lease_id: lease["state"] for lease_id, lease in self.leases.items()}
+
+    def expired(self):
+        return [lease_id for lease_id, lease in self.leases.items() if lease["expires"] < self.now]
+
+    def execute(self, sql):
+        interval = re.search(r"INTERVAL '(\d+) seconds'", sql)
+        lease_ids = re.findall(r"lease_id (?:=|IN) \(?([^)\n]+)", sql)
+        lease_ids = re.findall(r"'(\w+)'", lease_ids[0]) if lease_ids else []
+        if sql.startswith("LOCK"):
+            self.locks += 1
+            return []
+        if sql.startswith("INSERT"):
+            values = re.search(r"VALUES \('\w+', '(\w+)', '[^']*', '\w+', (\d+), (-?\d+)", sql)
+            self.add(values.group(1), int(values.group(2)), int(values.group(3)), expires_in=int(interval.group(1)))
+            return 1
+        if sql.startswith("DELETE") and "expires_at < GETDATE()" in sql:
+            expired = self.expired()
+        elif sql.startswith("DELETE"):
+            expired = [lease_id for lease_id in lease_ids if lease_id in self.leases]
+        if sql.startswith("DELETE"):
+            for lease_id in expired:
+                del self.leases[lease_id]
+            return len(expired)
+        if sql.startswith("UPDATE"):
+            updated = [lease_id for lease_id in lease_ids if lease_id in self.leases
+                       and ("state = 'waiting'" not in sql or self.leases[lease_id]["state"] == "waiting")]
+            for lease_id in updated:
+                self.leases[lease_id]["expires"] = self.now + int(interval.group(1))
+                if "SET state = 'running'" in sql:
+                    self.leases[lease_id]["state"] = "running"
+            return len(updated)
+        if sql.startswith("SELECT MAX"):
+            state = self.leases[lease_ids[0]]["state"] if lease_ids[0] in self.leases else None
+            return [(state, len(self.expired()))]
+        queue = sorted(self.leases.items(), key=lambda item: (item[1]["state"], -item[1]["priority"],
+                                                              item[1]["requested"], item[0]))
+        return [(lease_id, lease["weight"], lease["state"]) for lease_id, lease in queue]
+
+
+class FakeSession:
+    def __init__(self, table):
+        self.table = table
+
+    def run(self, sql, parameters=None):
+        return [self.table.execute(sql.strip())]
+
+    def get_records(self, sql, parameters=None):
+        return self.table.execute(sql.strip())
+
+    def get_first(self, sql, parameters=None):
+        return self.get_records(sql)[0]
+
+
+class FakePool:
+    """
+    Pool of connections of Redshift connection over fake lease table; counts transactions (sessions
+    not in autocommit mode).
+    """
+
+    conn_id = "redshift"
+
+    def __init__(self, table):
+        self.table = table
+
+    @contextmanager
+    def session(self, autocommit=False):
+        if not autocommit:
+            self.table.transactions += 1
+        yield FakeSession(self.table)
+
+
+@pytest.fixture
+def table():
+    return FakeLeaseTable()
+
+
+@pytest.fixture
+def scheduler(table):
+    return SlotScheduler(FakePool(table), 2, poll_seconds=2.0, min_poll_seconds=0.25)
+
+
+def test_weights_are_capped_by_slots(scheduler):
+    assert scheduler.weight("copy") == 2
+    assert scheduler.weight("load") == 2
+    assert scheduler.weight("maintenance") == 2
+    assert scheduler.weight("check") == 1
+    with pytest.raises(ValueError):
+        scheduler.weight("vacuum")
+
+
+def test_release_grants_waiting_leases_by_priority_without_starving_heavy_lease(scheduler, table):
+    running = scheduler.acquire("load", owner="Load_songplays_fact_table")
+    assert table.states() == {running.lease_id: "running"}
+    table.add("copy_low", 2, 0)
+    table.add("check_high", 1, 10)
+    table.add("check_low", 1, 0)
+
+    scheduler.release(running)
+    # Light check of low priority fits into free slot, but is not granted before COPY requested earlier
+    assert table.states() == {"copy_low": "waiting", "check_high": "running", "check_low": "waiting"}
+
+    scheduler.release(SlotLease("check_high", "check", 1, 10))
+    assert table.states() == {"copy_low": "running", "check_low": "waiting"}
+
+    scheduler.release(SlotLease("copy_low", "copy", 2, 0))
+    assert table.states() == {"check_low": "running"}
+
+
+def test_waiting_session_polls_without_lock_and_backs_off(scheduler, table, monkeypatch):
+    running = scheduler.acquire("copy", owner="Stage_events")
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        table.now += seconds
+        if len(sleeps) == 5:
+            scheduler.release(running)
+
+    monkeypatch.setattr(wlm_scheduler.time, "sleep", sleep)
+    lease = scheduler.acquire("check", priority=5, owner="Run_data_quality_checks")
+
+    assert sleeps == [0.25, 0.5, 1.0, 2.0, 2.0]
+    assert table.states() == {lease.lease_id: "running"}
+    # Locks and transactions: grant of COPY, request of check and release of COPY; polls only read state
+    assert (table.locks, table.transactions) == (3, 3)
+    report = scheduler.report()
+    assert (report["leases"], report["queued"], report["polls"], report["dispatches"]) == (2, 1, 5, 3)
+
+
+def test_waiting_session_dispatches_queue_when_lease_expired(scheduler, table, monkeypatch):
+    table.add("crashed", 2, 0, state="running", expires_in=1)
+    monkeypatch.setattr(wlm_scheduler.time, "sleep", lambda seconds: setattr(table, "now", table.now + seconds))
+
+    lease = scheduler.acquire("load")
+
+    assert table.states() == {lease.lease_id: "running"}
+    assert scheduler.report()["expired"] == 1
+
+
+def test_lost_lease_is_requested_again(scheduler, table, monkeypatch):
+    running = scheduler.acquire("copy")
+
+    def sleep(seconds):
+        # Lease of waiting session is deleted as expired and slots are released meanwhile
+        del table.leases[[lease_id for lease_id in table.leases if lease_id != running.lease_id][0]]
+        scheduler.release(running)
+
+    monkeypatch.setattr(wlm_scheduler.time, "sleep", sleep)
+    lease = scheduler.acquire("check")
+
+    assert table.states() == {lease.lease_id: "running"}